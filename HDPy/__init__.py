@@ -31,11 +31,15 @@ incorporates Reservoir Computing as the Critic's function approximator
 
 """
 from rc import *
+from epoch import *
+from features import *
+from checkpoint import *
 from rl import *
 from analysis import *
 from puppy import *
 from inout import *
 from hdp import *
+from population import *
 
 import puppy
 import epuck
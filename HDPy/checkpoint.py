@@ -0,0 +1,181 @@
+"""
+Storing an :py:class:`ActorCritic` through :py:meth:`ActorCritic.save`
+pickles the whole object, including the reservoir matrices and the
+readout. For a large critic, this takes long enough to stall the
+control loop. This module provides an alternative checkpoint format.
+
+A checkpoint is a directory. The object is pickled into *state.pkl*
+(binary protocol), but all numeric arrays - including the components of
+sparse matrices - are stored as separate *.npy* files next to it. Only
+a small metadata record remains in the pickle. Writing a checkpoint
+happens in two phases: First, the object is pickled and its arrays
+copied in memory. This snapshot is consistent and cheap. Second, the
+snapshot is written to disk, optionally by a background thread
+(:py:class:`CheckpointWriter`). The files are written into a temporary
+directory which is renamed once complete, hence a checkpoint on disk is
+never partially written.
+
+When loading a checkpoint, the arrays are memory-mapped in
+copy-on-write mode. They can be altered without affecting the files
+and are only read from disk when accessed.
+
+"""
+import cPickle as pickle
+import cStringIO
+import numpy as np
+import os
+import shutil
+import threading
+import Queue
+import atexit
+
+STATE_FILE = 'state.pkl'
+
+def _array_file(pth, pid):
+    """Return the path of the array ``pid`` in checkpoint ``pth``."""
+    return os.path.join(pth, 'arr_%i.npy' % pid)
+
+def snapshot(obj, min_size=64):
+    """Return a snapshot of ``obj``, i.e. its pickled state and a list
+    of the numeric arrays it contains (as copies). Arrays with less
+    than ``min_size`` items are kept in the pickle.
+    """
+    arrays = []
+    ids = {}
+    
+    def persistent_id(item):
+        if type(item) is not np.ndarray and not isinstance(item, np.memmap):
+            return None
+        if item.dtype.hasobject or item.size < min_size:
+            return None
+        
+        pid = ids.get(id(item))
+        if pid is None:
+            pid = ids[id(item)] = len(arrays)
+            arrays.append((item, np.array(item, copy=True)))
+        return pid
+    
+    buf = cStringIO.StringIO()
+    pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+    
+    # The originals were kept alive to keep the ids unique while pickling
+    return buf.getvalue(), [copy for _, copy in arrays]
+
+def write_snapshot(pth, state, arrays):
+    """Write a snapshot (see :py:func:`snapshot`) to the checkpoint
+    directory ``pth``. An existing checkpoint is replaced."""
+    pth = os.path.abspath(pth)
+    tmp = pth + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    
+    os.makedirs(tmp)
+    for pid, arr in enumerate(arrays):
+        np.save(_array_file(tmp, pid), arr)
+    
+    f = open(os.path.join(tmp, STATE_FILE), 'wb')
+    f.write(state)
+    f.close()
+    
+    old = None
+    if os.path.exists(pth):
+        old = pth + '.old'
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        os.rename(pth, old)
+    
+    os.rename(tmp, pth)
+    if old is not None:
+        shutil.rmtree(old)
+
+def load_checkpoint(pth, mmap=True):
+    """Load an object from the checkpoint directory ``pth``. If
+    ``mmap`` is set, the arrays are memory-mapped in copy-on-write mode,
+    otherwise they are read into memory."""
+    mmap_mode = 'c' if mmap else None
+    
+    def persistent_load(pid):
+        return np.load(_array_file(pth, int(pid)), mmap_mode=mmap_mode)
+    
+    f = open(os.path.join(pth, STATE_FILE), 'rb')
+    unpickler = pickle.Unpickler(f)
+    unpickler.persistent_load = persistent_load
+    obj = unpickler.load()
+    f.close()
+    return obj
+
+class CheckpointWriter(object):
+    """Write checkpoints in a background thread.
+    
+    :py:meth:`save` takes the snapshot of an object immediately and
+    enqueues it for writing. The checkpoints are written in order.
+    :py:meth:`wait` blocks until all pending checkpoints are written.
+    An error in the writer thread is raised in the next call to
+    :py:meth:`save` or :py:meth:`wait`.
+    
+    """
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._error = None
+    
+    def save(self, obj, pth, min_size=64):
+        """Snapshot ``obj`` and write it to ``pth`` in the background."""
+        self._check_error()
+        state, arrays = snapshot(obj, min_size)
+        if self._queue is None:
+            self._start()
+        self._queue.put((pth, state, arrays))
+    
+    def wait(self):
+        """Block until all pending checkpoints are written."""
+        if self._queue is not None:
+            self._queue.join()
+        self._check_error()
+    
+    def _start(self):
+        """Set up the queue and worker thread."""
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._worker, args=(self._queue, ))
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.wait)
+    
+    def _worker(self, queue):
+        """Worker thread, writes enqueued snapshots."""
+        while True:
+            pth, state, arrays = queue.get()
+            try:
+                write_snapshot(pth, state, arrays)
+            except Exception as e:
+                self._error = e
+            finally:
+                queue.task_done()
+    
+    def _check_error(self):
+        """Raise the exception of the worker thread, if any."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+_WRITER = CheckpointWriter()
+
+def save_checkpoint(obj, pth, background=False, min_size=64):
+    """Store ``obj`` as checkpoint in the directory ``pth``. If
+    ``background`` is set, only the snapshot is taken immediately,
+    while the files are written by a background thread. Use
+    :py:func:`wait_checkpoints` to wait for it. Arrays with less than
+    ``min_size`` items are kept in the pickle.
+    """
+    if background:
+        _WRITER.save(obj, pth, min_size)
+    else:
+        state, arrays = snapshot(obj, min_size)
+        write_snapshot(pth, state, arrays)
+
+def wait_checkpoints():
+    """Block until all checkpoints written in the background by
+    :py:func:`save_checkpoint` are complete."""
+    _WRITER.wait()
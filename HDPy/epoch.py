@@ -0,0 +1,145 @@
+"""
+An epoch holds the sensor readings of one control step. Usually, it's
+a :py:keyword:`dict` with a separate array for each sensor, as it's
+produced by :py:mod:`PuPy`. For the offline processing of recorded
+data, building such a dict for every step is unnecessarily expensive.
+
+The :py:class:`ColumnarEpoch` stores the sensor readings of an epoch
+in a single (samples x sensors) array, together with a mapping from the
+sensor name to its column. The sensor values are returned as views into
+this array, hence constructing an epoch from a larger block of data
+doesn't copy anything. It behaves like a :py:keyword:`dict`, such that
+plants, actor-critics and :py:class:`PuPy.RobotCollector` can work
+with it as usual. Values which are written into the epoch (e.g. the
+intermediate results of the actor-critic) are kept apart from the
+sensor columns.
+
+"""
+import collections
+import numpy as np
+
+def column_index(names):
+    """Return a :py:keyword:`dict` which maps the sensor ``names`` to
+    consecutive columns. Duplicate names are dropped (e.g. 'touch0'
+    in :py:data:`HDPy.puppy.SENSOR_NAMES`).
+    """
+    index = {}
+    for name in names:
+        if name not in index:
+            index[name] = len(index)
+    return index
+
+class ColumnarEpoch(collections.MutableMapping):
+    """Epoch with sensor readings in a single array.
+    
+    ``data``
+        Array of the sensor readings, with one row per sample and one
+        column per sensor.
+    
+    ``columns``
+        Mapping from the sensor names to the columns of ``data`` (see
+        :py:func:`column_index`), or a list of the column names. The
+        mapping may be shared between epochs, it's not altered.
+    
+    ``extras``
+        :py:keyword:`dict` of further (non-sensor) items.
+    
+    Reading a sensor returns a view of its column in ``data``. Writing
+    an item always stores it in ``extras``, such that ``data`` and the
+    views into it remain untouched. If a sensor is overwritten, the new
+    value hides the column.
+    
+    """
+    def __init__(self, data, columns, extras=None):
+        if not isinstance(columns, dict):
+            columns = column_index(columns)
+        
+        self.data = data
+        self.columns = columns
+        self.extras = {} if extras is None else extras
+    
+    @classmethod
+    def from_dict(cls, epoch, names, out=None):
+        """Pack the sensors ``names`` of the :py:keyword:`dict` ``epoch``
+        into a new :py:class:`ColumnarEpoch`. Other items of ``epoch``
+        are taken over as extras. The array may be preallocated in
+        ``out``.
+        """
+        columns = column_index(names)
+        if out is None:
+            num_samples = len(epoch[names[0]])
+            out = np.empty((num_samples, len(columns)))
+        
+        for name, col in columns.iteritems():
+            out[:, col] = epoch[name]
+        
+        extras = dict([(key, value) for key, value in epoch.iteritems() if key not in columns])
+        return cls(out, columns, extras)
+    
+    @classmethod
+    def from_hdf5(cls, group, names, start=0, end=None, out=None):
+        """Read the sensors ``names`` in the sample range [``start``,
+        ``end``) from the HDF5 ``group`` (one dataset per sensor, as
+        written by :py:class:`PuPy.RobotCollector`). The data is read
+        directly into the array ``out``, which is allocated if not
+        given.
+        
+        As the sensors are stored in separate datasets, there's one
+        read per sensor; HDF5 can't read several datasets at once.
+        Hence, the range should be large (e.g. a whole episode) and the
+        epochs of the single steps taken as views of it, instead of
+        reading each epoch separately (see :py:func:`offline_playback`).
+        """
+        columns = column_index(names)
+        if end is None:
+            end = group[names[0]].shape[0]
+        
+        if out is None:
+            out = np.empty((end - start, len(columns)))
+        
+        for name, col in columns.iteritems():
+            group[name].read_direct(out, source_sel=np.s_[start:end], dest_sel=np.s_[:, col])
+        
+        return cls(out, columns)
+    
+    def __getitem__(self, key):
+        if key in self.extras:
+            return self.extras[key]
+        return self.data[:, self.columns[key]]
+    
+    def __setitem__(self, key, value):
+        self.extras[key] = value
+    
+    def __delitem__(self, key):
+        if key in self.extras:
+            del self.extras[key]
+        elif key in self.columns:
+            raise KeyError('Sensor columns cannot be removed (%s)' % key)
+        else:
+            raise KeyError(key)
+    
+    def __contains__(self, key):
+        return key in self.extras or key in self.columns
+    
+    def __iter__(self):
+        for key in self.columns:
+            if key not in self.extras:
+                yield key
+        for key in self.extras:
+            yield key
+    
+    def __len__(self):
+        hidden = len([key for key in self.extras if key in self.columns])
+        return len(self.columns) + len(self.extras) - hidden
+    
+    def has_key(self, key):
+        """Return :py:const:`True` if ``key`` is an item of the epoch."""
+        return key in self
+    
+    def copy(self):
+        """Return a copy of the epoch. The sensor data is shared, the
+        extras are copied shallowly."""
+        return ColumnarEpoch(self.data, self.columns, dict(self.extras))
+    
+    def __repr__(self):
+        return 'ColumnarEpoch(%i samples, %i sensors, extras=%r)' % (self.data.shape[0], len(self.columns), self.extras.keys())
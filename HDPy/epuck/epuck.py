@@ -467,3 +467,76 @@ def simulation_loop(acd, robot, max_step=-1, max_episodes=-1, max_total_iter=-1)
             break
     
     return acd
+
+def population_loop(population, robots, max_step=-1, max_episodes=-1, max_total_iter=-1):
+    """Simulate the ePuck robots of an :py:class:`ADHDPPopulation`.
+    
+    In contrast to :py:func:`simulation_loop`, all agents of the
+    ``population`` are stepped together, each one with its own robot.
+    If a robot collides or the maximum episode length is reached, only
+    its agent starts a new episode, the others continue.
+    
+    ``population``
+        Actor-Critic population (:py:class:`ADHDPPopulation`).
+    
+    ``robots``
+        List of robot instances (:py:class:`Robot`), one per agent.
+    
+    ``max_step``
+        Maximum number of steps in an episode. Negative means no limit.
+    
+    ``max_episodes``
+        Minimum number of episodes per agent, after which the
+        simulation stops. Negative means no limit.
+    
+    ``max_total_iter``
+        Maximum number of (joint) steps in total. Negative means no
+        limit.
+    
+    """
+    if max_step < 0 and max_episodes < 0 and max_total_iter < 0:
+        raise Exception('The simulation cannot run forever.')
+    
+    if len(robots) != population.size:
+        raise Exception('There must be one robot per agent.')
+    
+    population.new_episode()
+    for robot in robots:
+        robot.reset()
+    
+    a_curr = population.a_curr.copy()
+    num_step = np.zeros(population.size, dtype=int)
+    num_episode = np.zeros(population.size, dtype=int)
+    num_total_iter = 0
+    while True:
+        
+        # Apply current action, observe sensors
+        collided = np.array([robot.take_action(action) for robot, action in zip(robots, a_curr)])
+        s_next = [robot.read_sensors() for robot in robots]
+        
+        # Execute ACD
+        a_curr = population(s_next)
+        
+        # Iterate
+        num_step += 1
+        num_total_iter += 1
+        done = collided
+        if max_step > 0:
+            done = done | (num_step >= max_step)
+        
+        if done.any():
+            population.new_episode(done)
+            for idx in np.flatnonzero(done):
+                robots[idx].reset()
+            
+            a_curr[done] = population.a_curr[done]
+            num_step[done] = 0
+            num_episode += done
+        
+        if max_episodes > 0 and num_episode.min() >= max_episodes:
+            break
+        if max_total_iter > 0 and num_total_iter >= max_total_iter:
+            break
+    
+    population.sync()
+    return population
@@ -1,4 +1,5 @@
 from ...rl import Plant
+from ...features import FeatureSpec
 import warnings
 import numpy as np
 
@@ -10,18 +11,13 @@ class CollisionAvoidanceFrontal(Plant):
     ``obs_noise`` is positive.
     
     """
+    FEATURES = [FeatureSpec('ir', index=(0, 1, -1))]
+    
     def __init__(self, theta, obs_noise=0.0):
         super(CollisionAvoidanceFrontal, self).__init__(state_space_dim=3)
         self.theta = float(theta)
         self.obs_sigma = abs(float(obs_noise))
     
-    def state_input(self, state):
-        """Return the state from observations ``state``"""
-        input_ = np.hstack((state['ir'][0, :2], [state['ir'][0, -1]]))
-        input_ = self.normalization.normalize_value('ir', input_)
-        #input_ += np.random.normal(scale=0.001, size=input_.shape) # Additive noise
-        return np.atleast_2d(input_).T
-    
     def reward(self, epoch):
         """Return the reward produced by ``epoch``."""
         ir_front = np.hstack((epoch['ir'][:2], [epoch['ir'][-1]]))
@@ -39,18 +35,13 @@ class CollisionAvoidanceSideways(Plant):
     ``obs_noise`` is positive.
     
     """
+    FEATURES = [FeatureSpec('ir', index=(0, 2, 6))]
+    
     def __init__(self, theta, obs_noise=0.0):
         super(CollisionAvoidanceSideways, self).__init__(state_space_dim=3)
         self.theta = float(theta)
         self.obs_sigma = abs(float(obs_noise))
     
-    def state_input(self, state):
-        """Return the state from observations ``state``"""
-        input_ = np.array((state['ir'][0, 0], state['ir'][0, 2], state['ir'][0, 6]))
-        input_ = self.normalization.normalize_value('ir', input_)
-        #input_ += np.random.normal(scale=0.001, size=input_.shape) # Additive noise
-        return np.atleast_2d(input_).T
-    
     def reward(self, epoch):
         """Return the reward produced by ``epoch``."""
         sensors = np.array((epoch['ir'][0, 0], epoch['ir'][0, 2], epoch['ir'][0, 6]))
@@ -67,17 +58,13 @@ class CollisionAvoidanceFull(Plant):
     ``obs_noise`` is positive.
     
     """
+    FEATURES = [FeatureSpec('ir', index=range(8))]
+    
     def __init__(self, theta, obs_noise=0.0):
         super(CollisionAvoidanceFull, self).__init__(state_space_dim=8)
         self.theta = float(theta)
         self.obs_sigma = abs(float(obs_noise))
     
-    def state_input(self, state):
-        """Return the state from observations ``state``"""
-        input_ = state['ir'].T
-        input_ = self.normalization.normalize_value('ir', input_)
-        return input_
-    
     def reward(self, epoch):
         """Return the reward produced by ``epoch``."""
         ret = float(sum([min(ir - self.theta, 0) for ir in epoch['ir'].T]))
@@ -97,17 +84,14 @@ class Attractor(Plant):
         r = \\frac{s}{\Delta_a} - \\frac{s}{\Delta_r}
     
     """
+    FEATURES = [FeatureSpec('loc', index=(0, 1), norm=False)]
+    
     def __init__(self, attractor, repeller, scale):
         self.attractor = map(float, attractor)
         self.repeller = map(float, repeller)
         self.scale = scale
         super(Attractor, self).__init__(state_space_dim=2)
     
-    def state_input(self, state):
-        """Return the state from observations ``state``"""
-        input_ = np.atleast_2d(state['loc']).T
-        return input_
-    
     def _idist(self, pt0, pt1):
         """Compute the inverse distance between two points ``pt0`` and
         ``pt1``. The points are expected to be coordinate tuples.
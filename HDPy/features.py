@@ -0,0 +1,198 @@
+"""
+Most plants derive their state from a handful of sensors in the same
+way: take the trailing samples of a sensor, reduce them to a single
+value (usually the latest sample or the mean over a short window) and
+normalize the result. Instead of writing out these steps sensor by
+sensor, a plant may describe its state by a list of
+:py:class:`FeatureSpec` instances. A :py:class:`FeatureExtractor`
+compiles such a description once into a few vectorized operations: the
+sensors are grouped by their reduction and the normalization parameters
+are collected into an offset and a scale vector. Extracting the
+features then merely gathers the raw values and normalizes them in a
+single step.
+
+The :py:class:`Plant` base class supports this layer directly through
+:py:attr:`Plant.FEATURES`.
+
+"""
+import numpy as np
+from epoch import ColumnarEpoch
+
+class FeatureSpec(object):
+    """Description of one state feature.
+    
+    ``sensor``
+        Name of the sensor in the epoch.
+    
+    ``window``
+        Number of trailing samples the ``reduction`` operates on.
+    
+    ``reduction``
+        How the samples of the ``window`` are reduced to a value.
+        Either one of 'last', 'mean', 'sum', 'min', 'max' or a
+        function which maps the window onto a value. The 'last'
+        reduction ignores the ``window``.
+    
+    ``norm``
+        Key of the normalization parameters. By default, the
+        ``sensor`` name is used. If False, the feature is not
+        normalized.
+    
+    ``index``
+        For multi-dimensional sensors (samples in rows, channels in
+        columns), a sequence of the columns to be used. Each column
+        becomes a feature on its own, normalized with the same
+        parameters. If None, the sensor is expected to be
+        one-dimensional.
+    
+    The normalization is applied after the reduction. For the linear
+    reductions 'last', 'mean' and 'sum' the order does not matter.
+    
+    """
+    REDUCTIONS = ('last', 'mean', 'sum', 'min', 'max')
+    
+    def __init__(self, sensor, window=1, reduction='last', norm=None, index=None):
+        if not callable(reduction) and reduction not in self.REDUCTIONS:
+            raise Exception('Unknown reduction %r' % (reduction, ))
+        if window < 1:
+            raise Exception('The window must contain at least one sample')
+        
+        self.sensor = sensor
+        self.window = int(window)
+        self.reduction = reduction
+        self.norm = sensor if norm is None else norm
+        self.index = None if index is None else list(index)
+    
+    def __len__(self):
+        """Return the number of features described by the spec."""
+        if self.index is None:
+            return 1
+        return len(self.index)
+    
+    def __repr__(self):
+        return 'FeatureSpec(%r, window=%i, reduction=%r, norm=%r, index=%r)' % (self.sensor, self.window, self.reduction, self.norm, self.index)
+
+class FeatureExtractor(object):
+    """Compute the features described by ``specs``, a list of
+    :py:class:`FeatureSpec` instances, from an epoch.
+    
+    The extractor is compiled against the :py:class:`PuPy.Normalization`
+    instance ``normalization``. If the normalization changes, the
+    extractor has to be recompiled through :py:meth:`compile`. If
+    ``normalization`` is None, the features are not normalized.
+    
+    Calling the extractor on an epoch returns the features as Nx1
+    vector, in the order of ``specs``.
+    
+    """
+    def __init__(self, specs, normalization=None):
+        self.specs = list(specs)
+        self.size = sum([len(spec) for spec in self.specs])
+        self.offset = None
+        self.scale = None
+        self._groups = None
+        self.compile(normalization)
+    
+    def compile(self, normalization=None):
+        """Collect the normalization parameters of all features from
+        ``normalization`` and group the specs by their reduction.
+        """
+        offset, scale = [], []
+        for spec in self.specs:
+            if spec.norm is False or normalization is None:
+                off, scl = 0.0, 1.0
+            else:
+                off, scl = normalization.get(spec.norm)
+            
+            offset += [off] * len(spec)
+            scale += [scl] * len(spec)
+        
+        self.offset = np.array(offset, dtype=float)
+        self.scale = np.array(scale, dtype=float)
+        
+        # Group the scalar sensors by (reduction, window), such that each
+        # group can be gathered and reduced at once. Specs with an index
+        # or a custom reduction are handled one by one.
+        groups, singles = {}, []
+        pos = 0
+        for spec in self.specs:
+            idx = range(pos, pos + len(spec))
+            pos += len(spec)
+            if spec.index is None and not callable(spec.reduction):
+                window = 1 if spec.reduction == 'last' else spec.window
+                keys, locs = groups.setdefault((spec.reduction, window), ([], []))
+                keys.append(spec.sensor)
+                locs += idx
+            else:
+                singles.append((spec, idx))
+        
+        self._groups = [(red, window, keys, np.array(locs)) for (red, window), (keys, locs) in groups.iteritems()]
+        self._singles = singles
+        self._sensors = frozenset([spec.sensor for spec in self.specs])
+        self._columnar = all([spec.index is None for spec in self.specs])
+        self._column_cache = None
+    
+    def raw(self, epoch):
+        """Return the reduced but unnormalized features of ``epoch`` as
+        flat array.
+        """
+        if self._columnar and isinstance(epoch, ColumnarEpoch) and self._sensors.isdisjoint(epoch.extras):
+            return self._raw_columnar(epoch)
+        
+        out = np.empty(self.size)
+        for red, window, keys, locs in self._groups:
+            if red == 'last':
+                out[locs] = [epoch[key][-1] for key in keys]
+            else:
+                samples = np.array([epoch[key][-window:] for key in keys])
+                out[locs] = getattr(samples, red)(axis=1)
+        
+        for spec, idx in self._singles:
+            samples = np.asarray(epoch[spec.sensor])
+            if spec.index is not None:
+                samples = samples[:, spec.index]
+            
+            if spec.reduction == 'last':
+                out[idx] = samples[-1]
+            elif callable(spec.reduction):
+                out[idx] = spec.reduction(samples[-spec.window:])
+            else:
+                out[idx] = getattr(samples[-spec.window:], spec.reduction)(axis=0)
+        
+        return out
+    
+    def _raw_columnar(self, epoch):
+        """Return the raw features of a :py:class:`ColumnarEpoch`. The
+        sensors of a group are gathered from the data array at once.
+        Only scalar sensors are supported (no ``index``).
+        """
+        cache = self._column_cache
+        if cache is None or cache[0] is not epoch.columns:
+            columns = epoch.columns
+            cols = [np.array([columns[key] for key in keys]) for _, _, keys, _ in self._groups]
+            single_cols = [columns[spec.sensor] for spec, _ in self._singles]
+            cache = self._column_cache = (columns, cols, single_cols)
+        
+        _, cols, single_cols = cache
+        data = epoch.data
+        out = np.empty(self.size)
+        for (red, window, _, locs), col in zip(self._groups, cols):
+            if red == 'last':
+                out[locs] = data[-1, col]
+            else:
+                out[locs] = getattr(data[-window:, col], red)(axis=0)
+        
+        for (spec, idx), col in zip(self._singles, single_cols):
+            out[idx] = spec.reduction(data[-spec.window:, col])
+        
+        return out
+    
+    def __call__(self, epoch):
+        """Return the normalized features of ``epoch`` as Nx1 vector."""
+        out = self.raw(epoch)
+        out -= self.offset
+        out /= self.scale
+        return out[:, np.newaxis]
+    
+    def __len__(self):
+        return self.size
@@ -13,17 +13,179 @@ for example the case in :py:class:`ADHDP`). If so, the two methods
 next action) should be called as other structures may rely on those.
 
 Some variations of the baseline algorithm are implemented as well in
-:py:class:`ActionGradient`, :py:class:`ActionRecomputation` and
-:py:class:`ActionBruteForce`. They fulfill the same purpose but approach
+:py:class:`ActionGradient`, :py:class:`ActionNewton`,
+:py:class:`ActionRecomputation`, :py:class:`ActionBruteForce` and
+:py:class:`ActionRefinement`. They fulfill the same purpose but approach
 it differently (specifically, the actor is implemented differently). The
 details are given in details of the respective class.
 
+With a :py:class:`ReplayBuffer`, all of them reuse past transitions to
+take additional critic updates between control steps.
+
 """
 import numpy as np
 import PuPy
 from rl import ActorCritic
+from rc import PlainRLS
 import warnings
+import threading
+import Queue
+import copy
+import atexit
+import weakref
+
+# Critics with a running training thread, see ADHDP.set_async_training
+_TRAINING_CRITICS = weakref.WeakSet()
+
+def _stop_training_threads():
+    """Complete the pending training of all critics at exit."""
+    for critic in list(_TRAINING_CRITICS):
+        critic._stop_training_thread()
+
+atexit.register(_stop_training_threads)
+
+def _training_worker(critic_ref, queue):
+    """Worker thread of the asynchronous training. The critic is only
+    referenced weakly, such that it can be collected while the thread
+    runs. The thread ends if the critic was collected."""
+    while True:
+        item = queue.get()
+        critic = critic_ref()
+        try:
+            if item is None or critic is None:
+                return
+            critic._critic_fit(critic._training_readout, *item)
+            critic._beta_snapshot = critic._training_readout.beta.copy()
+        except Exception as e:
+            critic._training_error = e
+        finally:
+            critic = None
+            queue.task_done()
 
+def _wake_training_worker(queue):
+    """Return a callback which wakes the worker waiting on ``queue``."""
+    def callback(critic_ref):
+        try:
+            queue.put_nowait(None)
+        except Queue.Full:
+            # The worker notices the collected critic with the next item
+            pass
+    return callback
+
+class ReplayBuffer(object):
+    """Fixed-capacity ring buffer of critic transitions, for experience
+    replay.
+    
+    The reservoir state depends on the whole input history, hence a
+    transition cannot be replayed from the (state, action) pair alone.
+    Instead, the critic inputs of both steps are stored (i.e. the
+    reservoir states, with the state input and normalized action
+    appended, as returned by :py:meth:`ADHDP._critic_eval`), together
+    with the reward and discount rate. All of them are kept in
+    preallocated, contiguous arrays which are allocated when the first
+    transition is added. If the buffer is full, the oldest transition
+    is overwritten.
+    
+    ``capacity``
+        Maximum number of stored transitions.
+    
+    ``prioritized``
+        If :py:const:`True`, transitions are sampled with probability
+        proportional to :math:`(|err| + \epsilon)^\alpha`, with *err*
+        the most recent TD error of the transition. Otherwise, the
+        sampling is uniform. Default is :py:const:`False`.
+    
+    ``priority_exponent``
+        The exponent :math:`\alpha` of the prioritized sampling.
+    
+    ``priority_offset``
+        The offset :math:`\epsilon` of the prioritized sampling, such
+        that no transition has zero probability.
+    
+    ``rnd``
+        A :py:class:`numpy.random.RandomState` for sampling. If
+        :py:const:`None`, the module-level generator is used.
+    
+    """
+    def __init__(self, capacity, prioritized=False, priority_exponent=0.6, priority_offset=1e-6, rnd=None):
+        self.capacity = int(capacity)
+        self.prioritized = prioritized
+        self.priority_exponent = priority_exponent
+        self.priority_offset = priority_offset
+        self.rnd = rnd is None and np.random or rnd
+        self.x_curr = None
+        self.x_next = None
+        self.reward = None
+        self.gamma = None
+        self.priority = None
+        self._size = 0
+        self._pos = 0
+    
+    def _allocate(self, dim):
+        """Allocate the buffers for critic inputs of dimension ``dim``."""
+        self.x_curr = np.zeros((self.capacity, dim))
+        self.x_next = np.zeros((self.capacity, dim))
+        self.reward = np.zeros((self.capacity, 1))
+        self.gamma = np.zeros((self.capacity, 1))
+        self.priority = np.zeros(self.capacity)
+    
+    def __len__(self):
+        return self._size
+    
+    def clear(self):
+        """Remove all transitions. The buffers are kept."""
+        self._size = 0
+        self._pos = 0
+    
+    def add(self, x_curr, reward, gamma, x_next, err=None):
+        """Store a transition from critic input ``x_curr`` to
+        ``x_next`` with ``reward`` and discount rate ``gamma``. The
+        critic inputs are copied. The priority is initialized from the
+        TD error ``err`` or, if not given, to the maximum priority in
+        the buffer.
+        """
+        if self.x_curr is None:
+            self._allocate(np.size(x_curr))
+        
+        pos = self._pos
+        self.x_curr[pos] = np.ravel(x_curr)
+        self.x_next[pos] = np.ravel(x_next)
+        self.reward[pos] = reward
+        self.gamma[pos] = gamma
+        if err is not None:
+            self.priority[pos] = self._priority(err)
+        elif self._size > 0:
+            self.priority[pos] = self.priority[:self._size].max()
+        else:
+            self.priority[pos] = 1.0
+        
+        self._pos = (pos + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+    
+    def _priority(self, err):
+        """Return the priority of TD errors ``err``."""
+        return (np.abs(np.ravel(err)) + self.priority_offset) ** self.priority_exponent
+    
+    def sample(self, num):
+        """Return the indices of ``num`` transitions, drawn with
+        replacement. The buffer must not be empty."""
+        if not self.prioritized:
+            return self.rnd.randint(0, self._size, size=num)
+        
+        cdf = np.cumsum(self.priority[:self._size])
+        idx = np.searchsorted(cdf, self.rnd.uniform(0.0, cdf[-1], size=num), side='right')
+        return np.minimum(idx, self._size - 1)
+    
+    def batch(self, idx):
+        """Return the critic inputs, rewards and discount rates of the
+        transitions ``idx`` as (x_curr, reward, gamma, x_next), with
+        one row per transition."""
+        return self.x_curr[idx], self.reward[idx], self.gamma[idx], self.x_next[idx]
+    
+    def update_priorities(self, idx, err):
+        """Set the priorities of transitions ``idx`` from their latest
+        TD errors ``err``."""
+        self.priority[idx] = self._priority(err)
 
 class ADHDP(ActorCritic):
     """Action dependent Heuristic Dynamic Programming structure and
@@ -49,11 +211,45 @@ class ADHDP(ActorCritic):
         of ``reservoir`` and ``readout``  must match and the
         output of the latter must be single dimensional.
     
+    ``async_training``
+        Train the critic asynchronously, in a background thread. See
+        :py:meth:`set_async_training`. Default is :py:const:`False`.
+    
+    ``replay``
+        A :py:class:`ReplayBuffer` for experience replay. If given,
+        each transition is stored in the buffer and after the online
+        update, the critic is trained on ``replay_steps`` mini-batches
+        of ``replay_batch`` transitions each. The TD targets of a
+        mini-batch are computed with the current critic, then the
+        readout is trained on them. Note that the readout counts
+        replayed samples like new ones, i.e. they are subject to its
+        forgetting factor and :py:class:`StabilizedRLS` resets its
+        diagonal more often (consider increasing its *tau*).
+        Default is :py:const:`None` (no replay).
+    
     """
+    # Defaults, such that instances stored by earlier versions load
+    replay = None
+    replay_batch = 32
+    replay_steps = 1
+    async_training = False
+    async_queue_size = 100
+    _training_queue = None
+    _training_thread = None
+    _training_readout = None
+    _training_error = None
+    _beta_snapshot = None
+    _transient = ActorCritic._transient + ('_training_queue', '_training_thread', '_training_readout', '_training_error', '_beta_snapshot')
+    
     def __init__(self, reservoir, readout, *args, **kwargs):
         self.reservoir = reservoir
         self.readout = readout
+        self.replay = kwargs.pop('replay', None)
+        self.replay_batch = kwargs.pop('replay_batch', 32)
+        self.replay_steps = kwargs.pop('replay_steps', 1)
+        async_training = kwargs.pop('async_training', False)
         super(ADHDP, self).__init__(*args, **kwargs)
+        self.set_async_training(async_training)
         
         # Check assumptions
         assert self.reservoir.reset_states == False
@@ -65,48 +261,301 @@ class ADHDP(ActorCritic):
         also be used to initialize the *ActorCritic*, for example when
         it is loaded from a file.
         """
+        self.wait_training()
+        self._train_backlog()
         self.reservoir.reset()
         self.plant.reset()
         super(ADHDP, self).new_episode()
     
+    def __call__(self, epoch, time_start_ms, time_end_ms, step_size_ms):
+        """One round in the actor-critic cycle, see
+        :py:meth:`ActorCritic.__call__`. With asynchronous training,
+        the latest readout weights of the worker are taken over first,
+        such that the whole step uses the same snapshot.
+        """
+        snapshot = self._beta_snapshot
+        if snapshot is not None:
+            self.readout.beta = snapshot
+        
+        return super(ADHDP, self).__call__(epoch, time_start_ms, time_end_ms, step_size_ms)
+    
+    def save(self, pth):
+        """Store the current instance in a file at ``pth``. Pending
+        asynchronous training is completed before."""
+        self.wait_training()
+        super(ADHDP, self).save(pth)
+    
+    def save_checkpoint(self, pth, background=True):
+        """Store the current instance as checkpoint in the directory
+        ``pth``, see :py:meth:`ActorCritic.save_checkpoint`. Pending
+        asynchronous training is completed before."""
+        self.wait_training()
+        super(ADHDP, self).save_checkpoint(pth, background)
+    
+    def restore_checkpoint(self, pth):
+        """Reset the instance to the checkpoint in the directory ``pth``,
+        see :py:meth:`ActorCritic.restore_checkpoint`. Pending
+        asynchronous training is completed and the worker is stopped
+        before."""
+        self.wait_training()
+        self._stop_training_thread()
+        super(ADHDP, self).restore_checkpoint(pth)
+    
+    def set_async_training(self, async_training=True, queue_size=100):
+        """Enable or disable asynchronous critic training.
+        
+        If enabled, the RLS training (and experience replay) is moved
+        off the critical path, into a background thread. The training
+        samples are passed to the thread through a queue of at most
+        ``queue_size`` entries; if it's full, the control loop blocks
+        until there's space. The thread trains a copy of the readout
+        and publishes its weights after each sample. The control loop
+        takes over the latest weights at the start of each step, hence
+        the critic evaluations of a step are consistent but may lag
+        behind the training by a few samples.
+        
+        Pending training is completed when a new episode starts, the
+        instance is saved, or :py:meth:`wait_training` is called.
+        
+        """
+        self.wait_training()
+        self._stop_training_thread()
+        self.async_training = async_training
+        self.async_queue_size = queue_size
+    
+    def wait_training(self):
+        """Block until the asynchronous training is complete, then
+        update the readout with the trained state."""
+        if self._training_queue is None:
+            return
+        
+        self._training_queue.join()
+        self._check_training_error()
+        self.readout.__dict__.update(copy.deepcopy(self._training_readout.__dict__))
+        self._beta_snapshot = None
+    
+    def _start_training_thread(self):
+        """Set up the queue and worker thread for asynchronous training."""
+        self._training_readout = copy.deepcopy(self.readout)
+        self._training_queue = Queue.Queue(maxsize=self.async_queue_size)
+        critic_ref = weakref.ref(self, _wake_training_worker(self._training_queue))
+        self._training_thread = threading.Thread(target=_training_worker, args=(critic_ref, self._training_queue))
+        self._training_thread.daemon = True
+        self._training_thread.start()
+        _TRAINING_CRITICS.add(self)
+    
+    def _stop_training_thread(self):
+        """Terminate the worker thread of the asynchronous training."""
+        if self._training_queue is None:
+            return
+        
+        self._training_queue.put(None)
+        self._training_thread.join()
+        self._training_queue = None
+        self._training_thread = None
+        self._training_readout = None
+        _TRAINING_CRITICS.discard(self)
+    
+    def _check_training_error(self):
+        """Raise the exception of the worker thread, if any."""
+        if self._training_error is not None:
+            error, self._training_error = self._training_error, None
+            raise error
+    
+    def set_normalization(self, norm):
+        """Set the normalization instance to ``norm``. The normalization
+        is propagated to the plant and policy."""
+        super(ADHDP, self).set_normalization(norm)
+        self._invalidate_deriv_operator()
+    
+    def _critic_buffers(self, simulate):
+        """Return the preallocated reservoir input, critic input and
+        return buffers. There's one set for the actual (``simulate``
+        is :py:const:`False`) and one for the simulated evaluation,
+        such that the results of both can be used at the same time.
+        """
+        buffers = self.__dict__.setdefault('_critic_buf', {})
+        if simulate not in buffers:
+            input_dim = self.reservoir.get_input_dim()
+            output_dim = self.reservoir.get_output_dim()
+            r_input = np.zeros((1, input_dim))
+            o_state = np.zeros((1, output_dim + input_dim))
+            j_curr = np.zeros((1, 1))
+            buffers[simulate] = (r_input, o_state, j_curr)
+        return buffers[simulate]
+    
     def _critic_eval(self, state, action, simulate, action_name='a_curr'):
-        """Evaluate the critic at ``state`` and ``action``."""
-        in_state = self.plant.state_input(state)
-        action_nrm = self.normalizer.normalize_value(action_name, action)
-        r_input = np.vstack((in_state, action_nrm)).T
+        """Evaluate the critic at ``state`` and ``action``.
+        
+        The returned arrays are buffers which are overwritten by the
+        next evaluation with the same ``simulate`` flag. Copy them if
+        they have to be kept.
+        
+        """
+        time_start = self.timer.tic()
+        in_state = self._state_input(state)
+        self.timer.toc('state_input', time_start)
+        return self._critic_eval_input(in_state, action, simulate, action_name)
+    
+    def _critic_eval_input(self, in_state, action, simulate, action_name='a_curr'):
+        """Evaluate the critic at the state-part of the reservoir input
+        ``in_state`` and ``action``. The critic inputs are assembled in
+        the buffers of :py:meth:`_critic_buffers`.
+        """
+        time_start = self.timer.tic()
+        r_input, o_state, j_curr = self._critic_buffers(simulate)
+        state_dim = in_state.shape[0]
+        res_dim = o_state.shape[1] - r_input.shape[1]
+        r_input[0, :state_dim] = in_state[:, 0]
+        r_input[0, state_dim:] = self._normalize_action(action_name, action)[:, 0]
         #r_input += np.random.normal(scale=0.001, size=r_input.shape)
-        r_state = self.reservoir(r_input, simulate=simulate)
+        self.reservoir.step(r_input, simulate=simulate, out=o_state[:, :res_dim])
         #o_state = r_state # TODO: Direct ESN Model
-        o_state = np.hstack((r_state, r_input)) # TODO: Input/Output ESN Model
-        j_curr = self.readout(o_state)
+        o_state[0, res_dim:] = r_input[0] # TODO: Input/Output ESN Model
+        if isinstance(self.readout, PlainRLS):
+            self.readout(o_state, out=j_curr)
+        else:
+            j_curr[...] = self.readout(o_state)
+        self.timer.toc('critic', time_start)
         return r_input, o_state, j_curr
     
+    def _critic_eval_batch(self, state, actions, action_name='a_next'):
+        """Evaluate the critic at ``state`` for several ``actions`` at
+        once. The actions are given as a CxA matrix, with one action
+        per row. The reservoir state is not altered.
+        
+        Returns the reservoir inputs, critic inputs and the predicted
+        returns, each with one row per action.
+        
+        """
+        in_state = self._state_input(state)
+        state_dim = in_state.shape[0]
+        actions_nrm = self.normalizer.normalize_value(action_name, actions.T) # AxC
+        r_input = np.empty((actions.shape[0], state_dim + actions.shape[1]))
+        r_input[:, :state_dim] = in_state.T
+        r_input[:, state_dim:] = actions_nrm.T
+        r_state = self.reservoir.execute_batch(r_input)
+        o_state = np.hstack((r_state, r_input)) # TODO: Input/Output ESN Model
+        j_cand = self.readout(o_state)
+        return r_input, o_state, j_cand
+    
+    def _critic_deriv_operator(self):
+        """Return the action columns of the reservoir input matrix as
+        dense NxA array and the action normalization scale.
+        
+        Both are cached. The cache is invalidated if the reservoir
+        input matrix is replaced (e.g. the reservoir is initialized
+        anew) or the normalization is set through
+        :py:meth:`set_normalization`. If either is altered in place,
+        :py:meth:`_invalidate_deriv_operator` must be called.
+        
+        """
+        cache = self.__dict__.get('_deriv_cache', None)
+        w_in = self.reservoir.w_in
+        if cache is None or cache[0] is not w_in:
+            w_action = w_in[:, -self._motor_action_dim:].toarray() # NxA
+            scale = self.normalizer.get('a_curr')[1]
+            cache = self._deriv_cache = (w_in, w_action, scale)
+        return cache[1], cache[2]
+    
+    def _invalidate_deriv_operator(self):
+        """Discard the cached derivative operator."""
+        self._deriv_cache = None
+    
     def _critic_deriv_io_model(self, r_state):
         """Return the critic's derivative at ``r_state``."""
-        direct_input_size = self.plant.state_space_dim()+self.child.action_space_dim() # Input/Output ESN Model
-        r_state = r_state[:, :-direct_input_size] # this is because _critic_eval appends the input to the state
-        dtanh = (np.ones(r_state.shape) - r_state**2).T # Nx1
-        dstate = dtanh * self.reservoir.w_in[:, -self._motor_action_dim:].toarray() # Nx1 .* NxA => NxA
-        deriv = self.readout.beta[1:-direct_input_size].T.dot(dstate) # Input/Output ESN Model
-        deriv += self.readout.beta[-self._motor_action_dim:].T # Input/Output ESN Model
-        deriv = deriv.T # AxL
-        scale = self.normalizer.get('a_curr')[1]
+        w_action, scale = self._critic_deriv_operator()
+        res_dim = w_action.shape[0]
+        beta = self.readout.beta
+        r_state = r_state[0, :res_dim] # this is because _critic_eval appends the input to the state
+        # beta_r^T (dtanh .* W_a) == W_a^T (dtanh .* beta_r), without the NxA temporary
+        dtanh = 1.0 - r_state**2 # N
+        deriv = w_action.T.dot(beta[1:res_dim+1] * dtanh[:, np.newaxis]) # AxL # Input/Output ESN Model
+        deriv += beta[-self._motor_action_dim:] # Input/Output ESN Model
         deriv *= scale # Derivative denormalization
         return deriv
     
     def _critic_deriv_direct_model(self, r_state):
         """Return the critic's derivative at ``r_state``."""
-        dtanh = (np.ones(r_state.shape) - r_state**2).T # Nx1
-        dstate = dtanh * self.reservoir.w_in[:, -self._motor_action_dim:].toarray() # Nx1 .* NxA => NxA
-        deriv = self.readout.beta[1:].T.dot(dstate) #  LxA # Direct ESN Model
-        deriv = deriv.T # AxL
-        scale = self.normalizer.get('a_curr')[1]
+        w_action, scale = self._critic_deriv_operator()
+        dtanh = 1.0 - r_state[0]**2 # N
+        deriv = w_action.T.dot(self.readout.beta[1:] * dtanh[:, np.newaxis]) # AxL # Direct ESN Model
         deriv *= scale # Derivative denormalization
         return deriv
     
     def _critic_deriv(self, r_state):
         """Return the critic's derivative at ``r_state``."""
-        return self._critic_deriv_io_model(r_state)
+        time_start = self.timer.tic()
+        deriv = self._critic_deriv_io_model(r_state)
+        self.timer.toc('deriv', time_start)
+        return deriv
+    
+    def _critic_train(self, x_curr, x_next, reward, err):
+        """Train the critic on the transition from critic input
+        ``x_curr`` to ``x_next`` with TD error ``err``. If a
+        :py:class:`ReplayBuffer` is set, the transition is stored and
+        the critic is additionally trained on replayed mini-batches.
+        
+        With asynchronous training, the sample is passed to the worker
+        thread (see :py:meth:`set_async_training`). Otherwise, if the
+        time budget of the step is exhausted, the training is
+        deferred: The sample and its TD target are stored in the
+        backlog (see :py:meth:`ActorCritic.set_time_budget`). Else,
+        the backlog is processed after the training, as long as time
+        remains.
+        
+        """
+        time_start = self.timer.tic()
+        gamma = self.gamma(self.num_episode, self.num_step)
+        if self.async_training:
+            # The worker evaluates the error with its current weights
+            if self._training_queue is None:
+                self._start_training_thread()
+            self._check_training_error()
+            trg = err + self.readout(x_curr)
+            self._training_queue.put((x_curr.copy(), x_next.copy(), reward, gamma, err.copy(), trg))
+        
+        elif self._backlog is not None and self._time_left() <= 0.0:
+            trg = err + self.readout(x_curr)
+            self._backlog.append((x_curr.copy(), trg))
+        
+        else:
+            self._critic_fit(self.readout, x_curr, x_next, reward, gamma, err)
+            if self._backlog:
+                self._train_backlog(until_deadline=True)
+        
+        self.timer.toc('train', time_start)
+    
+    def _critic_fit(self, readout, x_curr, x_next, reward, gamma, err, trg=None):
+        """Train ``readout`` on the critic input ``x_curr`` with TD
+        error ``err`` or, if given, TD target ``trg``. Then, apply
+        experience replay (if set).
+        """
+        if trg is None:
+            readout.train(x_curr, err=err)
+        else:
+            readout.train(x_curr, trg=trg)
+        
+        if self.replay is not None:
+            self.replay.add(x_curr, reward, gamma, x_next, err)
+            for _ in xrange(self.replay_steps):
+                idx = self.replay.sample(self.replay_batch)
+                b_curr, b_reward, b_gamma, b_next = self.replay.batch(idx)
+                # TD targets are fixed within the mini-batch; the readout
+                # computes the a-priori error of each sample itself
+                b_trg = b_reward + b_gamma * readout(b_next)
+                b_err = b_trg - readout(b_curr)
+                readout.train(b_curr, trg=b_trg)
+                self.replay.update_priorities(idx, b_err)
+    
+    def _train_backlog(self, until_deadline=False):
+        """Train the critic on the deferred samples. If
+        ``until_deadline`` is set, the training stops when the time
+        budget of the step is exhausted."""
+        backlog = self._backlog
+        while backlog and not (until_deadline and self._time_left() <= 0.0):
+            x_curr, trg = backlog.popleft()
+            self.readout.train(x_curr, trg=trg)
     
     def _step(self, s_curr, epoch, a_curr, reward):
         """Execute one step of the actor and return the next action.
@@ -143,9 +592,11 @@ class ADHDP(ActorCritic):
         deriv = self._critic_deriv(x_curr)
         
         # gradient training of action (acc. to eq. 10)
+        time_start = self.timer.tic()
         a_next = a_curr + self.alpha(self.num_episode, self.num_step) * deriv
         a_next = self.momentum(a_curr, a_next, self.num_episode, self.num_step)
         a_next = self._next_action_hook(a_next)
+        self.timer.toc('action', time_start)
         
         # ESN-critic, second instance: in(k+1) => J(k+1)
         i_next, x_next, j_next = self._critic_eval(epoch, a_next, simulate=True, action_name='a_next')
@@ -154,22 +605,25 @@ class ADHDP(ActorCritic):
         err = reward + self.gamma(self.num_episode, self.num_step) * j_next - j_curr
         
         # One-step RLS training => Trained ESN
-        self.readout.train(x_curr, err=err)
+        self._critic_train(x_curr, x_next, reward, err)
         
         # update epoch with locals:
-        epoch['reward'] = np.atleast_2d([reward]).T
-        epoch['deriv'] = deriv.T
-        epoch['err'] = err.T
-        epoch['readout'] = self.readout.beta.T
-        epoch['gamma'] = np.atleast_2d([self.gamma(self.num_episode, self.num_step)]).T
-        epoch['i_curr'] = i_curr
-        epoch['x_curr'] = x_curr
-        epoch['j_curr'] = j_curr
-        epoch['a_curr'] = a_curr.T
-        epoch['i_next'] = i_next
-        epoch['x_next'] = x_next
-        epoch['j_next'] = j_next
-        epoch['a_next'] = a_next.T
+        self._record(epoch,
+            reward=np.atleast_2d([reward]).T,
+            deriv=deriv.T,
+            err=err.T,
+            readout=self.readout.beta.T,
+            gamma=np.atleast_2d([self.gamma(self.num_episode, self.num_step)]).T,
+            i_curr=i_curr,
+            x_curr=x_curr,
+            j_curr=j_curr,
+            a_curr=a_curr.T,
+            i_next=i_next,
+            x_next=x_next,
+            j_next=j_next,
+            a_next=a_next.T)
+        
+        self._pre_increment_hook(epoch, reward=reward, err=err, x_curr=x_curr, x_next=x_next, j_curr=j_curr, j_next=j_next)
         
         # increment
         return epoch
@@ -188,10 +642,11 @@ class ADHDP(ActorCritic):
         """
         if self.num_step > 1:
             i_curr, x_curr, j_curr = self._critic_eval(self.s_curr, self.a_curr, False, 'a_curr')
-            epoch['x_curr'] = x_curr
-            epoch['i_curr'] = i_curr
-            epoch['a_next'] = self.a_curr.T
-            epoch['a_curr'] = self.a_curr.T
+            self._record(epoch,
+                x_curr=x_curr,
+                i_curr=i_curr,
+                a_next=self.a_curr.T,
+                a_curr=self.a_curr.T)
                     
         self.s_curr = epoch
         return self.child(epoch, time_start_ms, time_end_ms, step_size_ms)
@@ -214,8 +669,8 @@ class ReservoirActorADHDP(ADHDP):
     def _step(self, s_curr, epoch, a_curr, reward):
         """Execute one step of the actor and return the next action."""
         # ESN-critic, first instance: in(k) => J(k)
-        in_state = self.plant.state_input(s_curr)
-        action_nrm = self.normalizer.normalize_value('a_curr', a_curr)
+        in_state = self._state_input(s_curr)
+        action_nrm = self._normalize_action('a_curr', a_curr)
         i_curr = np.vstack((in_state, action_nrm)).T
         r_prev = self.reservoir.states
         r_state = self.reservoir(i_curr, simulate=False)
@@ -248,22 +703,25 @@ class ReservoirActorADHDP(ADHDP):
         err = reward + self.gamma(self.num_episode, self.num_step) * j_next - j_curr
         
         # One-step RLS training => Trained ESN
-        self.readout.train(x_curr, err=err) 
+        self._critic_train(x_curr, x_next, reward, err)
         
         # fill epoch with locals:
-        epoch['reward'] = np.atleast_2d([reward]).T
-        epoch['deriv'] = deriv.T
-        epoch['err'] = err.T
-        epoch['readout'] = self.readout.beta.T
-        epoch['gamma'] = np.atleast_2d([self.gamma(self.num_episode, self.num_step)]).T
-        epoch['i_curr'] = i_curr
-        epoch['x_curr'] = x_curr
-        epoch['j_curr'] = j_curr
-        epoch['a_curr'] = a_curr.T
-        epoch['i_next'] = i_next
-        epoch['x_next'] = x_next
-        epoch['j_next'] = j_next
-        epoch['a_next'] = a_next.T
+        self._record(epoch,
+            reward=np.atleast_2d([reward]).T,
+            deriv=deriv.T,
+            err=err.T,
+            readout=self.readout.beta.T,
+            gamma=np.atleast_2d([self.gamma(self.num_episode, self.num_step)]).T,
+            i_curr=i_curr,
+            x_curr=x_curr,
+            j_curr=j_curr,
+            a_curr=a_curr.T,
+            i_next=i_next,
+            x_next=x_next,
+            j_next=j_next,
+            a_next=a_next.T)
+        
+        self._pre_increment_hook(epoch, reward=reward, err=err, x_curr=x_curr, x_next=x_next, j_curr=j_curr, j_next=j_next)
         
         # increment
         return epoch
@@ -296,12 +754,14 @@ class ActionGradient(ADHDP):
         i_curr, x_curr, j_curr = self._critic_eval(s_curr, a_curr, simulate=False, action_name='a_curr')
         
         # Gradient ascent of J(a|s_{t+1})
+        time_start = self.timer.tic()
         a_next = self.gradient_descent(epoch, a_curr)
         deriv = (a_next - a_curr) / self.alpha(self.num_episode, self.num_step)
         
         # Next action
         a_next = self.momentum(a_curr, a_next, self.num_episode, self.num_step)
         a_next = self._next_action_hook(a_next)
+        self.timer.toc('action', time_start)
         
         # ESN-critic, second instance: in(k+1) => J(k+1)
         i_next, x_next, j_next = self._critic_eval(epoch, a_next, simulate=True, action_name='a_next')
@@ -310,22 +770,25 @@ class ActionGradient(ADHDP):
         err = reward + self.gamma(self.num_episode, self.num_step) * j_next - j_curr
         
         # One-step RLS training => Trained ESN
-        self.readout.train(x_curr, err=err)
+        self._critic_train(x_curr, x_next, reward, err)
         
         # fill epoch with locals:
-        epoch['reward'] = np.atleast_2d([reward]).T
-        epoch['deriv'] = deriv.T
-        epoch['err'] = err.T
-        epoch['readout'] = self.readout.beta.T
-        epoch['gamma'] = np.atleast_2d([self.gamma(self.num_episode, self.num_step)]).T
-        epoch['i_curr'] = i_curr
-        epoch['x_curr'] = x_curr
-        epoch['j_curr'] = j_curr
-        epoch['a_curr'] = a_curr.T
-        epoch['i_next'] = i_next
-        epoch['x_next'] = x_next
-        epoch['j_next'] = j_next
-        epoch['a_next'] = a_next.T
+        self._record(epoch,
+            reward=np.atleast_2d([reward]).T,
+            deriv=deriv.T,
+            err=err.T,
+            readout=self.readout.beta.T,
+            gamma=np.atleast_2d([self.gamma(self.num_episode, self.num_step)]).T,
+            i_curr=i_curr,
+            x_curr=x_curr,
+            j_curr=j_curr,
+            a_curr=a_curr.T,
+            i_next=i_next,
+            x_next=x_next,
+            j_next=j_next,
+            a_next=a_next.T)
+        
+        self._pre_increment_hook(epoch, reward=reward, err=err, x_curr=x_curr, x_next=x_next, j_curr=j_curr, j_next=j_next)
         
         # increment
         return epoch
@@ -354,7 +817,7 @@ class ActionGradient(ADHDP):
             derivative."""
             # gradient * -derivative(action + alpha * gradient)
             action_query = action + alpha * gradient
-            in_state = self.plant.state_input(state)
+            in_state = self._state_input(state)
             action_nrm = self.normalizer.normalize_value('a_next', action_query)
             i_inter = np.vstack((in_state, action_nrm)).T
             x_inter = self.reservoir(i_inter, simulate=True) # TODO: Check reservoir state!
@@ -430,14 +893,14 @@ class ActionGradient(ADHDP):
         the predicted return given a ``state``. The search starts at
         ``action``.
         """
-        in_state = self.plant.state_input(state)
+        if self._time_left() <= 0.0:
+            return action
+        
+        in_state = self._state_input(state)
         num_iter = self.gd_max_iter
         while True:
             # Compute the gradient
-            action_nrm = self.normalizer.normalize_value('a_next', action)
-            i_inter = np.vstack((in_state, action_nrm)).T
-            x_inter = self.reservoir(i_inter, simulate=True)
-            x_inter = np.hstack((x_inter, i_inter)) # FIXME: Input/Output ESN Model
+            _, x_inter, _ = self._critic_eval_input(in_state, action, True, 'a_next')
             gradient = self._critic_deriv(x_inter)
             
             # Do line search and update the action
@@ -448,13 +911,151 @@ class ActionGradient(ADHDP):
             
             # Exit condition
             num_iter -= 1
-            if np.linalg.norm(gradient) < self.gd_tol or num_iter <= 0:
+            if np.linalg.norm(gradient) < self.gd_tol or num_iter <= 0 or self._time_left() <= 0.0:
                 break
         
         #print num_iter
         
         return action
 
+class ActionNewton(ActionGradient):
+    """Determine the next action by a second-order (Newton) search with
+    a trust region. With a tanh reservoir and a linear readout, the
+    gradient and Hessian of the critic with respect to the action are
+    available in closed form. The Hessian is made negative definite
+    (by flipping and bounding its eigenvalues), such that every step
+    ascends the predicted return. The step length is limited by a trust
+    region radius which is adapted to the agreement between the
+    quadratic model and the critic. Each iteration costs a single
+    critic evaluation and the number of iterations is bounded.
+    
+    The search is warm-started from the optimum of the previous step,
+    if it predicts a higher return than the current action.
+    
+    Additional keyword arguments:
+    
+    ``newton_max_iter``
+        Maximum number of Newton steps. Default is 10.
+    
+    ``newton_tolerance``
+        Stop if the gradient norm or the trust radius falls below this
+        threshold. Default is 1e-8.
+    
+    ``trust_radius``
+        Initial trust region radius, in (unnormalized) action units.
+        Default is 0.5.
+    
+    ``trust_radius_max``
+        Upper limit of the trust region radius. Default is
+        4 * ``trust_radius``.
+    
+    """
+    def __init__(self, *args, **kwargs):
+        self.newton_max_iter = kwargs.pop('newton_max_iter', 10)
+        self.newton_tol = kwargs.pop('newton_tolerance', 1e-8)
+        self.trust_radius = kwargs.pop('trust_radius', 0.5)
+        self.trust_radius_max = kwargs.pop('trust_radius_max', 4.0 * self.trust_radius)
+        self._a_optimum = None
+        super(ActionNewton, self).__init__(*args, **kwargs)
+    
+    def new_episode(self):
+        """Start a new episode of the same experiment. The warm start
+        of the action search is discarded.
+        """
+        super(ActionNewton, self).new_episode()
+        self._a_optimum = None
+    
+    def _critic_newton_model(self, r_fixed, w_action, in_state, action):
+        """Return the predicted return, its gradient (Ax1) and Hessian
+        (AxA) with respect to the (unnormalized) ``action``.
+        
+        ``r_fixed`` is the part of the reservoir pre-activation which
+        does not depend on the action (Nx1), ``w_action`` the action
+        columns of the reservoir input matrix (NxA) and ``in_state``
+        the state-part of the reservoir input (Sx1).
+        
+        """
+        action_dim = action.shape[0]
+        action_nrm = self.normalizer.normalize_value('a_next', action)
+        # Derivative of the (affine) normalization
+        nrm_zero = self.normalizer.normalize_value('a_next', np.zeros(action.shape))
+        dnrm = self.normalizer.normalize_value('a_next', np.ones(action.shape)) - nrm_zero # Ax1
+        
+        r_state = np.tanh(r_fixed + w_action.dot(action_nrm)) # Nx1
+        beta = self.readout.beta
+        beta_r = beta[1:r_state.shape[0]+1] # Nx1
+        o_input = np.vstack((r_state, in_state, action_nrm))
+        j_pred = beta[0, 0] + beta[1:].T.dot(o_input)[0, 0]
+        
+        dtanh = 1.0 - r_state**2 # Nx1
+        grad = w_action.T.dot(beta_r * dtanh) + beta[-action_dim:] # Ax1
+        curv = beta_r * (-2.0 * r_state * dtanh) # Nx1
+        hess = w_action.T.dot(curv * w_action) # AxA
+        
+        # Chain rule of the normalization
+        grad = dnrm * grad
+        hess = dnrm * hess * dnrm.T
+        return j_pred, grad, hess
+    
+    def gradient_descent(self, state, action):
+        """Newton search to find the action which maximizes the
+        predicted return given a ``state``. The search starts at
+        ``action`` or at the previous optimum, whichever is predicted
+        to be better.
+        """
+        if self.reservoir.nonlin_func is not np.tanh:
+            warnings.warn('Newton search requires a tanh reservoir, falling back to gradient ascent')
+            return super(ActionNewton, self).gradient_descent(state, action)
+        
+        # Reservoir pre-activation which does not depend on the action
+        in_state = self._state_input(state)
+        state_dim = in_state.shape[0]
+        r_prev = self.reservoir.states[-1, :]
+        r_fixed = self.reservoir.w * r_prev + self.reservoir.w_in[:, :state_dim] * in_state[:, 0] + self.reservoir.w_bias
+        r_fixed = np.atleast_2d(r_fixed).T # Nx1
+        w_action, _ = self._critic_deriv_operator() # NxA
+        
+        # Warm start
+        j_curr, grad, hess = self._critic_newton_model(r_fixed, w_action, in_state, action)
+        if self._a_optimum is not None:
+            j_warm, grad_w, hess_w = self._critic_newton_model(r_fixed, w_action, in_state, self._a_optimum)
+            if j_warm > j_curr:
+                action, j_curr, grad, hess = self._a_optimum, j_warm, grad_w, hess_w
+        
+        radius = self.trust_radius
+        for _ in range(self.newton_max_iter):
+            if np.linalg.norm(grad) < self.newton_tol or radius < self.newton_tol or self._time_left() <= 0.0:
+                break
+            
+            # Modified Newton step: ascent direction for any Hessian
+            eigval, eigvec = np.linalg.eigh(hess)
+            eigval = np.maximum(np.abs(eigval), self.newton_tol)
+            step = eigvec.dot(eigvec.T.dot(grad) / np.atleast_2d(eigval).T)
+            step_len = np.linalg.norm(step)
+            if step_len > radius:
+                step *= radius / step_len
+                step_len = radius
+            
+            # Evaluate the step
+            a_query = self._next_action_hook(action + step)
+            step = a_query - action # the hook may alter the step
+            j_query, grad_q, hess_q = self._critic_newton_model(r_fixed, w_action, in_state, a_query)
+            predicted = grad.T.dot(step)[0, 0] + 0.5 * step.T.dot(hess).dot(step)[0, 0]
+            ratio = (j_query - j_curr) / predicted if predicted > 0.0 else 0.0
+            
+            # Adapt the trust region
+            if ratio < 0.25:
+                radius *= 0.25
+            elif ratio > 0.75 and step_len >= radius:
+                radius = min(2.0 * radius, self.trust_radius_max)
+            
+            # Accept improving steps
+            if j_query > j_curr:
+                action, j_curr, grad, hess = a_query, j_query, grad_q, hess_q
+        
+        self._a_optimum = action
+        return action
+
 class ActionRecomputation(ADHDP):
     """Determine the next action the same way as the baseline algorithm
     for critic training, then recompute it based on the updated critic
@@ -470,9 +1071,11 @@ class ActionRecomputation(ADHDP):
         deriv = self._critic_deriv(x_curr)
         
         # gradient training of action (acc. to eq. 10)
+        time_start = self.timer.tic()
         a_next = a_curr + self.alpha(self.num_episode, self.num_step) * deriv
         a_next = self.momentum(a_curr, a_next, self.num_episode, self.num_step)
         a_next = self._next_action_hook(a_next)
+        self.timer.toc('action', time_start)
         
         # ESN-critic, second instance: in(k+1) => J(k+1)
         i_next, x_next, j_next = self._critic_eval(epoch, a_next, True, 'a_next')
@@ -481,29 +1084,34 @@ class ActionRecomputation(ADHDP):
         err = reward + self.gamma(self.num_episode, self.num_step) * j_next - j_curr
         
         # One-step RLS training => Trained ESN
-        self.readout.train(x_curr, err=err)
+        self._critic_train(x_curr, x_next, reward, err)
         
         # Action re-computation
         deriv2 = self._critic_deriv(x_next)
+        time_start = self.timer.tic()
         a_next = a_curr + self.alpha(self.num_episode, self.num_step) * deriv2
         a_next = self.momentum(a_curr, a_next, self.num_episode, self.num_step)
         a_next = self._next_action_hook(a_next)
+        self.timer.toc('action', time_start)
         
         # fill epoch with locals:
-        epoch['reward'] = np.atleast_2d([reward]).T
-        epoch['deriv2'] = deriv2.T
-        epoch['deriv'] = deriv.T
-        epoch['err'] = err.T
-        epoch['readout'] = self.readout.beta.T
-        epoch['gamma'] = np.atleast_2d([self.gamma(self.num_episode, self.num_step)]).T
-        epoch['i_curr'] = i_curr
-        epoch['x_curr'] = x_curr
-        epoch['j_curr'] = j_curr
-        epoch['a_curr'] = a_curr.T
-        epoch['i_next'] = i_next
-        epoch['x_next'] = x_next
-        epoch['j_next'] = j_next
-        epoch['a_next'] = a_next.T
+        self._record(epoch,
+            reward=np.atleast_2d([reward]).T,
+            deriv2=deriv2.T,
+            deriv=deriv.T,
+            err=err.T,
+            readout=self.readout.beta.T,
+            gamma=np.atleast_2d([self.gamma(self.num_episode, self.num_step)]).T,
+            i_curr=i_curr,
+            x_curr=x_curr,
+            j_curr=j_curr,
+            a_curr=a_curr.T,
+            i_next=i_next,
+            x_next=x_next,
+            j_next=j_next,
+            a_next=a_next.T)
+        
+        self._pre_increment_hook(epoch, reward=reward, err=err, x_curr=x_curr, x_next=x_next, j_curr=j_curr, j_next=j_next)
         
         # increment
         return epoch
@@ -513,8 +1121,13 @@ class ActionBruteForce(ADHDP):
     different sampled locations and picking the action which yields the
     highest one.
     
+    All candidates are evaluated at once (see
+    :py:meth:`ADHDP._critic_eval_batch`), hence dense candidate grids
+    are feasible.
+    
     ``candidates``
-        Action samples. Must be a list of valid actions.
+        Action samples. Must be a list of valid actions or a CxA matrix
+        with one action per row.
     
     .. todo::
         Breaks old code
@@ -522,7 +1135,28 @@ class ActionBruteForce(ADHDP):
     """
     def __init__(self, candidates, *args, **kwargs):
         super(ActionBruteForce, self).__init__(*args, **kwargs)
-        self.candidates = candidates
+        self.candidates = None
+        self.set_candidates(candidates)
+    
+    def set_candidates(self, candidates):
+        """Define the action samples ``candidates``. They are stored
+        as CxA matrix, with one action per row.
+        """
+        candidates = [np.asarray(cand, dtype=float).flatten() for cand in candidates]
+        if len(candidates) > 0:
+            self.candidates = np.vstack(candidates)
+        else:
+            self.candidates = np.zeros((0, self._motor_action_dim))
+        assert self.candidates.shape[1] == self._motor_action_dim
+    
+    def _best_candidate(self, state, candidates):
+        """Return the row of ``candidates`` which yields the highest
+        predicted return in ``state``, as Ax1 column vector, and its
+        predicted return.
+        """
+        _, _, j_cand = self._critic_eval_batch(state, candidates, 'a_next')
+        idx = j_cand[:, 0].argmax()
+        return np.atleast_2d(candidates[idx]).T, j_cand[idx, 0]
     
     def _step(self, s_curr, epoch, a_curr, reward):
         """Execute one step of the actor and return the next action."""
@@ -530,20 +1164,15 @@ class ActionBruteForce(ADHDP):
         i_curr, x_curr, j_curr = self._critic_eval(s_curr, a_curr, False, 'a_curr')
         
         # Next action
-        a_next = a_curr
-        j_best = float('-inf')
-        in_state = self.plant.state_input(epoch)
-        for candidate in self.candidates:
-            candidate_nrm = self.normalizer.normalize_value('a_next', candidate)
-            i_cand = np.vstack((in_state, candidate_nrm)).T
-            x_cand = self.reservoir(i_cand, simulate=True)
-            j_cand = self.readout(x_cand)
-            if j_cand > j_best:
-                j_best = j_cand
-                a_next = np.atleast_2d(candidate)
+        time_start = self.timer.tic()
+        if self.candidates.shape[0] > 0 and self._time_left() > 0.0:
+            a_next, _ = self._best_candidate(epoch, self.candidates)
+        else:
+            a_next = a_curr
         
         a_next = a_curr + self.alpha(self.num_episode, self.num_step) * (a_next - a_curr)
         a_next = self._next_action_hook(a_next)
+        self.timer.toc('action', time_start)
         
         # ESN-critic, second instance: in(k+1) => J(k+1)
         i_next, x_next, j_next = self._critic_eval(epoch, a_next, True, 'a_next')
@@ -552,22 +1181,183 @@ class ActionBruteForce(ADHDP):
         err = reward + self.gamma(self.num_episode, self.num_step) * j_next - j_curr
         
         # One-step RLS training => Trained ESN
-        self.readout.train(x_curr, err=err)
+        self._critic_train(x_curr, x_next, reward, err)
         
         # fill epoch with locals:
-        epoch['reward'] = np.atleast_2d([reward]).T
-        epoch['err'] = err.T
-        epoch['deriv'] = a_next-a_curr
-        epoch['readout'] = self.readout.beta.T
-        epoch['gamma'] = np.atleast_2d([self.gamma(self.num_episode, self.num_step)]).T
-        epoch['i_curr'] = i_curr
-        epoch['x_curr'] = x_curr
-        epoch['j_curr'] = j_curr
-        epoch['a_curr'] = a_curr.T
-        epoch['i_next'] = i_next
-        epoch['x_next'] = x_next
-        epoch['j_next'] = j_next
-        epoch['a_next'] = a_next.T
+        self._record(epoch,
+            reward=np.atleast_2d([reward]).T,
+            err=err.T,
+            deriv=a_next-a_curr,
+            readout=self.readout.beta.T,
+            gamma=np.atleast_2d([self.gamma(self.num_episode, self.num_step)]).T,
+            i_curr=i_curr,
+            x_curr=x_curr,
+            j_curr=j_curr,
+            a_curr=a_curr.T,
+            i_next=i_next,
+            x_next=x_next,
+            j_next=j_next,
+            a_next=a_next.T)
+        
+        self._pre_increment_hook(epoch, reward=reward, err=err, x_curr=x_curr, x_next=x_next, j_curr=j_curr, j_next=j_next)
         
         # increment
         return epoch
+
+class ActionRefinement(ActionBruteForce):
+    """Find the optimal action by a coarse-to-fine search. The search
+    starts with evaluating the ``candidates``, like
+    :py:class:`ActionBruteForce`. Then, new samples are drawn around
+    the best actions found so far, within a radius which shrinks at
+    every refinement level. The search stops as soon as the number of
+    critic evaluations exceeds a budget. Like in
+    :py:class:`ActionBruteForce`, the next action is moved towards the
+    best sample according to ``alpha``.
+    
+    In contrast to the exhaustive search, the number of evaluations does
+    not grow exponentially with the action dimension. The local samples
+    are drawn from a Halton sequence, hence cover the neighbourhood
+    evenly.
+    
+    Additional keyword arguments:
+    
+    ``bounds``
+        Lower and upper limits of the action space, as tuple of two
+        arrays of length A (or scalars). Samples are clipped to this box.
+        If ``candidates`` is :py:const:`None`, the initial samples are
+        drawn quasi-randomly from the box.
+    
+    ``num_samples``
+        Number of initial samples, if they are drawn from ``bounds``.
+        Default is 64.
+    
+    ``budget``
+        Maximum number of critic evaluations per step (including the
+        initial candidates). Default is 256.
+    
+    ``num_best``
+        Number of best samples which are refined at each level.
+        Default is 4.
+    
+    ``num_refine``
+        Number of new samples drawn around each of the best samples per
+        level. Default is 8.
+    
+    ``radius``
+        Initial sampling radius around the best samples. Scalar or array
+        of length A. By default, half the spacing of the initial samples
+        is used.
+    
+    ``shrink``
+        Factor by which the radius is reduced at each level. Default is
+        0.5.
+    
+    """
+    def __init__(self, candidates, *args, **kwargs):
+        self.bounds = kwargs.pop('bounds', None)
+        self.num_samples = kwargs.pop('num_samples', 64)
+        self.budget = kwargs.pop('budget', 256)
+        self.num_best = kwargs.pop('num_best', 4)
+        self.num_refine = kwargs.pop('num_refine', 8)
+        self.shrink = kwargs.pop('shrink', 0.5)
+        radius = kwargs.pop('radius', None)
+        self.radius = None
+        self._halton_index = 0
+        assert 0.0 < self.shrink and self.shrink < 1.0
+        if candidates is None:
+            if self.bounds is None:
+                raise Exception('Either candidates or bounds must be provided')
+            candidates = []
+        super(ActionRefinement, self).__init__(candidates, *args, **kwargs)
+        
+        if self.candidates.shape[0] == 0:
+            lower, upper = self._bounds()
+            samples = halton_sequence(self.num_samples, self._motor_action_dim)
+            self.set_candidates(lower + samples * (upper - lower))
+        
+        if radius is not None:
+            self.radius = radius * np.ones(self._motor_action_dim)
+    
+    def set_candidates(self, candidates):
+        """Define the initial action samples ``candidates``. The
+        sampling radius is adapted to their spacing.
+        """
+        super(ActionRefinement, self).set_candidates(candidates)
+        num_cand, action_dim = self.candidates.shape
+        if num_cand > 1:
+            per_dim = max(1.0, np.round(num_cand ** (1.0 / action_dim)) - 1.0)
+            self.radius = 0.5 * self.candidates.ptp(axis=0) / per_dim
+            self.radius[self.radius == 0.0] = 0.1
+        else:
+            self.radius = 0.1 * np.ones(action_dim)
+    
+    def _bounds(self):
+        """Return the lower and upper action limits as arrays."""
+        lower, upper = self.bounds
+        lower = np.asarray(lower, dtype=float).flatten() * np.ones(self._motor_action_dim)
+        upper = np.asarray(upper, dtype=float).flatten() * np.ones(self._motor_action_dim)
+        return lower, upper
+    
+    def _best_candidate(self, state, candidates):
+        """Return the best action found by the coarse-to-fine search,
+        starting at ``candidates``, as Ax1 column vector, and its
+        predicted return.
+        """
+        action_dim = candidates.shape[1]
+        _, _, j_cand = self._critic_eval_batch(state, candidates, 'a_next')
+        samples, returns = candidates, j_cand[:, 0]
+        num_eval = samples.shape[0]
+        radius = self.radius
+        while num_eval < self.budget and self._time_left() > 0.0:
+            # keep the best samples
+            best = returns.argsort()[::-1][:self.num_best]
+            samples, returns = samples[best], returns[best]
+            
+            # sample around the best ones
+            num_new = min(self.num_refine * samples.shape[0], self.budget - num_eval)
+            offsets = halton_sequence(num_new, action_dim, self._halton_index)
+            self._halton_index = (self._halton_index + num_new) % 100000
+            offsets = radius * (2.0 * offsets - 1.0)
+            local = samples[np.arange(num_new) % samples.shape[0]] + offsets
+            if self.bounds is not None:
+                lower, upper = self._bounds()
+                local = np.clip(local, lower, upper)
+            
+            _, _, j_local = self._critic_eval_batch(state, local, 'a_next')
+            samples = np.vstack((samples, local))
+            returns = np.concatenate((returns, j_local[:, 0]))
+            num_eval += num_new
+            radius = radius * self.shrink
+        
+        idx = returns.argmax()
+        return np.atleast_2d(samples[idx]).T, returns[idx]
+
+## QUASI-RANDOM SAMPLING ##
+
+def _first_primes(num):
+    """Return the ``num`` smallest prime numbers."""
+    primes = []
+    candidate = 2
+    while len(primes) < num:
+        if all(candidate % prime != 0 for prime in primes):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+def halton_sequence(num, dim, start=0):
+    """Return ``num`` points of the ``dim``-dimensional Halton sequence,
+    starting at index ``start``. The points lie in the unit cube and
+    are returned as (num x dim) matrix.
+    """
+    idx = np.arange(start + 1, start + num + 1)
+    points = np.empty((num, dim))
+    for col, base in enumerate(_first_primes(dim)):
+        remainder = idx.copy()
+        fraction = 1.0
+        value = np.zeros(num)
+        while (remainder > 0).any():
+            fraction /= base
+            value += fraction * (remainder % base)
+            remainder //= base
+        points[:, col] = value
+    return points
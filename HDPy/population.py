@@ -0,0 +1,306 @@
+"""
+Often, the same experiment is run many times, e.g. with different
+seeds or parameters. If each run is a separate process (or a separate
+:py:class:`ADHDP` instance), the loop overhead is paid per agent and
+step. The :py:class:`ADHDPPopulation` instead holds a number of
+independent :py:class:`ADHDP` agents and advances all of them with a
+single call per step. The reservoirs, readouts (RLS) and actions are
+kept in stacked arrays, such that the agents are processed jointly by
+batched linear algebra. Only the plants (state and reward) are still
+evaluated per agent.
+
+"""
+import numpy as np
+import scipy.sparse
+from rl import ActorCritic, _ConstParam, ConstMomentum, RadialMomentum
+from rc import StabilizedRLS
+from hdp import ADHDP
+
+def _dense(mat):
+    """Return the matrix ``mat`` as dense array."""
+    if scipy.sparse.issparse(mat):
+        return mat.toarray()
+    return np.asarray(mat)
+
+def _select(mask):
+    """Return an index for the entries of ``mask``. If all of them are
+    selected, a slice is returned such that no copies are made."""
+    if mask.all():
+        return slice(None)
+    return np.flatnonzero(mask)
+
+def _norm_params(normalizer, name, dim):
+    """Return offset and scale of ``name`` as 2x``dim`` array."""
+    offset, scale = normalizer.get(name)
+    return np.array([np.ones(dim) * offset, np.ones(dim) * scale])
+
+class ADHDPPopulation(object):
+    """A population of independent :py:class:`ADHDP` agents which are
+    stepped in lockstep.
+    
+    The agents keep their own reservoirs, readouts, plants, policies
+    and parameters, but are executed jointly. The algorithm is the one
+    of :py:meth:`ADHDP._step` (including the initial phase of
+    :py:meth:`ADHDP.init_episode`). At construction, the current state
+    of the agents is copied into stacked arrays; afterwards, the
+    agents are not updated until :py:meth:`sync` is called.
+    
+    The agents must be compatible, i.e. have the same reservoir size,
+    input and action dimension. The reservoirs must use :py:func:`numpy.tanh`
+    as node function, the readouts must be either all
+    :py:class:`PlainRLS` or all :py:class:`StabilizedRLS` (with bias and
+    a single output). The epoch is not filled with intermediate
+    results (see :py:meth:`ActorCritic.set_recording`) and the
+    policies are only updated by :py:meth:`sync` and
+    :py:meth:`new_episode`.
+    
+    ``agents``
+        List of :py:class:`ADHDP` instances.
+    
+    """
+    def __init__(self, agents):
+        agents = list(agents)
+        if len(agents) == 0:
+            raise Exception('The population must not be empty')
+        
+        first = agents[0]
+        res_dim = first.reservoir.get_output_dim()
+        input_dim = first.reservoir.get_input_dim()
+        action_dim = first.child.action_space_dim()
+        readout_cls = type(first.readout)
+        for agent in agents:
+            if type(agent)._step.im_func is not ADHDP._step.im_func:
+                raise Exception('Only the baseline ADHDP algorithm is supported')
+            assert agent.reservoir.get_output_dim() == res_dim
+            assert agent.reservoir.get_input_dim() == input_dim
+            assert agent.child.action_space_dim() == action_dim
+            assert agent.reservoir.nonlin_func is np.tanh
+            assert type(agent.readout) is readout_cls
+            assert agent.readout.with_bias and agent.readout.output_dim == 1
+            assert not agent.readout._stop_training
+        
+        self.agents = agents
+        self.size = len(agents)
+        self._res_dim = res_dim
+        self._action_dim = action_dim
+        
+        # Reservoirs
+        self.w = np.array([_dense(agent.reservoir.w) for agent in agents]) # PxNxN
+        self.w_in = np.array([_dense(agent.reservoir.w_in) for agent in agents]) # PxNxD
+        self.w_bias = np.array([_dense(agent.reservoir.w_bias)[0] for agent in agents]) # PxN
+        self.states = np.array([agent.reservoir.states[-1] for agent in agents]) # PxN
+        
+        # Readouts
+        self.beta = np.array([agent.readout.beta[:, 0] for agent in agents]) # PxK
+        self.psi_inv = np.array([agent.readout._psi_inv for agent in agents]) # PxKxK
+        self.lambda_ = np.array([agent.readout.lambda_ for agent in agents], dtype=float)
+        self._stabilized = issubclass(readout_cls, StabilizedRLS)
+        if self._stabilized:
+            self.tau = np.array([agent.readout.tau for agent in agents])
+            self.cnt_train = np.array([agent.readout.cnt_train for agent in agents])
+            self.diag_default = np.array([agent.readout.diag_default for agent in agents])
+            self._triu = np.triu_indices(self.beta.shape[1], 1)
+        
+        # Actor-Critic state
+        self.a_curr = np.array([agent.a_curr[:, 0] for agent in agents], dtype=float) # PxA
+        self.num_step = np.array([agent.num_step for agent in agents])
+        self.num_episode = np.array([agent.num_episode for agent in agents])
+        self._init_steps = np.array([agent._init_steps for agent in agents])
+        self.s_curr = [agent.s_curr for agent in agents]
+        self._in_curr = None
+        self.reward = np.zeros(self.size)
+        self.err = np.zeros(self.size)
+        
+        # Action normalization and derivative denormalization
+        self._a_curr_nrm = np.array([_norm_params(agent.normalizer, 'a_curr', action_dim) for agent in agents]) # Px2xA
+        self._a_next_nrm = np.array([_norm_params(agent.normalizer, 'a_next', action_dim) for agent in agents]) # Px2xA
+        
+        # Constant parameters are evaluated once
+        self._const = {}
+        for name in ('alpha', 'gamma'):
+            params = [getattr(agent, name) for agent in agents]
+            if all([isinstance(param, _ConstParam) for param in params]):
+                self._const[name] = np.array([param._value for param in params], dtype=float)
+        
+        momentum = [agent.momentum for agent in agents]
+        self._momentum_type = None
+        for mom_type in (ConstMomentum, RadialMomentum):
+            if all([type(mom) is mom_type for mom in momentum]):
+                self._momentum_type = mom_type
+                self._momentum_value = np.array([mom._value for mom in momentum], dtype=float)[:, np.newaxis]
+        
+        # Hooks are only executed if overwritten
+        self._hooks = [type(agent)._next_action_hook.im_func is not ActorCritic._next_action_hook.im_func for agent in agents]
+        self._has_hooks = any(self._hooks)
+    
+    def _params(self, name, sel):
+        """Return the parameter ``name`` ('alpha' or 'gamma') of the
+        agents ``sel`` as array."""
+        if name in self._const:
+            return self._const[name][sel]
+        return np.array([float(getattr(self.agents[idx], name)(self.num_episode[idx], self.num_step[idx])) for idx in np.arange(self.size)[sel]])
+    
+    def _momentum(self, sel, a_curr, a_prop):
+        """Apply the agents' momentum to the proposed actions ``a_prop``
+        of the agents ``sel``."""
+        if self._momentum_type is ConstMomentum:
+            value = self._momentum_value[sel]
+            return value * a_curr + (1.0 - value) * a_prop
+        
+        if self._momentum_type is RadialMomentum:
+            value = self._momentum_value[sel]
+            imag_r = value * np.exp(1j * (a_curr % (2*np.pi))) + (1.0 - value) * np.exp(1j * (a_prop % (2*np.pi)))
+            return np.angle(imag_r) % (2*np.pi)
+        
+        a_next = np.empty(a_prop.shape)
+        for pos, idx in enumerate(np.arange(self.size)[sel]):
+            momentum = self.agents[idx].momentum
+            a_next[pos] = momentum(a_curr[pos][:, np.newaxis], a_prop[pos][:, np.newaxis], self.num_episode[idx], self.num_step[idx])[:, 0]
+        return a_next
+    
+    def _reservoir_step(self, sel, states, r_input):
+        """Return the next reservoir states of the agents ``sel``."""
+        r_pre = np.einsum('pij,pj->pi', self.w[sel], states)
+        r_pre += np.einsum('pij,pj->pi', self.w_in[sel], r_input)
+        r_pre += self.w_bias[sel]
+        return np.tanh(r_pre, out=r_pre)
+    
+    def _readout(self, beta, x_state):
+        """Evaluate the readouts ``beta`` at the critic inputs ``x_state``."""
+        return beta[:, 0] + np.einsum('pk,pk->p', x_state, beta[:, 1:])
+    
+    def _train(self, sel, x_state, err):
+        """Batched RLS training of the readouts ``sel`` on one sample
+        ``x_state`` each, with error ``err``."""
+        sample = np.hstack((np.ones((x_state.shape[0], 1)), x_state))
+        psi_inv = self.psi_inv[sel]
+        lambda_ = self.lambda_[sel]
+        psi_x = np.einsum('pij,pj->pi', psi_inv, sample)
+        gain = psi_x / (lambda_ + np.einsum('pi,pi->p', sample, psi_x))[:, np.newaxis]
+        self.beta[sel] += gain * err[:, np.newaxis]
+        psi_inv -= gain[:, :, np.newaxis] * psi_x[:, np.newaxis, :]
+        if (lambda_ != 1.0).any():
+            psi_inv /= lambda_[:, np.newaxis, np.newaxis]
+        
+        if self._stabilized:
+            # Restore symmetry from the lower triangular part
+            rows, cols = self._triu
+            psi_inv[:, rows, cols] = psi_inv[:, cols, rows]
+            
+            # Diagonal stabilization
+            agents = np.arange(self.size)[sel]
+            self.cnt_train[agents] += 1
+            for pos in np.flatnonzero(self.cnt_train[agents] % self.tau[agents] == 0):
+                np.fill_diagonal(psi_inv[pos], self.diag_default[agents[pos]])
+        
+        self.psi_inv[sel] = psi_inv
+    
+    def __call__(self, epochs):
+        """Advance all agents by one step. The latest observations are
+        given in ``epochs``, a list with one epoch per agent. Returns
+        the next action of each agent, in the rows of a PxA array.
+        """
+        res_dim = self._res_dim
+        action_dim = self._action_dim
+        in_next = np.array([agent.plant.state_input(epoch)[:, 0] for agent, epoch in zip(self.agents, epochs)]) # PxS
+        if self._in_curr is None:
+            self._in_curr = np.zeros(in_next.shape)
+        
+        # Initial phase: num_step <= init_steps (see ActorCritic.__call__)
+        init = self.num_step <= self._init_steps
+        self.num_step[init] += 1
+        learn = ~init
+        advance = learn | (init & (self.num_step > 1))
+        
+        if advance.any():
+            sel = _select(advance)
+            a_curr = self.a_curr[sel]
+            i_curr = np.hstack((self._in_curr[sel], (a_curr - self._a_curr_nrm[sel, 0]) / self._a_curr_nrm[sel, 1]))
+            r_curr = self._reservoir_step(sel, self.states[sel], i_curr)
+            self.states[sel] = r_curr
+        
+        if learn.any():
+            # Note that all learning agents advance
+            sel = _select(learn)
+            if not isinstance(sel, slice):
+                pos = np.searchsorted(np.flatnonzero(advance), sel)
+                i_curr, r_curr, a_curr = i_curr[pos], r_curr[pos], a_curr[pos]
+            
+            reward = np.array([float(self.agents[idx].plant.reward(epochs[idx])) for idx in np.arange(self.size)[sel]])
+            alpha = self._params('alpha', sel)
+            gamma = self._params('gamma', sel)
+            beta = self.beta[sel]
+            
+            # ESN-critic, first instance: in(k) => J(k)
+            x_curr = np.hstack((r_curr, i_curr))
+            j_curr = self._readout(beta, x_curr)
+            
+            # Next action
+            dtanh = 1.0 - r_curr**2
+            deriv = np.einsum('pna,pn->pa', self.w_in[sel][:, :, -action_dim:], beta[:, 1:res_dim+1] * dtanh)
+            deriv += beta[:, -action_dim:]
+            deriv *= self._a_curr_nrm[sel, 1]
+            a_next = a_curr + alpha[:, np.newaxis] * deriv
+            a_next = self._momentum(sel, a_curr, a_next)
+            if self._has_hooks:
+                for pos, idx in enumerate(np.arange(self.size)[sel]):
+                    if self._hooks[idx]:
+                        a_next[pos] = self.agents[idx]._next_action_hook(a_next[pos][:, np.newaxis])[:, 0]
+            
+            # ESN-critic, second instance: in(k+1) => J(k+1)
+            i_next = np.hstack((in_next[sel], (a_next - self._a_next_nrm[sel, 0]) / self._a_next_nrm[sel, 1]))
+            r_next = self._reservoir_step(sel, r_curr, i_next)
+            x_next = np.hstack((r_next, i_next))
+            j_next = self._readout(beta, x_next)
+            
+            # TD_error(k) = J(k) - U(k) - gamma * J(k+1)
+            err = reward + gamma * j_next - j_curr
+            
+            # One-step RLS training => Trained ESN
+            self._train(sel, x_curr, err)
+            
+            self.reward[sel] = reward
+            self.err[sel] = err
+            self.a_curr[sel] = a_next
+            self.num_step[sel] += 1
+        
+        self._in_curr = in_next
+        self.s_curr = list(epochs)
+        return self.a_curr.copy()
+    
+    def new_episode(self, mask=None):
+        """Start a new episode for the agents selected by ``mask`` (a
+        boolean array or list of indices; all agents by default). As
+        in :py:meth:`ADHDP.new_episode`, the reservoir and plant are
+        reset and the action is set to the policy's initial action.
+        """
+        if mask is None:
+            mask = np.ones(self.size, dtype=bool)
+        
+        for idx in np.arange(self.size)[mask]:
+            agent = self.agents[idx]
+            agent.plant.reset()
+            # An individual agent updates its policy in each step, which
+            # may determine the initial action (e.g. of a gait policy)
+            agent.child.update(self.a_curr[idx][:, np.newaxis].copy())
+            self.a_curr[idx] = agent.child.initial_action()[:, 0]
+            self.s_curr[idx] = dict()
+        
+        self.states[mask] = 0.0
+        self.num_step[mask] = 0
+        self.num_episode[mask] += 1
+    
+    def sync(self):
+        """Write the population state back into the agents, such that
+        they can be used (or stored) individually."""
+        for idx, agent in enumerate(self.agents):
+            agent.reservoir.states = self.states[idx:idx+1].copy()
+            agent.readout.beta = self.beta[idx][:, np.newaxis].copy()
+            agent.readout._psi_inv = self.psi_inv[idx].copy()
+            if self._stabilized:
+                agent.readout.cnt_train = self.cnt_train[idx]
+            agent.a_curr = self.a_curr[idx][:, np.newaxis].copy()
+            agent.num_step = self.num_step[idx]
+            agent.num_episode = self.num_episode[idx]
+            agent.s_curr = self.s_curr[idx]
+            agent.child.update(agent.a_curr)
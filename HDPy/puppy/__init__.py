@@ -2,10 +2,28 @@
 
 .. automodule:: HDPy.puppy.puppy
 
+.. automodule:: HDPy.puppy.replay
+
 .. automodule:: HDPy.puppy.analysis_puppy
 
+.. automodule:: HDPy.puppy.cache
+
+.. automodule:: HDPy.puppy.batch
+
+.. automodule:: HDPy.puppy.sampling
+
+.. automodule:: HDPy.puppy.headless
+
+.. automodule:: HDPy.puppy.sweep
+
 """
 from puppy import *
+from replay import *
 from analysis_puppy import *
+from cache import *
+from batch import *
+from sampling import *
+from headless import *
+from sweep import *
 import policy
 import plant
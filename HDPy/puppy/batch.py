@@ -0,0 +1,181 @@
+"""
+With a fixed offline dataset, the critic can be fitted in batch instead
+of sample by sample. First, the critic's reservoir is run over all
+recorded episodes once and the transitions (critic input of the current
+and next step, reward and discount) are collected
+(:py:func:`collect_transitions`). The readout is then fitted by fitted
+value iteration (:py:func:`fitted_value_iteration`): The TD targets
+are computed from the current readout, the readout is solved as ridge
+regression over all transitions, and this is repeated until the
+weights converge. As the regression matrix doesn't change between
+iterations, it's factorized only once.
+
+The result is a readout of the same type as the critic's. Its inverse
+correlation matrix is set as if the readout had been trained online on
+all transitions, hence an online run can be warm-started from it
+(:py:func:`batch_adhdp`).
+
+"""
+from puppy import offline_playback
+from ..rl import Policy
+import numpy as np
+import scipy.linalg
+import warnings
+import copy
+
+class Transitions(object):
+    """Transitions of a critic, collected from offline data. The
+    critic inputs of the current and next step are stored in rows of
+    *x_curr* and *x_next*, the rewards and discount factors in *reward*
+    and *gamma* and the episode of each transition in *episode*.
+    """
+    def __init__(self, x_curr, x_next, reward, gamma, episode):
+        self.x_curr = x_curr
+        self.x_next = x_next
+        self.reward = reward
+        self.gamma = gamma
+        self.episode = episode
+    
+    def __len__(self):
+        return self.x_curr.shape[0]
+
+class _TransitionRecorder(object):
+    """Pre-increment hook of ``critic``, which records the transitions
+    of each step."""
+    def __init__(self, critic):
+        self.critic = critic
+        self.x_curr, self.x_next = [], []
+        self.reward, self.gamma, self.episode = [], [], []
+    
+    def __call__(self, epoch, **kwargs):
+        if 'x_curr' not in kwargs:
+            return
+        
+        critic = self.critic
+        self.x_curr.append(kwargs['x_curr'][0].copy())
+        self.x_next.append(kwargs['x_next'][0].copy())
+        self.reward.append(float(kwargs['reward']))
+        self.gamma.append(critic.gamma(critic.num_episode, critic.num_step))
+        self.episode.append(kwargs['offline_episode'][0])
+    
+    def transitions(self):
+        """Return the recorded :py:class:`Transitions`."""
+        return Transitions(
+            np.array(self.x_curr),
+            np.array(self.x_next),
+            np.array(self.reward),
+            np.array(self.gamma, dtype=float),
+            np.array(self.episode)
+            )
+
+class _ReplayPolicy(Policy):
+    """Stand-in for the policy of a critic copy in
+    :py:func:`collect_transitions`. The replay reads the actions from
+    the data, hence the policy only has to provide the initial action.
+    """
+    def __init__(self, policy):
+        super(_ReplayPolicy, self).__init__(action_space_dim=policy.action_space_dim())
+        self.action = policy.initial_action().copy()
+    
+    def initial_action(self):
+        return self.action.copy()
+    
+    def update(self, action_upd):
+        pass
+    
+    def get_iterator(self, time_start_ms, time_end_ms, step_size_ms):
+        return iter([])
+    
+    def reset(self):
+        pass
+
+def collect_transitions(pth_data, critic, samples_per_action, ms_per_step, **playback_kwargs):
+    """Replay the offline data at ``pth_data`` (see
+    :py:func:`offline_playback`) on a copy of ``critic`` with disabled
+    training and return the :py:class:`Transitions`. The ``critic``
+    itself is not altered.
+    
+    As with :py:meth:`ActorCritic.save`, the policy (``critic.child``)
+    is not copied, since it may hold resources such as open files. The
+    copy is given a stand-in policy instead.
+    
+    """
+    child = critic.child
+    critic.child = None
+    try:
+        replayed = copy.deepcopy(critic)
+    finally:
+        critic.child = child
+    
+    critic = replayed
+    critic.child = _ReplayPolicy(child)
+    critic.readout.stop_training()
+    critic.replay = None
+    recorder = _TransitionRecorder(critic)
+    critic._pre_increment_hook = recorder
+    offline_playback(pth_data, critic, samples_per_action, ms_per_step, **playback_kwargs)
+    return recorder.transitions()
+
+def fitted_value_iteration(transitions, readout, ridge=1e-4, max_iter=100, tol=1e-6):
+    """Fit a copy of ``readout`` to the :py:class:`Transitions` by
+    fitted value iteration.
+    
+    In each iteration, the TD targets
+    :math:`r_t + \gamma_t J(x_{t+1})` are computed with the current
+    weights, then the weights are solved by ridge regression (with
+    regularization ``ridge``) of the targets on :math:`x_t`. The
+    iteration starts with the weights of ``readout`` and stops after
+    ``max_iter`` iterations or if the largest weight change is below
+    ``tol`` (relative to the largest weight).
+    
+    The default ``ridge`` corresponds to the initial inverse
+    correlation matrix of :py:class:`StabilizedRLS`.
+    
+    Returns the fitted readout and the number of iterations.
+    
+    """
+    x_curr, x_next = transitions.x_curr, transitions.x_next
+    if readout.with_bias:
+        x_curr = readout._add_constant(x_curr)
+        x_next = readout._add_constant(x_next)
+    
+    # Fixed point beta = A^-1 X' (r + gamma Xn beta) = b + M beta
+    corr = x_curr.T.dot(x_curr)
+    corr.flat[::corr.shape[0] + 1] += ridge
+    factor = scipy.linalg.cho_factor(corr)
+    b = scipy.linalg.cho_solve(factor, x_curr.T.dot(transitions.reward[:, np.newaxis]))
+    M = scipy.linalg.cho_solve(factor, x_curr.T.dot(transitions.gamma[:, np.newaxis] * x_next))
+    
+    beta = readout.beta.copy()
+    num_iter = 0
+    converged = False
+    while num_iter < max_iter and not converged:
+        beta_next = b + M.dot(beta)
+        num_iter += 1
+        if not np.isfinite(beta_next).all():
+            raise Exception('Fitted value iteration diverged after %i iterations' % num_iter)
+        converged = np.abs(beta_next - beta).max() <= tol * max(1.0, np.abs(beta_next).max())
+        beta = beta_next
+    
+    if not converged:
+        warnings.warn('Fitted value iteration did not converge within %i iterations' % max_iter)
+    
+    fitted = copy.deepcopy(readout)
+    fitted.beta = beta
+    fitted._psi_inv = scipy.linalg.cho_solve(factor, np.eye(corr.shape[0]))
+    return fitted, num_iter
+
+def batch_adhdp(pth_data, critic, samples_per_action, ms_per_step, ridge=1e-4, max_iter=100, tol=1e-6, **playback_kwargs):
+    """Fit the readout of ``critic`` to the offline data at
+    ``pth_data`` in batch, see :py:func:`collect_transitions` and
+    :py:func:`fitted_value_iteration`. The critic is not altered; to
+    warm-start it, assign the returned readout to ``critic.readout``.
+    
+    Note that the returned readout was fitted on the reservoir states
+    of the replay. The reservoir of ``critic`` must not be altered
+    afterwards.
+    
+    """
+    transitions = collect_transitions(pth_data, critic, samples_per_action, ms_per_step, **playback_kwargs)
+    readout, _ = fitted_value_iteration(transitions, critic.readout, ridge, max_iter, tol)
+    return readout
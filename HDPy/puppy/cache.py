@@ -0,0 +1,207 @@
+"""
+In an offline replay, the plant derives the reward and state of each
+step from the raw sensor samples. Both depend only on the data and the
+plant, not on the critic. When the same data is replayed many times
+(e.g. in a :py:class:`Sweep`), they can be computed beforehand.
+
+A :py:class:`ReplayCache` holds the per-step rewards and states of a
+data file for a specific plant and number of samples per action,
+together with the actions, tumbling and restart information and an
+index of the episode offsets. It is passed to
+:py:func:`offline_playback` instead of the data file's path, in which
+case the raw sensors are not read at all. The critics' plants are
+temporarily replaced by a :py:class:`CachedPlant`, which looks up the
+precomputed values.
+
+The cache is built by driving a copy of the plant the same way a
+critic does in the replay: The plant is reset between episodes (as
+:py:class:`PuppyHDP` does on the 'reset' message) and the reward is
+only evaluated after the critic's initial steps. For plants which keep
+a history (such as :py:class:`AccelerationReward`), the rewards thus
+match those of a replay from the data file. The cache is only valid for
+critics with the same number of initial steps, which is checked by the
+replay.
+
+Note that the rewards are evaluated only once. A noisy or otherwise
+stochastic reward (e.g. ``reward_noise`` of :py:class:`LineFollower`)
+is frozen into the cache, i.e. every replay sees the same noise.
+
+"""
+from puppy import _EpisodeFile, plant_config
+from ..rl import Plant
+from ..checkpoint import save_checkpoint, load_checkpoint
+import numpy as np
+import cPickle as pickle
+import hashlib
+import copy
+import os
+
+class ReplayCache(object):
+    """Precomputed rewards and states of an offline data file.
+    
+    The per-step arrays (*states*, *rewards*, *a_next*) are stacked over
+    all episodes; the steps of episode *i* are found in the range
+    ``offsets[i]:offsets[i+1]``. Per episode, the name (*episodes*),
+    the number of stored actions (*lengths*), the initial action
+    (*a_curr*), the restart flag (*init_step*) and the sample at which
+    the robot tumbled (*time_tumbled*) are kept. The rewards are only
+    valid for the steps marked in *evaluated*, which depends on the
+    number of initial steps (*init_steps*) of the critic.
+    
+    Use :py:meth:`build` or :py:func:`replay_cache` to create an
+    instance.
+    
+    """
+    def __init__(self, samples_per_action, init_steps, episodes, lengths, offsets, states, rewards, evaluated, a_curr, a_next, init_step, time_tumbled):
+        self.samples_per_action = samples_per_action
+        self.init_steps = init_steps
+        self.episodes = list(episodes)
+        self.lengths = lengths
+        self.offsets = offsets
+        self.states = states
+        self.rewards = rewards
+        self.evaluated = evaluated
+        self.a_curr = a_curr
+        self.a_next = a_next
+        self.init_step = init_step
+        self.time_tumbled = time_tumbled
+    
+    @classmethod
+    def build(cls, pth_data, plant, samples_per_action, init_steps=1):
+        """Evaluate a copy of ``plant`` on all episodes of the data file
+        at ``pth_data``, split into chunks of ``samples_per_action``
+        samples, for a critic with ``init_steps`` initial steps.
+        
+        As in the replay, the plant is reset between episodes and the
+        reward is not evaluated in the initial steps of an episode
+        (see :py:meth:`ActorCritic.__call__`; the empty call after a
+        restart of the simulation counts as initial step). The state is
+        evaluated on every step.
+        
+        """
+        plant = copy.deepcopy(plant)
+        source = _EpisodeFile(pth_data, samples_per_action)
+        episodes = source.storages()
+        lengths, offsets, init_step, time_tumbled = [], [0], [], []
+        states, rewards, evaluated, a_curr, a_next = [], [], [], [], []
+        for episode_idx, episode in enumerate(episodes):
+            if episode_idx > 0:
+                plant.reset()
+            
+            data = source.load_episode(episode)
+            num_calls = 1 if data['init_step'] else 0
+            for step in range(data['num_steps']):
+                chunk = data['chunk'](step)
+                states.append(plant.state_input(chunk)[:, 0])
+                num_calls += 1
+                if num_calls > init_steps + 1:
+                    rewards.append(float(plant.reward(chunk)))
+                    evaluated.append(True)
+                else:
+                    rewards.append(np.nan)
+                    evaluated.append(False)
+            
+            lengths.append(source.file[episode]['a_curr'].shape[0])
+            offsets.append(offsets[-1] + data['num_steps'])
+            init_step.append(data['init_step'])
+            time_tumbled.append(data['time_tumbled'])
+            a_curr.append(data['a_curr'])
+            a_next.append(data['a_next'])
+        
+        return cls(
+            samples_per_action,
+            init_steps,
+            episodes,
+            np.array(lengths),
+            np.array(offsets),
+            np.array(states, dtype=float),
+            np.array(rewards, dtype=float),
+            np.array(evaluated, dtype=bool),
+            np.array(a_curr, dtype=float),
+            np.vstack(a_next).astype(float),
+            np.array(init_step, dtype=bool),
+            np.array(time_tumbled)
+            )
+    
+    def save(self, pth):
+        """Store the cache in the directory ``pth``, see
+        :py:mod:`HDPy.checkpoint`."""
+        save_checkpoint(self, pth, min_size=1)
+    
+    @staticmethod
+    def load(pth, mmap=True):
+        """Load a cache from the directory ``pth``. The arrays are
+        memory-mapped if ``mmap`` is set."""
+        return load_checkpoint(pth, mmap)
+    
+    def storages(self, min_episode_len=0):
+        """Return the names of the episodes with more than
+        ``min_episode_len`` steps, in order."""
+        return [episode for episode, length in zip(self.episodes, self.lengths) if length > min_episode_len]
+    
+    def load_episode(self, storage):
+        """Return the data of an episode, in the format of
+        :py:meth:`HDPy.puppy.puppy._EpisodeFile.load_episode`. The
+        epoch of a step only holds the index into the cache
+        (*cache_step*), which is resolved by :py:class:`CachedPlant`."""
+        idx = self.episodes.index(storage)
+        offset = self.offsets[idx]
+        return {
+            'num_steps'     : self.offsets[idx + 1] - offset,
+            'a_curr'        : self.a_curr[idx],
+            'a_next'        : self.a_next[offset:self.offsets[idx + 1]],
+            'init_step'     : bool(self.init_step[idx]),
+            'time_tumbled'  : self.time_tumbled[idx],
+            'chunk'         : lambda step: {'cache_step': offset + step},
+            }
+    
+    def replay_plant(self, critics):
+        """Return a :py:class:`CachedPlant` for the cache, after
+        checking that it's valid for the ``critics``."""
+        for critic in critics:
+            if critic._init_steps != self.init_steps:
+                raise Exception('The cache was built for %i initial steps, the critic has %i' % (self.init_steps, critic._init_steps))
+        return CachedPlant(self)
+
+class CachedPlant(Plant):
+    """A :py:class:`Plant` which returns the precomputed reward and
+    state of a :py:class:`ReplayCache`. The epochs are expected to hold
+    the index of the step in the cache (*cache_step*). The states are
+    normalized already.
+    """
+    def __init__(self, cache):
+        super(CachedPlant, self).__init__(state_space_dim=cache.states.shape[1])
+        self.cache = cache
+    
+    def state_input(self, state):
+        """Return the cached state of the epoch ``state``."""
+        return self.cache.states[state['cache_step']][:, np.newaxis]
+    
+    def reward(self, epoch):
+        """Return the cached reward of ``epoch``."""
+        step = epoch['cache_step']
+        if not self.cache.evaluated[step]:
+            raise Exception('The reward of step %i is not cached, the critic is driven differently than assumed by the cache' % step)
+        return self.cache.rewards[step]
+
+def cache_key(pth_data, plant, samples_per_action, init_steps=1):
+    """Return an identifier of the combination of the data file at
+    ``pth_data`` (by path, size and modification time), the
+    configuration of ``plant`` (see :py:func:`plant_config`),
+    ``samples_per_action`` and ``init_steps``."""
+    stat = os.stat(pth_data)
+    md5 = hashlib.md5()
+    md5.update(repr((os.path.abspath(pth_data), stat.st_size, stat.st_mtime, samples_per_action, init_steps)))
+    md5.update(pickle.dumps(plant_config(plant), pickle.HIGHEST_PROTOCOL))
+    return md5.hexdigest()
+
+def replay_cache(pth_data, plant, samples_per_action, cache_dir, init_steps=1):
+    """Return the :py:class:`ReplayCache` of the data file at
+    ``pth_data`` for ``plant``, ``samples_per_action`` and critics with
+    ``init_steps`` initial steps. The cache is stored in
+    ``cache_dir``; if it was built before, it's loaded (memory-mapped)
+    instead."""
+    pth = os.path.join(cache_dir, cache_key(pth_data, plant, samples_per_action, init_steps))
+    if not os.path.exists(pth):
+        ReplayCache.build(pth_data, plant, samples_per_action, init_steps).save(pth)
+    return ReplayCache.load(pth)
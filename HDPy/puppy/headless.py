@@ -0,0 +1,234 @@
+"""
+Every Puppy experiment requires webots, which makes it hard to test or
+profile the learning pipeline on its own. :py:class:`HeadlessPuppy` is
+a lightweight stand-in for the simulated robot and supervisor. It drives
+an actor (e.g. :py:class:`PuppyHDP` or :py:class:`OfflineCollector`,
+possibly wrapped in :py:mod:`PuPy` collectors) the same way the webots
+controller does: The actor is called once per control period with the
+sensor readings of the last period and returns the motor targets of
+the next one (e.g. of a :py:class:`PuPy.Gait`). The supervisor messages
+are sent through the actor's signal chain.
+
+The robot is not simulated physically. Instead, plausible sensor
+readings (see :py:data:`SENSOR_NAMES`) are derived from the motor
+targets:
+
+* The joints follow the targets with a first-order lag, the touch
+  sensors indicate the stance phase of each leg.
+* The robot walks with a speed proportional to the mean amplitude of
+  the targets and turns according to the difference of the left and
+  right amplitudes. The GPS reports the position with a slowly
+  drifting bias and noise.
+* The accelerometer measures the gravity and the gait oscillations,
+  with noise. The compass and gyro follow the heading.
+* In each control period, the robot may tumble with a probability that
+  increases with large or uneven amplitudes (see
+  :py:meth:`HeadlessPuppy.tumble_probability`). A tumbled robot stops
+  and the gravity shifts away from the vertical axis.
+
+All random numbers are drawn from a seeded generator, hence a run is
+reproducible.
+
+"""
+import numpy as np
+
+class HeadlessPuppy(object):
+    """Stand-in for Puppy in webots, which drives ``actor``.
+    
+    ``actor``
+        The robot's actor. It's called as by the webots controller and
+        receives the supervisor messages through its ``signal`` method.
+    
+    ``sampling_period_ms``
+        Sensor sampling period.
+    
+    ``ctrl_period_ms``
+        Control period, i.e. the time between two actor calls.
+    
+    ``seed``
+        Seed of the random number generator.
+    
+    ``grace_time_ms``
+        Time between tumbling and the reset of the robot.
+    
+    ``arena_size``
+        Tuple (*x_min*, *x_max*, *y_min*, *y_max*). If the robot leaves
+        the arena, it's reset. If :py:const:`None`, the arena is
+        unbounded.
+    
+    ``max_episode_ms``
+        Reset the robot after this period. If :py:const:`None`, the
+        robot is only reset after tumbling or leaving the arena.
+    
+    ``tumble_rate``
+        Scales the probability of tumbling.
+    
+    The supervisor messages are sent in the order of webots: When the
+    robot tumbles, 'tumbled_grace_start' is sent. After the grace time,
+    'tumbled' is sent and the robot is reset, which is announced by
+    'reset' and 'new_episode'. If the robot leaves the arena,
+    'out_of_arena' is sent before resetting. After each reset (and
+    initially), the actor is called with an empty epoch, as if the
+    simulation was reverted.
+    
+    """
+    def __init__(self, actor, sampling_period_ms=20, ctrl_period_ms=3000, seed=None, grace_time_ms=9000, arena_size=None, max_episode_ms=None, tumble_rate=0.02):
+        assert ctrl_period_ms % sampling_period_ms == 0
+        self.actor = actor
+        self.sampling_period_ms = sampling_period_ms
+        self.ctrl_period_ms = ctrl_period_ms
+        self.grace_time_ms = grace_time_ms
+        self.arena_size = arena_size
+        self.max_episode_ms = max_episode_ms
+        self.tumble_rate = tumble_rate
+        self.rnd = np.random.RandomState(seed)
+        
+        # Sensor model
+        self.speed_gain = 0.25      # m/s per unit of amplitude
+        self.turn_gain = 0.2        # rad/s per unit of amplitude difference
+        self.joint_lag = 0.3        # first-order lag of the joints
+        self.gps_drift = 0.002      # m/sqrt(s), random walk of the GPS bias
+        self.gps_noise = 0.001      # m
+        self.acc_noise = 0.3        # m/s^2
+        self.gyro_noise = 0.01      # rad/s
+        
+        self.num_steps = 0
+        self.num_episodes = 0
+        self.num_tumbles = 0
+        self._targets = None
+        self._revert()
+    
+    def _revert(self):
+        """Reset the robot to its initial pose and call the actor with an
+        empty epoch."""
+        self.time_ms = 0
+        self.position = np.zeros(2)
+        self.heading = 0.0
+        self.gps_bias = np.zeros(2)
+        self.joints = np.zeros(4)
+        self.tumbled_ms = None
+        self.num_episodes += 1
+        self._targets = self.actor(dict(), 0, self.ctrl_period_ms, self.sampling_period_ms)
+    
+    def _reset(self, *messages):
+        """Send ``messages`` and reset the robot."""
+        for msg in messages + ('reset', 'new_episode'):
+            self.actor.signal(msg)
+        self._revert()
+    
+    def tumble_probability(self, amplitudes):
+        """Return the probability of tumbling within a control period,
+        given the ``amplitudes`` of the four legs. It's zero for
+        moderate amplitudes and grows with amplitudes above 1.0 and
+        with the spread of the amplitudes beyond 0.4 (cf. the action
+        constraints of :py:class:`OfflineCollector`)."""
+        excess = max(0.0, amplitudes.max() - 1.0) + max(0.0, amplitudes.ptp() - 0.4)
+        return min(1.0, self.tumble_rate * (1.0 + 10.0 * excess) * excess)
+    
+    def _simulate(self, targets):
+        """Return the sensor readings (epoch) while executing the motor
+        ``targets`` (one row per sample, one column per leg)."""
+        rnd = self.rnd
+        num = targets.shape[0]
+        dt = self.sampling_period_ms / 1000.0
+        amplitudes = targets.ptp(axis=0) / 2.0
+        center = (targets.max(axis=0) + targets.min(axis=0)) / 2.0
+        
+        if self.tumbled_ms is None and rnd.uniform() < self.tumble_probability(amplitudes):
+            self.tumbled_ms = self.time_ms + rnd.randint(num) * self.sampling_period_ms
+            self.num_tumbles += 1
+        
+        # Joints: first-order lag, restarting from the last sample
+        joints = np.empty(targets.shape)
+        state = self.joints
+        for idx in xrange(num):
+            state = state + self.joint_lag * (targets[idx] - state)
+            joints[idx] = state
+        self.joints = state
+        knees = -0.5 * (joints - center)
+        
+        # Locomotion
+        time_ms = self.time_ms + self.sampling_period_ms * np.arange(1, num + 1)
+        upright = np.ones(num)
+        if self.tumbled_ms is not None:
+            upright[time_ms > self.tumbled_ms] = 0.0
+        
+        speed = self.speed_gain * amplitudes.mean() * upright
+        turn = self.turn_gain * (amplitudes[[0, 2]].sum() - amplitudes[[1, 3]].sum()) * upright
+        heading = self.heading + np.cumsum(turn) * dt
+        velocity = np.vstack((np.cos(heading), np.sin(heading))) * speed
+        position = self.position[:, np.newaxis] + np.cumsum(velocity, axis=1) * dt
+        self.heading = heading[-1]
+        self.position = position[:, -1]
+        
+        bias = self.gps_bias[:, np.newaxis] + np.cumsum(rnd.normal(0.0, self.gps_drift * np.sqrt(dt), size=(2, num)), axis=1)
+        self.gps_bias = bias[:, -1]
+        gps = position + bias + rnd.normal(0.0, self.gps_noise, size=(2, num))
+        
+        # Inertial sensors: gait oscillation and gravity
+        bounce = (targets - center).mean(axis=1) * upright
+        gravity = 9.81
+        acc_x = np.gradient(speed * np.ones(num), dt) + 2.0 * bounce
+        acc_y = gravity * (1.0 - upright) + turn * speed
+        acc_z = gravity * upright + 4.0 * bounce
+        
+        epoch = {
+            'puppyGPS_x'        : gps[0],
+            'puppyGPS_y'        : gps[1],
+            'puppyGPS_z'        : 0.1 * upright + 0.01 * bounce + rnd.normal(0.0, self.gps_noise, size=num),
+            'accelerometer_x'   : acc_x + rnd.normal(0.0, self.acc_noise, size=num),
+            'accelerometer_y'   : acc_y + rnd.normal(0.0, self.acc_noise, size=num),
+            'accelerometer_z'   : acc_z + rnd.normal(0.0, self.acc_noise, size=num),
+            'compass_x'         : np.cos(heading),
+            'compass_y'         : np.zeros(num),
+            'compass_z'         : np.sin(heading),
+            'gyro_x'            : bounce + rnd.normal(0.0, self.gyro_noise, size=num),
+            'gyro_y'            : rnd.normal(0.0, self.gyro_noise, size=num),
+            'gyro_z'            : turn + rnd.normal(0.0, self.gyro_noise, size=num),
+            }
+        for leg in range(4):
+            epoch['trg%i' % leg] = targets[:, leg].copy()
+            epoch['hip%i' % leg] = joints[:, leg]
+            epoch['knee%i' % leg] = knees[:, leg]
+            epoch['touch%i' % leg] = (joints[:, leg] < center[leg]).astype(float) * upright
+        
+        self.time_ms = int(time_ms[-1])
+        return epoch
+    
+    def step(self):
+        """Execute one control period: Apply the motor targets of the
+        actor, send the supervisor messages and call the actor with the
+        sensor readings."""
+        num = self.ctrl_period_ms / self.sampling_period_ms
+        targets = np.array([self._targets.next() for _ in xrange(num)], dtype=float)
+        was_tumbled = self.tumbled_ms is not None
+        epoch = self._simulate(targets)
+        self.num_steps += 1
+        
+        if self.tumbled_ms is not None:
+            if not was_tumbled:
+                self.actor.signal('tumbled_grace_start')
+            elif self.time_ms - self.tumbled_ms >= self.grace_time_ms:
+                self._reset('tumbled')
+                return
+        
+        if self.arena_size is not None:
+            x_min, x_max, y_min, y_max = self.arena_size
+            x, y = self.position
+            if not (x_min <= x <= x_max and y_min <= y <= y_max):
+                self._reset('out_of_arena')
+                return
+        
+        if self.max_episode_ms is not None and self.time_ms >= self.max_episode_ms:
+            self._reset()
+            return
+        
+        self._targets = self.actor(epoch, self.time_ms, self.time_ms + self.ctrl_period_ms, self.sampling_period_ms)
+    
+    def run(self, duration_ms):
+        """Run the robot for ``duration_ms`` of simulated time (summed
+        over all episodes). Return the number of control periods."""
+        num_steps = self.num_steps
+        for _ in xrange(int(duration_ms // self.ctrl_period_ms)):
+            self.step()
+        return self.num_steps - num_steps
@@ -3,65 +3,74 @@ ACD plants
 
 
 """
-from HDPy import Plant
+from HDPy import Plant, FeatureSpec
 import numpy as np
 import scipy.constants
 import scipy.signal
 
 class AccelerationReward(Plant):
     """A :py:class:`Plant` with focus on the speed and acceleration of the robot.
+    The state consists of the latest sample of the GPS, accelerometer,
+    compass, gyro, joint and touch sensors.
     """
+    FEATURES = map(FeatureSpec, (
+        'puppyGPS_x', 'puppyGPS_y', 'puppyGPS_z',
+        'accelerometer_x', 'accelerometer_y', 'accelerometer_z',
+        'compass_x', 'compass_y', 'compass_z',
+        'gyro_x', 'gyro_y', 'gyro_z',
+        'hip0', 'hip1', 'hip2', 'hip3',
+        'knee0', 'knee1', 'knee2', 'knee3',
+        'touch0', 'touch1', 'touch2', 'touch3'
+        ))
 
     def __init__(self):
         super(AccelerationReward, self).__init__(state_space_dim=24)
-        self.x = []
-        self.y = []
-        self.ax = []
-        self.ay = []
-        self.az = []
-
-
-    def state_input(self, state):
-        """Full state
+        self._pos = None
+        self._n = None
+        self._acc = None
+        self._fwd = None
+        self._size = 0
+        self._taps = None
+        self._zi = None
+    
+    def _push(self, acc):
+        """Append the summed acceleration ``acc`` of an epoch to the
+        history, which keeps the last two epochs plus the current one.
+        
+        The history is stored in fixed-size buffers, together with the
+        forward pass of the lowpass filter. If the epoch size changes,
+        the buffers are reallocated, keeping the latest samples.
         """
-        sio =  np.atleast_2d([
-            self.normalization.normalize_value('puppyGPS_x', state['puppyGPS_x'][-1]),
-            self.normalization.normalize_value('puppyGPS_y', state['puppyGPS_y'][-1]),
-            self.normalization.normalize_value('puppyGPS_z', state['puppyGPS_z'][-1]),
-            self.normalization.normalize_value('accelerometer_x', state['accelerometer_x'][-1]),
-            self.normalization.normalize_value('accelerometer_y', state['accelerometer_y'][-1]),
-            self.normalization.normalize_value('accelerometer_z', state['accelerometer_z'][-1]),
-            self.normalization.normalize_value('compass_x', state['compass_x'][-1]),
-            self.normalization.normalize_value('compass_y', state['compass_y'][-1]),
-            self.normalization.normalize_value('compass_z', state['compass_z'][-1]),
-            self.normalization.normalize_value('gyro_x', state['gyro_x'][-1]),
-            self.normalization.normalize_value('gyro_y', state['gyro_y'][-1]),
-            self.normalization.normalize_value('gyro_z', state['gyro_z'][-1]),
-            self.normalization.normalize_value('hip0', state['hip0'][-1]),
-            self.normalization.normalize_value('hip1', state['hip1'][-1]),
-            self.normalization.normalize_value('hip2', state['hip2'][-1]),
-            self.normalization.normalize_value('hip3', state['hip3'][-1]),
-            self.normalization.normalize_value('knee0', state['knee0'][-1]),
-            self.normalization.normalize_value('knee1', state['knee1'][-1]),
-            self.normalization.normalize_value('knee2', state['knee2'][-1]),
-            self.normalization.normalize_value('knee3', state['knee3'][-1]),
-#             state['touch0'][-1],
-#             state['touch1'][-1],
-#             state['touch2'][-1],
-#             state['touch3'][-1],
-            self.normalization.normalize_value('touch0', state['touch0'][-1]),
-            self.normalization.normalize_value('touch1', state['touch1'][-1]),
-            self.normalization.normalize_value('touch2', state['touch2'][-1]),
-            self.normalization.normalize_value('touch3', state['touch3'][-1])
-        ]).T
-        return sio
-
-
+        n = acc.size
+        if n != self._n:
+            hist = np.zeros(0)
+            if self._acc is not None:
+                hist = self._acc[self._acc.size - self._size:]
+            hist = hist[-2*n:]
+            self._n = n
+            self._acc = np.zeros(3*n)
+            self._fwd = np.zeros(3*n)
+            self._size = hist.size
+            self._acc[self._acc.size - hist.size:] = hist
+            self._taps = None
+        
+        self._acc[:-n] = self._acc[n:]
+        self._acc[-n:] = acc
+        self._fwd[:-n] = self._fwd[n:]
+        self._size = min(self._size + n, self._acc.size)
+    
     def reward(self, epoch):
         """Return -100.0 if the robot tumbled.
         Maximizes speed while minimizing total acceleration
         The speed measurement is the average/covered distance since last epoch
         and sum of the acceleration minus gravity is used as negative reinforcement.
+        
+        The acceleration is lowpass filtered forward and backward (see
+        :py:func:`firfilt`) over the last three epochs. Since the
+        filter has a finite response, the forward pass is streamed
+        (only the new samples are filtered, with the filter state
+        carried over) and the backward pass only covers the trimmed
+        part and the filter length behind it.
         """
         
 #         if (epoch['accelerometer_z'] < 1.0).mean() > 0.8:
@@ -69,52 +78,67 @@ class AccelerationReward(Plant):
         
         n = epoch['puppyGPS_x'].size
         
-        #keep last position
-        self.x  = np.concatenate([self.x[-1:],  epoch['puppyGPS_x']])
-        self.y  = np.concatenate([self.y[-1:],  epoch['puppyGPS_y']])
-        
-        #store last 2 epochs plus current one 
-        self.ax = np.concatenate([self.ax[-2*n:], epoch['accelerometer_x']])
-        self.ay = np.concatenate([self.ay[-2*n:], epoch['accelerometer_y']])
-        self.az = np.concatenate([self.az[-2*n:], epoch['accelerometer_z']])
+        #distance from the last position (or the first one of the epoch)
+        x = epoch['puppyGPS_x']
+        y = epoch['puppyGPS_y']
+        if self._pos is None:
+            self._pos = (x[0], y[0])
         
         spd = 0
-        if self.x.size > 1:
-            mov = np.linalg.norm(np.array([self.x[-1] - self.x[0], self.y[-1] - self.y[0]]))
-            #check consistency
-            if mov < 0.1*n:
-                # calculate displacement in a reasonable scale
-                spd = (3000.0/n) * mov;
-        
+        mov = np.linalg.norm(np.array([x[-1] - self._pos[0], y[-1] - self._pos[1]]))
+        self._pos = (x[-1], y[-1])
+        #check consistency
+        if mov < 0.1*n:
+            # calculate displacement in a reasonable scale
+            spd = (3000.0/n) * mov;
         
+        #the filter is linear, hence the axes are summed before filtering
+        self._push(epoch['accelerometer_x'] + epoch['accelerometer_y'] + epoch['accelerometer_z'])
+        size = self._size
         
-        s = np.ceil(self.ax.size/3.0)
+        s = int(np.ceil(size/3.0))
         fr = 0.3
         sr = 2*fr + (s/10.0) #should be smaller than s
+        taps = fir_taps(fr, sr)
         
-        #filtered to remove noise; borders of the result always tend to zero and have to be trimmed
-        end = -np.ceil(sr)
-        beg = -s+end
-        fax = firfilt(self.ax, fr, sr)[beg:end]
-        fay = firfilt(self.ay, fr, sr)[beg:end]
-        faz = firfilt(self.az, fr, sr)[beg:end]
+        #forward pass; restarted at the begin of the history if the filter changed
+        window = self._acc[self._acc.size - size:]
+        fwd = self._fwd[self._fwd.size - size:]
+        if taps is self._taps:
+            fwd[-n:], self._zi = scipy.signal.lfilter(taps, 1, window[-n:], zi=self._zi)
+        else:
+            fwd[:], self._zi = scipy.signal.lfilter(taps, 1, window, zi=np.zeros(taps.size - 1))
+            self._taps = taps
         
-        if fax.size > 0:
-            acc = abs(fax  + fay  + faz - scipy.constants.g).mean()
+        #borders of the result always tend to zero and have to be trimmed
+        end = size - int(np.ceil(sr))
+        beg = max(end - s, 0)
+        if end > beg:
+            facc = scipy.signal.lfilter(taps, 1, fwd[beg:][::-1])[::-1][:end - beg]
+            acc = abs(facc - scipy.constants.g).mean()
         else:
             acc = scipy.constants.g;
-
+        
         #acc = abs(epoch['accelerometer_x'] + epoch['accelerometer_y']  + epoch['accelerometer_z'] - scipy.constants.g).mean()
         return spd - acc; 
 
+_FIR_TAPS = {}
+
+def fir_taps(freq, sampling_rate):
+    """Return the taps of the lowpass filter in :py:func:`firfilt`.
+    The taps are computed once per (``freq``, ``sampling_rate``)."""
+    key = (freq, sampling_rate)
+    if key not in _FIR_TAPS:
+        nfreq = freq/(0.5*sampling_rate)
+        numtaps = int(np.ceil(sampling_rate)) + 1
+        _FIR_TAPS[key] = scipy.signal.firwin(numtaps, cutoff=nfreq)
+    return _FIR_TAPS[key]
 
 def firfilt(interval, freq, sampling_rate):
     """ Second Order LowPass Filter
     """
-    nfreq = freq/(0.5*sampling_rate)
-    taps =  sampling_rate + 1
+    b = fir_taps(freq, sampling_rate)
     a = 1
-    b = scipy.signal.firwin(taps, cutoff=nfreq)
     firstpass = scipy.signal.lfilter(b, a, interval)
     secondpass = scipy.signal.lfilter(b, a, firstpass[::-1])[::-1]
     return secondpass
@@ -1,23 +1,26 @@
 from ...rl import Plant
+from ...features import FeatureSpec, FeatureExtractor
 import numpy as np
 import warnings
 
+GPS_MEAN = [
+    FeatureSpec('puppyGPS_x', window=10, reduction='mean'),
+    FeatureSpec('puppyGPS_y', window=10, reduction='mean')
+    ]
+
+# Unnormalized location
+_GPS_LOCATION = FeatureExtractor(GPS_MEAN)
+
 class SpeedReward(Plant):
-    """A :py:class:`Plant` with focus on the speed of the robot.
+    """A :py:class:`Plant` with focus on the speed of the robot. The
+    state is the location, sampled from the *GPS* (x,y) values as
+    average over the last 10 GPS coordinates.
     """
+    FEATURES = GPS_MEAN
+    
     def __init__(self):
         super(SpeedReward, self).__init__(state_space_dim=2)
     
-    def state_input(self, state):
-        """Return the location, sampled from the *GPS* (x,y) values.
-        The sample is an average over the last 10 GPS coordinates.
-        """
-        sio =  np.atleast_2d([
-            self.normalization.normalize_value('puppyGPS_x', state['puppyGPS_x'][-10:]).mean(),
-            self.normalization.normalize_value('puppyGPS_y', state['puppyGPS_y'][-10:]).mean()
-        ]).T
-        return sio
-    
     def reward(self, epoch):
         """Return the covered distance and -1.0 if the robot tumbled.
         The speed measurement is taken from the 100th to the last sample.
@@ -32,8 +35,11 @@ class SpeedReward(Plant):
 class LineFollower(Plant):
     """A :py:class:`Plant` which gives negative reward proportional to
     the distance to a line in the xy plane. The line is described by
-    its ``origin`` and the ``direction``.
+    its ``origin`` and the ``direction``. The state is the location,
+    averaged over the last 10 *GPS* (x,y) values.
     """
+    FEATURES = GPS_MEAN
+    
     def __init__(self, origin, direction, reward_noise=0.01):
         super(LineFollower, self).__init__(state_space_dim=2)
         self.origin = np.atleast_2d(origin)
@@ -51,15 +57,6 @@ class LineFollower(Plant):
         assert self.direction.shape == (2, 1)
         assert self.origin.shape == (2, 1)
     
-    def state_input(self, state):
-        """Return the latest *GPS* (x,y) values.
-        """
-        sio =  np.atleast_2d([
-            self.normalization.normalize_value('puppyGPS_x', state['puppyGPS_x'][-10:]).mean(),
-            self.normalization.normalize_value('puppyGPS_y', state['puppyGPS_y'][-10:]).mean()
-        ]).T
-        return sio
-    
     def reward(self, epoch):
         """Return the distance between the current robot location and
         the line.
@@ -81,8 +78,12 @@ class TargetLocation(Plant):
     """A :py:class:`Plant` which gives negative reward proportional to
     the distance to point ``target`` in the xy plane. If the robot is
     closer than ``radius`` to the target, the reward will be 0.0.
+    The state is the location, averaged over the last 10 *GPS* (x,y)
+    values.
     
     """
+    FEATURES = GPS_MEAN
+    
     def __init__(self, target, radius=0.0, reward_noise=0.01):
         super(TargetLocation, self).__init__(state_space_dim=2)
         self.target = np.atleast_2d(target)
@@ -94,14 +95,6 @@ class TargetLocation(Plant):
             
         assert self.target.shape == (2, 1)
     
-    def state_input(self, state):
-        """Return the latest *GPS* (x,y) values."""
-        sio =  np.atleast_2d([
-            self.normalization.normalize_value('puppyGPS_x', state['puppyGPS_x'][-10:]).mean(),
-            self.normalization.normalize_value('puppyGPS_y', state['puppyGPS_y'][-10:]).mean()
-        ]).T
-        return sio
-    
     def reward(self, epoch):
         """Return the distance between the current robot location and
         the target point.
@@ -149,10 +142,7 @@ class TargetLocationLandmarks(TargetLocation):
     
     def state_input(self, state):
         """Return the distance to the landmarks."""
-        sio =  np.atleast_2d([
-            state['puppyGPS_x'][-10:].mean(),
-            state['puppyGPS_y'][-10:].mean()
-        ]).T
+        sio = _GPS_LOCATION(state)
         
         dist = [np.linalg.norm(sio - mark) for mark in self.landmarks]
         dist = np.atleast_2d(dist).T
@@ -15,10 +15,18 @@ is documented in :ref:`puppy_offline`.
 """
 from ..hdp import ADHDP
 from ..rl import Plant
+from ..epoch import ColumnarEpoch
+from replay import ReplayMetrics, ReplayHooks, resume_point
+from sampling import TruncatedNormalSampler
 import numpy as np
 import warnings
 import h5py
 import HDPy
+import threading
+import Queue
+import collections
+import contextlib
+import cPickle as pickle
 
 SENSOR_NAMES = ['trg0', 'trg1', 'trg2', 'trg3', 'accelerometer_x', 'accelerometer_y', 'accelerometer_z', 'compass_x', 'compass_y', 'compass_z', 'gyro_x', 'gyro_y', 'gyro_z', 'hip0', 'hip1', 'hip2', 'hip3', 'knee0', 'knee1', 'knee2', 'knee3', 'puppyGPS_x', 'puppyGPS_y', 'puppyGPS_z', 'touch0', 'touch0', 'touch1', 'touch2', 'touch3']
 
@@ -133,10 +141,11 @@ class PuppyHDP(ADHDP):
 #            x_curr = self.reservoir(i_curr, simulate=False)
 #            x_curr = np.hstack((x_curr, i_curr)) # FIXME: Input/Output ESN Model
             i_curr, x_curr, _ = self._critic_eval(self.s_curr, self.a_curr, False, 'a_curr')
-            epoch['x_curr'] = x_curr
-            epoch['i_curr'] = i_curr
-            epoch['a_next'] = self.a_curr.T
-            epoch['a_curr'] = self.a_curr.T
+            self._record(epoch,
+                x_curr=x_curr,
+                i_curr=i_curr,
+                a_next=self.a_curr.T,
+                a_curr=self.a_curr.T)
         
         self.s_curr = epoch
         return self.child(epoch, time_start_ms, time_end_ms, step_size_ms)
@@ -153,7 +162,19 @@ class OfflineCollector(ADHDP):
     processing of the experiment in an offline fashion through the
     function :py:func:`puppy.offline_playback`.
     
+    ``sampler``
+        Action sampler, see :py:mod:`HDPy.puppy.sampling`. It's called
+        with the current action and returns the next one. By default,
+        :py:meth:`_next_action_hook` defines the sampling policy.
+    
+    ``coverage``
+        :py:class:`ActionCoverage` instance, which tracks the sampled
+        actions (and the simulated time).
+    
     """
+    sampler = None
+    coverage = None
+    
     def __init__(self, *args, **kwargs):
         # look for policy's member 'action_space_dim' (policy is hidden in child or sub-child)
         policy = kwargs['policy']
@@ -176,6 +197,8 @@ class OfflineCollector(ADHDP):
         kwargs['plant'] = Plant(state_space_dim=0)
         kwargs['reservoir'] = Phony()
         kwargs['readout'] = None
+        self.sampler = kwargs.pop('sampler', None)
+        self.coverage = kwargs.pop('coverage', None)
         self.supervisor_tumbled_notice = 0
         super(OfflineCollector, self).__init__(*args, **kwargs)
     
@@ -219,6 +242,8 @@ class OfflineCollector(ADHDP):
         else:
             # Normal walking
             a_next = self._next_action_hook(self.a_curr)
+            if self.coverage is not None:
+                self.coverage.add(a_next, time_end_ms - time_start_ms)
         
 #         if self.num_step <= self._init_steps:
 #             print "(init)", a_next.T
@@ -278,16 +303,20 @@ class OfflineCollector(ADHDP):
         gathering. Note that this policy is very relevant to later
         experiments, hence this methods should be overloaded (although
         a default policy is provided).
+        
+        If a ``sampler`` was given, it's used. Otherwise, the default
+        policy is a Gaussian random walk which prohibits too small or
+        large amplitudes (see :py:class:`TruncatedNormalSampler`).
         """
-        warnings.warn('Default sampling policy is used.')
-        a_next = np.zeros(self.a_curr.shape)
-        # Prohibit too small or large amplitudes
-        while (a_next < 0.2).any() or (a_next > 2.0).any() or ((a_next > 1.0).any() and a_next.ptp() > 0.4):
-            a_next = self.a_curr + np.random.normal(0.0, 0.15, size=self.a_curr.shape)
+        if self.sampler is not None:
+            return self.sampler(self.a_curr)
         
-        return a_next
+        warnings.warn('Default sampling policy is used.')
+        return _DEFAULT_SAMPLER(self.a_curr)
 
-def offline_playback(pth_data, critic, samples_per_action, ms_per_step, episode_start=None, episode_end=None, min_episode_len=0, err_coefficient=0.01, episode_start_test=None):
+_DEFAULT_SAMPLER = TruncatedNormalSampler(0.15)
+
+def offline_playback(pth_data, critic, samples_per_action, ms_per_step, episode_start=None, episode_end=None, min_episode_len=0, err_coefficient=0.01, episode_start_test=None, prefetch=True, metrics=None, snapshots=None):
     """Simulate an experiment run for the critic by using offline data.
     The data has to be collected in webots, using the respective
     robot and supervisor. Note that the behaviour of the simulation
@@ -302,7 +331,10 @@ def offline_playback(pth_data, critic, samples_per_action, ms_per_step, episode_
     The critic won't store any sensory data again.
     
     ``pth_data``
-        Path to the datafile with the sensory information (HDF5).
+        Path to the datafile with the sensory information (HDF5). A
+        :py:class:`ReplayCache` of the datafile may be passed instead,
+        then the precomputed rewards and states are used instead of
+        the critic's plant.
     
     ``critic``
         PuppyHDP instance.
@@ -329,116 +361,336 @@ def offline_playback(pth_data, critic, samples_per_action, ms_per_step, episode_
     
     ``episode_start_test``
         starting point for the test, i.e. when we start accounting the TD-error.
+    
+    ``prefetch``
+        Each episode is read into memory at once. If :py:const:`True`,
+        the next episode is read in a background thread while the
+        current one is processed.
+    
+    ``metrics``
+        :py:class:`ReplayMetrics` instance which collects the TD-error.
+        By default, a new one is created with ``err_coefficient``. Pass
+        an instance to get the mean, percentiles and per-episode
+        summaries of the error.
+    
+    ``snapshots``
+        :py:class:`ReplaySnapshots` store. If given, the critic is
+        stored there regularly. Also, the critic continues from the
+        latest stored snapshot before ``episode_start`` and the
+        episodes between the snapshot and ``episode_start`` are
+        replayed. The critic is thus trained as if all episodes
+        before ``episode_start`` had been replayed, which is not the
+        case without snapshots.
         
     :returns: accumulated TD-error average
     
+    """
+    if metrics is not None:
+        metrics = [metrics]
+    if snapshots is not None:
+        snapshots = [snapshots]
+    return offline_playback_multi(pth_data, [critic], samples_per_action, ms_per_step, episode_start, episode_end, min_episode_len, err_coefficient, episode_start_test, prefetch, metrics=metrics, snapshots=snapshots)[0]
+
+def offline_playback_multi(pth_data, critics, samples_per_action, ms_per_step, episode_start=None, episode_end=None, min_episode_len=0, err_coefficient=0.01, episode_start_test=None, prefetch=True, share_plant=True, metrics=None, snapshots=None):
+    """Simulate an experiment run for several ``critics`` by using
+    offline data, see :py:func:`offline_playback`. The data is read
+    and decoded once, then each epoch is fed to all critics in turn.
+    
+    If ``share_plant`` is set, the plant of the first critic computes
+    the reward and state of each epoch once for all critics. This
+    requires all critics to use the same plant configuration and
+    normalization (see :py:func:`plant_config`), and - for plants which
+    keep a history, such as :py:class:`AccelerationReward` - the same
+    number of initial steps. If the critics differ in either, a warning
+    is issued and each critic evaluates its own plant, as it does if
+    ``share_plant`` is not set.
+    
+    ``metrics`` and ``snapshots`` are lists with a
+    :py:class:`ReplayMetrics` and :py:class:`ReplaySnapshots` instance
+    for each critic. The critics are resumed from the latest snapshot
+    all stores have in common. All other arguments are as in
+    :py:func:`offline_playback`.
+    
+    :returns: accumulated TD-error average of each critic, as list
+    
     """
     # Open data file, get valid experiments
-    f = h5py.File(pth_data,'r')
-    storages = map(str, sorted(map(int, f.keys())))
-    storages = filter(lambda s: len(f[s]) > 0, storages)
-    if min_episode_len > 0:
-        storages = filter(lambda s: f[s]['a_curr'].shape[0] > min_episode_len, storages)
-    
-    if episode_end is not None:
-        storages = storages[:episode_end]
-    
-    if episode_start is not None:
-        storages = storages[episode_start:]
-    
-    assert len(storages) > 0
-    
-    if episode_start_test is None:
-        episode_start_test = len(storages)/2 - 1; #use last half for testing 
-    
-    # Prepare critic; redirect hooks to avoid storing epoch data twice
-    # and feed the actions
-    global accError 
-    accError = 0 # accumulated error
-    next_action = None
-    episode = None
-    critic._pre_increment_hook_orig = critic._pre_increment_hook
-    critic._next_action_hook_orig = critic._next_action_hook
-    
-    def pre_increment_hook(epoch, **kwargs):
-        kwargs['offline_episode'] = np.array([episode])
-        critic._pre_increment_hook_orig(dict(), **kwargs)
-        if int(episode) > episode_start_test and kwargs.has_key('err'):
-            global accError
-            accError = accError*(1-err_coefficient) + (kwargs['err'][0][0]**2)*err_coefficient # accumulated squared error
-            #accError = accError*(1-err_coefficient) + np.abs(kwargs['err'][0][0])*err_coefficient # accumulated absolute error
-    
-    def next_action_hook(a_next):
-        #print "(next)", a_next.T, next_action.T
-        return next_action
-    
-    critic._next_action_hook = next_action_hook
-    critic._pre_increment_hook = pre_increment_hook
-    
-    # Main loop, feed data to the critic
-    time_step_ms = ms_per_step * samples_per_action
-    time_start_ms = 0
-    for episode_idx, episode in enumerate(storages):
-        print episode_idx
-        
-        data_grp = f[episode]
-        N = len(data_grp['trg0'])
+    opened = isinstance(pth_data, basestring)
+    if opened:
+        source = _EpisodeFile(pth_data, samples_per_action)
+    else:
+        source = pth_data
+        assert source.samples_per_action == samples_per_action
+    
+    try:
+        storages = source.storages(min_episode_len)
+        
+        if episode_end is not None:
+            storages = storages[:episode_end]
+        
+        if episode_start is None:
+            episode_start = 0
+        
+        assert len(storages[episode_start:]) > 0
+        
+        if episode_start_test is None:
+            episode_start_test = len(storages[episode_start:])/2 - 1; #use last half for testing 
+        
+        # Continue from the latest snapshot before the first episode
+        replay_start = episode_start
+        if snapshots is not None:
+            replay_start = resume_point(snapshots, episode_start)
+            if replay_start > 0:
+                for critic, store in zip(critics, snapshots):
+                    store.restore(critic, replay_start, storages)
+        
+        replayed = storages[replay_start:]
+        
+        # Prepare critics; redirect hooks to avoid storing epoch data twice
+        # and feed the actions
+        if metrics is None:
+            metrics = [ReplayMetrics(err_coefficient) for _ in critics]
+        
+        shared_plant = None
+        if hasattr(source, 'replay_plant'):
+            shared_plant = source.replay_plant(critics)
+        elif share_plant and len(critics) > 1:
+            if _shareable(critics):
+                shared_plant = _SharedPlant(critics[0].plant)
+            else:
+                warnings.warn('The critics differ in their plant or initial steps, the plant is not shared')
+        
+        # Main loop, feed data to the critic
+        time_step_ms = ms_per_step * samples_per_action
+        time_start_ms = 0
+        if prefetch:
+            episodes = _prefetched(source.load_episode, replayed)
+        else:
+            episodes = ((storage, source.load_episode(storage)) for storage in replayed)
+        
+        with ReplayHooks(critics, metrics, shared_plant) as hooks, contextlib.closing(episodes):
+            for episode_idx, (episode, data) in enumerate(episodes):
+                num_episodes = replay_start + episode_idx
+                hooks.begin_episode(episode, test=num_episodes >= episode_start and int(episode) > episode_start_test)
+                
+                time_tumbled = data['time_tumbled']
+                
+                # initial, empty call
+                if data['init_step']:
+                    print "Simulation was started/reverted"
+                    time_start_ms = 0
+                    for critic in critics:
+                        critic(dict(), time_start_ms, time_start_ms + samples_per_action, ms_per_step)
+                    time_tumbled -= samples_per_action
+                
+                # initial action
+                for critic in critics:
+                    critic.a_curr = np.atleast_2d(data['a_curr']).T
+                
+                # loop through data, incrementally feed the critic
+                chunks = data['chunk']
+                for step in range(data['num_steps']):
+                    num_iter = step * samples_per_action
+                    
+                    # next action
+                    hooks.next_action = np.atleast_2d(data['a_next'][step]).T
+                    
+                    # get data
+                    time_start_ms += time_step_ms
+                    time_end_ms = time_start_ms + time_step_ms
+                    chunk = chunks(step)
+                    
+                    for critic in critics:
+                        # send tumbled message
+                        if num_iter == time_tumbled:
+                            #critic.event_handler(None, dict(), time_tumbled, 'tumbled_grace_start')
+                            critic.signal('tumbled_grace_start')
+                        
+                        # update critic
+                        critic(chunk, time_start_ms, time_end_ms, time_step_ms)
+                
+                # send reset after episode has finished
+                if episode_idx < len(replayed) - 1:
+                    for critic in critics:
+                        #critic.event_handler(None, dict(), ms_per_step * N, 'reset')
+                        critic.signal('reset')
+                        critic.signal('new_episode') # collectors will create new group
+                    
+                    # store the critics, ready for the next episode
+                    for critic_idx, store in enumerate(snapshots or []):
+                        if store.due(num_episodes + 1):
+                            with hooks.suspended(critic_idx) as critic:
+                                store.save(critic, num_episodes + 1, storages)
+        
+        return [m.ema for m in metrics]
+    finally:
+        if opened:
+            source.close()
+
+def plant_config(plant):
+    """Return the configuration of ``plant``, i.e. its class and public
+    attributes (including the normalization). Private attributes, such
+    as the history of a plant or compiled feature extractors, are
+    considered runtime state and left out."""
+    cls = type(plant)
+    attributes = sorted([(name, value) for name, value in plant.__dict__.iteritems() if not name.startswith('_')])
+    return (cls.__module__, cls.__name__, attributes)
+
+def _shareable(critics):
+    """Return True if all ``critics`` have the same plant configuration
+    and number of initial steps, such that a :py:class:`_SharedPlant`
+    gives the same results as the individual plants."""
+    config = pickle.dumps(plant_config(critics[0].plant), pickle.HIGHEST_PROTOCOL)
+    for critic in critics[1:]:
+        if critic._init_steps != critics[0]._init_steps:
+            return False
+        if pickle.dumps(plant_config(critic.plant), pickle.HIGHEST_PROTOCOL) != config:
+            return False
+    return True
+
+class _SharedPlant(object):
+    """Wrapper of a ``plant``, which is shared between several critics
+    in :py:func:`offline_playback_multi`. Reward and state are computed
+    once for each epoch, subsequent requests for the same epoch return
+    the stored result. Note that a noisy reward is thus the same for all
+    critics.
+    """
+    def __init__(self, plant):
+        self._plant = plant
+        self._reward = (None, None)
+        self._states = collections.deque(maxlen=2)
+    
+    def __getattr__(self, name):
+        if name.startswith('__') or name == '_plant':
+            raise AttributeError(name)
+        return getattr(self._plant, name)
+    
+    def reward(self, epoch):
+        """Return the reward of ``epoch``."""
+        last, reward = self._reward
+        if last is not epoch:
+            reward = self._plant.reward(epoch)
+            self._reward = (epoch, reward)
+        return reward
+    
+    def state_input(self, state):
+        """Return the state-part of the critic input of ``state``."""
+        for epoch, in_state in self._states:
+            if epoch is state:
+                return in_state
+        in_state = self._plant.state_input(state)
+        self._states.append((state, in_state))
+        return in_state
+
+class _EpisodeFile(object):
+    """Episodes of the HDF5 data file at ``pth``, as source of
+    :py:func:`offline_playback`."""
+    def __init__(self, pth, samples_per_action):
+        self.file = h5py.File(pth, 'r')
+        self.samples_per_action = samples_per_action
+    
+    def close(self):
+        """Close the data file."""
+        self.file.close()
+    
+    def storages(self, min_episode_len=0):
+        """Return the names of the non-empty episodes with more than
+        ``min_episode_len`` steps, in order."""
+        f = self.file
+        storages = map(str, sorted(map(int, f.keys())))
+        storages = filter(lambda s: len(f[s]) > 0, storages)
+        if min_episode_len > 0:
+            storages = filter(lambda s: f[s]['a_curr'].shape[0] > min_episode_len, storages)
+        return storages
+    
+    def load_episode(self, storage):
+        """Read the data of an episode into memory. The sensors are read
+        into a single :py:class:`ColumnarEpoch`, the chunk of a step is
+        a view into it.
+        
+        Returns a :py:keyword:`dict` with the number of steps
+        (*num_steps*), the initial action (*a_curr*), the action of each
+        step (*a_next*), whether the simulation was started or reverted
+        (*init_step*), the sample at which the robot tumbled
+        (*time_tumbled*, -1 if it didn't) and a function which returns
+        the epoch of a step (*chunk*).
+        
+        """
+        data_grp = self.file[storage]
+        samples_per_action = self.samples_per_action
+        sensors = ColumnarEpoch.from_hdf5(data_grp, SENSOR_NAMES)
+        a_next = data_grp['a_next'][:]
         
         # get the stored ratio
-        #db_samples_per_action = N / len(data_grp['a_next'])
-        #assert N % db_samples_per_action == 0
+        N = sensors.data.shape[0]
+        db_samples_per_action = N / a_next.shape[0]
+        assert N % db_samples_per_action == 0
         assert N % samples_per_action == 0
         
         # get tumbled infos
+        time_tumbled = -1
         if 'tumble' in data_grp:
-            from pylab import find 
-            time_tumbled = find(data_grp['tumble'])[0] / samples_per_action * samples_per_action
-            #time_tumbled = data_grp['tumbled'][0] * db_samples_per_action
-            #time_tumbled = data_grp['tumble'][0] * samples_per_action
-        else:
-            time_tumbled = -1
+            time_tumbled = np.flatnonzero(data_grp['tumble'][:])[0] / samples_per_action * samples_per_action
         
-        # initial, empty call
-        if 'init_step' in data_grp:
-            print "Simulation was started/reverted"
-            time_start_ms = 0
-            critic(dict(), time_start_ms, time_start_ms + samples_per_action, ms_per_step)
-            time_tumbled -= samples_per_action
+        def chunk(step):
+            num_iter = step * samples_per_action
+            return ColumnarEpoch(sensors.data[num_iter:(num_iter+samples_per_action)], sensors.columns)
         
-        # initial action
-        critic.a_curr = np.atleast_2d(data_grp['a_curr'][0]).T
+        return {
+            'num_steps'     : N / samples_per_action,
+            'a_curr'        : data_grp['a_curr'][0],
+            'a_next'        : a_next[np.arange(0, N, samples_per_action) / db_samples_per_action],
+            'init_step'     : 'init_step' in data_grp,
+            'time_tumbled'  : time_tumbled,
+            'chunk'         : chunk,
+            }
 
-        # loop through data, incrementally feed the critic
-        for num_iter in np.arange(0, N, samples_per_action):
-            # next action
-            next_action = np.atleast_2d(data_grp['a_next'][num_iter/db_samples_per_action]).T
-            
-            # get data
-            time_start_ms += time_step_ms
-            time_end_ms = time_start_ms + time_step_ms
-            chunk = dict([(k, data_grp[k][num_iter:(num_iter+samples_per_action)]) for k in SENSOR_NAMES])
-            
-            # send tumbled message
-            if num_iter == time_tumbled:
-                #critic.event_handler(None, dict(), time_tumbled, 'tumbled_grace_start')
-                critic.signal('tumbled_grace_start')
-            
-            # update critic
-            critic(chunk, time_start_ms, time_end_ms, time_step_ms)
-        
-        # send reset after episode has finished
-        if episode_idx < len(storages) - 1:
-            #critic.event_handler(None, dict(), ms_per_step * N, 'reset')
-            critic.signal('reset')
-            critic.signal('new_episode') # collectors will create new group
-    
-    # cleanup
-    critic._pre_increment_hook = critic._pre_increment_hook_orig
-    critic._next_action_hook = critic._next_action_hook_orig
-    del critic._pre_increment_hook_orig
-    del critic._next_action_hook_orig
-    
-    return accError
+def _prefetched(load, keys, timeout=0.1):
+    """Return an iterator over ``(key, load(key))`` for all ``keys``.
+    The items are loaded in a background thread, such that the next
+    item is ready when the current one was processed.
+    
+    If the iterator is closed before all items were consumed (e.g.
+    because the consumer raised), the thread stops within ``timeout``
+    seconds.
+    
+    """
+    queue = Queue.Queue(maxsize=1)
+    stop = threading.Event()
+    
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=timeout)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    
+    def worker():
+        for key in keys:
+            if stop.is_set():
+                return
+            try:
+                item = (key, load(key), None)
+            except Exception as e:
+                put((key, None, e))
+                return
+            if not put(item):
+                return
+    
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    
+    try:
+        for _ in keys:
+            key, value, error = queue.get()
+            if error is not None:
+                raise error
+            yield key, value
+    finally:
+        stop.set()
 
 
 ## DEPRECATED ##
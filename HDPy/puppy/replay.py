@@ -0,0 +1,300 @@
+"""
+During an offline replay (see :py:func:`offline_playback`), the
+critics' hooks are redirected: The next action is taken from the data
+instead of the actor, and the temporal difference error of each step is
+collected. Both is done by :py:class:`ReplayHooks`, a context manager
+which installs the hooks on entering and restores the critics on exit,
+also if the replay fails.
+
+The error is collected in a :py:class:`ReplayMetrics` instance per
+critic. All state lives in these objects, hence several replays may run
+concurrently (e.g. in threads), as long as they don't share critics.
+
+To continue a replay at a later episode without replaying all episodes
+before, the critic can be stored regularly in a
+:py:class:`ReplaySnapshots` store. A later replay then resumes from the
+latest snapshot before its first episode.
+
+"""
+from ..checkpoint import wait_checkpoints
+import numpy as np
+import contextlib
+import array
+import json
+import os
+
+class ReplayMetrics(object):
+    """Accumulate the squared temporal difference error of a critic
+    during a replay.
+    
+    ``err_coefficient``
+        Coefficient of the exponential moving average (*ema*) of the
+        squared error.
+    
+    The steps of an episode are only included into the overall
+    statistics (*ema*, :py:meth:`mean`, :py:meth:`percentile`) if the
+    episode is marked as test episode in :py:meth:`begin_episode`.
+    For every episode, a summary is stored in *episodes* regardless.
+    The squared errors of the test episodes are kept for the
+    percentiles (one float per step).
+    
+    """
+    def __init__(self, err_coefficient=0.01):
+        self.err_coefficient = err_coefficient
+        self.ema = 0.0
+        self.episodes = []
+        self._errors = array.array('d')
+        self._current = None
+    
+    def begin_episode(self, episode, test=True):
+        """Start collecting the episode ``episode``. If ``test`` is
+        set, its errors are included into the overall statistics."""
+        self.end_episode()
+        self._current = {
+            'episode'   : episode,
+            'test'      : test,
+            'steps'     : 0,
+            'sum'       : 0.0,
+            'max'       : 0.0,
+            }
+    
+    def add(self, err):
+        """Add the temporal difference error ``err`` of a step."""
+        sq_err = float(err) ** 2
+        current = self._current
+        if current is not None:
+            current['steps'] += 1
+            current['sum'] += sq_err
+            current['max'] = max(current['max'], sq_err)
+            if not current['test']:
+                return
+        
+        self.ema = self.ema * (1.0 - self.err_coefficient) + sq_err * self.err_coefficient
+        self._errors.append(sq_err)
+    
+    def end_episode(self):
+        """Close the current episode and store its summary, i.e. the
+        number of steps (*steps*), mean and maximum squared error
+        (*mse*, *max*) and the moving average at its end (*ema*)."""
+        current, self._current = self._current, None
+        if current is None:
+            return
+        
+        steps = current['steps']
+        self.episodes.append({
+            'episode'   : current['episode'],
+            'test'      : current['test'],
+            'steps'     : steps,
+            'mse'       : current['sum'] / steps if steps > 0 else float('nan'),
+            'max'       : current['max'],
+            'ema'       : self.ema,
+            })
+    
+    def __len__(self):
+        """Return the number of steps in the overall statistics."""
+        return len(self._errors)
+    
+    def mean(self):
+        """Return the mean squared error."""
+        if len(self._errors) == 0:
+            return float('nan')
+        return float(np.frombuffer(self._errors, dtype=float).mean())
+    
+    def percentile(self, q):
+        """Return the ``q``-th percentile(s) of the squared error."""
+        if len(self._errors) == 0:
+            return float('nan')
+        return np.percentile(np.frombuffer(self._errors, dtype=float), q)
+    
+    def summary(self, percentiles=(50, 90, 99)):
+        """Return the overall statistics as :py:keyword:`dict`."""
+        summary = {
+            'steps' : len(self),
+            'ema'   : self.ema,
+            'mse'   : self.mean(),
+            }
+        for q in percentiles:
+            summary['p%g' % q] = float(self.percentile(q)) if len(self) > 0 else float('nan')
+        return summary
+
+class ReplayHooks(object):
+    """Context manager which redirects the hooks of ``critics`` for a
+    replay.
+    
+    While active, :py:meth:`ActorCritic._next_action_hook` returns
+    *next_action* (to be set before each step) and the error passed to
+    :py:meth:`ActorCritic._pre_increment_hook` is added to the
+    respective entry of ``metrics``. The original pre-increment hook
+    is still invoked, with an empty epoch and the *offline_episode*
+    added to its arguments.
+    
+    If a ``plant`` is given, it temporarily replaces the plant of all
+    critics.
+    
+    """
+    def __init__(self, critics, metrics, plant=None):
+        assert len(critics) == len(metrics)
+        self.critics = critics
+        self.metrics = metrics
+        self.plant = plant
+        self.next_action = None
+        self.episode = None
+        self._saved = None
+    
+    def begin_episode(self, episode, test=True):
+        """Mark the start of ``episode`` in the hooks and metrics."""
+        self.episode = episode
+        for metrics in self.metrics:
+            metrics.begin_episode(episode, test)
+    
+    def _pre_increment_hook(self, critic, metrics):
+        """Return the pre-increment hook of ``critic``."""
+        hook_orig = critic._pre_increment_hook
+        def hook(epoch, **kwargs):
+            kwargs['offline_episode'] = np.array([self.episode])
+            hook_orig(dict(), **kwargs)
+            if 'err' in kwargs:
+                metrics.add(kwargs['err'][0][0])
+        return hook
+    
+    @contextlib.contextmanager
+    def suspended(self, critic_idx):
+        """Temporarily restore the hooks and plant of the critic at
+        ``critic_idx``, e.g. to store it."""
+        critic, hooks, plant = self._saved[critic_idx]
+        installed = (critic._pre_increment_hook, critic._next_action_hook, critic.plant)
+        del critic._pre_increment_hook
+        del critic._next_action_hook
+        critic.__dict__.update(hooks)
+        critic.plant = plant
+        try:
+            yield critic
+        finally:
+            critic._pre_increment_hook, critic._next_action_hook, critic.plant = installed
+    
+    def _next_action_hook(self, a_next):
+        """Return the action of the data instead of ``a_next``."""
+        return self.next_action
+    
+    def __enter__(self):
+        # Hooks which were not set on the instance are removed again
+        # afterwards, as bound methods stored in the instance prevent
+        # pickling
+        self._saved = []
+        for critic, metrics in zip(self.critics, self.metrics):
+            hooks = dict([(name, critic.__dict__[name]) for name in ('_pre_increment_hook', '_next_action_hook') if name in critic.__dict__])
+            self._saved.append((critic, hooks, critic.plant))
+            critic._pre_increment_hook = self._pre_increment_hook(critic, metrics)
+            critic._next_action_hook = self._next_action_hook
+            if self.plant is not None:
+                critic.plant = self.plant
+        
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        for critic, hooks, plant in self._saved:
+            del critic._pre_increment_hook
+            del critic._next_action_hook
+            critic.__dict__.update(hooks)
+            critic.plant = plant
+        
+        for metrics in self.metrics:
+            metrics.end_episode()
+        
+        self._saved = None
+        return False
+
+class ReplaySnapshots(object):
+    """Store of critic snapshots, taken during a replay.
+    
+    ``pth``
+        Directory of the store, e.g. next to the data file. It's
+        created if it doesn't exist.
+    
+    ``every``
+        Number of episodes between two snapshots.
+    
+    A snapshot is the checkpoint (see
+    :py:meth:`ActorCritic.save_checkpoint`) of the critic after a
+    number of episodes, hence it contains the reservoir, readout and
+    counters. It's identified by the number of episodes replayed
+    before. The snapshots are written in the background.
+    
+    The names of the replayed episodes are stored with the snapshots.
+    When resuming, they're compared to the episodes of the data. The
+    configuration of the critic is not checked, a store must only be
+    used with the same critic setup.
+    
+    """
+    META_FILE = 'episodes.json'
+    
+    def __init__(self, pth, every=10):
+        self.pth = pth
+        self.every = every
+        if not os.path.exists(pth):
+            os.makedirs(pth)
+    
+    def path(self, num_episodes):
+        """Return the path of the snapshot after ``num_episodes``."""
+        return os.path.join(self.pth, 'episode_%06i' % num_episodes)
+    
+    def available(self):
+        """Return the episode numbers of all stored snapshots."""
+        nums = []
+        for name in os.listdir(self.pth):
+            prefix, _, num = name.partition('_')
+            if prefix == 'episode' and num.isdigit():
+                nums.append(int(num))
+        return sorted(nums)
+    
+    def due(self, num_episodes):
+        """Return :py:const:`True` if a snapshot should be taken after
+        ``num_episodes`` but doesn't exist yet."""
+        return num_episodes % self.every == 0 and not os.path.exists(self.path(num_episodes))
+    
+    def save(self, critic, num_episodes, storages):
+        """Store ``critic`` as snapshot after ``num_episodes``. The
+        ``storages`` are the names of the episodes replayed so far."""
+        self._write_meta(storages[:num_episodes])
+        critic.save_checkpoint(self.path(num_episodes), background=True)
+    
+    def restore(self, critic, num_episodes, storages):
+        """Reset ``critic`` to the snapshot after ``num_episodes``. The
+        ``storages`` are the episode names of the data."""
+        wait_checkpoints()
+        stored = self._read_meta()
+        if stored[:num_episodes] != list(storages[:num_episodes]):
+            raise Exception('The snapshots in %s were taken on different episodes' % self.pth)
+        critic.restore_checkpoint(self.path(num_episodes))
+    
+    def _read_meta(self):
+        """Return the stored episode names."""
+        pth = os.path.join(self.pth, self.META_FILE)
+        if not os.path.exists(pth):
+            return []
+        f = open(pth, 'r')
+        storages = json.load(f)
+        f.close()
+        return storages
+    
+    def _write_meta(self, storages):
+        """Store the episode names, if they extend the stored ones."""
+        stored = self._read_meta()
+        if len(storages) <= len(stored):
+            return
+        if stored != list(storages[:len(stored)]):
+            raise Exception('The snapshots in %s were taken on different episodes' % self.pth)
+        
+        pth = os.path.join(self.pth, self.META_FILE)
+        f = open(pth + '.tmp', 'w')
+        json.dump(list(storages), f)
+        f.close()
+        os.rename(pth + '.tmp', pth)
+
+def resume_point(snapshots, episode):
+    """Return the largest episode number up to ``episode`` for which
+    all stores in ``snapshots`` hold a snapshot (0 if there's none)."""
+    common = set(snapshots[0].available())
+    for store in snapshots[1:]:
+        common &= set(store.available())
+    return max([num for num in common if num <= episode] + [0])
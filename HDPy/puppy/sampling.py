@@ -0,0 +1,282 @@
+"""
+The data gathered by :py:class:`OfflineCollector` is only as good as
+the actions it explores. This module provides action samplers which can
+be plugged into the collector (``sampler`` argument). A sampler is
+called with the current action (Ax1 vector) and returns the next one.
+
+All samplers respect the feasible region of the gait, which is given
+as a function of an (KxA) matrix of actions that returns a boolean
+vector. The default (:py:func:`puppy_feasible`) implements the amplitude
+constraints of Puppy. Candidates are generated and checked in batches,
+hence there's no per-sample loop.
+
+:py:class:`TruncatedNormalSampler`
+    Random walk: Gaussian perturbation of the current action,
+    restricted to the feasible region.
+
+:py:class:`HaltonSampler`, :py:class:`SobolSampler`
+    Low-discrepancy sequences, which cover the feasible part of the
+    action box evenly (independent of the current action).
+
+:py:class:`CoverageSampler`
+    Random walk, which picks among several feasible candidates the one
+    in the least visited region of the action space.
+
+The coverage of the action space is tracked by an
+:py:class:`ActionCoverage` instance, which reports it per simulated
+hour.
+
+"""
+from ..hdp import halton_sequence
+import numpy as np
+import warnings
+
+def puppy_feasible(actions):
+    """Return which rows of the (KxA) matrix ``actions`` satisfy the
+    amplitude constraints of Puppy: All amplitudes lie within [0.2,
+    2.0] and if one exceeds 1.0, the amplitudes may differ by at most
+    0.4."""
+    in_range = ((actions >= 0.2) & (actions <= 2.0)).all(axis=1)
+    spread = (actions > 1.0).any(axis=1) & (actions.ptp(axis=1) > 0.4)
+    return in_range & ~spread
+
+def _keep_action(a_curr, feasible):
+    """Fallback of the samplers if no feasible action was found: Return
+    a copy of ``a_curr`` if it's ``feasible``, raise an exception
+    otherwise."""
+    if not feasible(a_curr.T)[0]:
+        raise Exception('No feasible action found and the current action is infeasible')
+    warnings.warn('No feasible action found, keeping the current one')
+    return a_curr.copy()
+
+class TruncatedNormalSampler(object):
+    """Add a Gaussian perturbation with standard deviation ``sigma`` to
+    the current action, restricted to the ``feasible`` region.
+    
+    In each round, ``batch`` candidates are drawn at once and the first
+    feasible one is returned, which gives the same distribution as
+    drawing one by one. If no candidate is feasible after
+    ``max_rounds``, the current action is kept (with a warning). If
+    it's infeasible as well, an exception is raised. ``rnd`` is an optional
+    :py:class:`numpy.random.RandomState`.
+    
+    """
+    def __init__(self, sigma=0.15, feasible=puppy_feasible, batch=32, max_rounds=100, rnd=None):
+        self.sigma = sigma
+        self.feasible = feasible
+        self.batch = batch
+        self.max_rounds = max_rounds
+        self.rnd = np.random if rnd is None else rnd
+    
+    def candidates(self, a_curr, num):
+        """Return ``num`` feasible perturbations of ``a_curr`` as rows
+        of a matrix. Less are returned if ``max_rounds`` is exceeded."""
+        found = []
+        num_found = 0
+        for _ in xrange(self.max_rounds):
+            cand = a_curr.T + self.rnd.normal(0.0, self.sigma, size=(self.batch, a_curr.shape[0]))
+            cand = cand[self.feasible(cand)]
+            found.append(cand)
+            num_found += cand.shape[0]
+            if num_found >= num:
+                break
+        
+        return np.vstack(found)[:num]
+    
+    def __call__(self, a_curr):
+        cand = self.candidates(a_curr, 1)
+        if cand.shape[0] == 0:
+            return _keep_action(a_curr, self.feasible)
+        return cand[0][:, np.newaxis]
+
+class _SequenceSampler(object):
+    """Base class of the low-discrepancy samplers. The points of the
+    sequence in the unit cube are scaled into the action box [``low``,
+    ``high``] and infeasible points are skipped. ``batch`` points are
+    generated at once. If none of ``max_rounds`` batches holds a
+    feasible point, the current action is kept as in
+    :py:class:`TruncatedNormalSampler`."""
+    def __init__(self, low=0.2, high=2.0, feasible=puppy_feasible, start=1, batch=256, max_rounds=100):
+        self.low = low
+        self.high = high
+        self.feasible = feasible
+        self.index = start
+        self.batch = batch
+        self.max_rounds = max_rounds
+        self._pending = []
+    
+    def _points(self, num, dim, start):
+        """Return ``num`` points of the sequence in the unit cube."""
+        raise NotImplementedError()
+    
+    def __call__(self, a_curr):
+        for _ in xrange(self.max_rounds):
+            if len(self._pending) > 0:
+                break
+            points = self._points(self.batch, a_curr.shape[0], self.index)
+            self.index += self.batch
+            points = self.low + points * (np.asarray(self.high) - self.low)
+            self._pending = list(points[self.feasible(points)][::-1])
+        
+        if len(self._pending) == 0:
+            return _keep_action(a_curr, self.feasible)
+        return self._pending.pop()[:, np.newaxis]
+
+class HaltonSampler(_SequenceSampler):
+    """Cover the feasible part of the action box [``low``, ``high``]
+    with the Halton sequence, see :py:func:`halton_sequence`.
+    """
+    def _points(self, num, dim, start):
+        return halton_sequence(num, dim, start - 1)
+
+# Direction numbers of Joe and Kuo (new-joe-kuo-6.21201) for the
+# dimensions 2 to 11: degree s, coefficients a and initial numbers m
+_SOBOL_DIRECTIONS = (
+    (1, 0, (1, )),
+    (2, 1, (1, 3)),
+    (3, 1, (1, 3, 1)),
+    (3, 2, (1, 1, 1)),
+    (4, 1, (1, 1, 3, 3)),
+    (4, 4, (1, 3, 5, 13)),
+    (5, 2, (1, 1, 5, 5, 17)),
+    (5, 4, (1, 1, 5, 5, 5)),
+    (5, 7, (1, 1, 7, 11, 19)),
+    (5, 11, (1, 1, 5, 1, 1)),
+    )
+
+_SOBOL_BITS = 32
+
+def _sobol_direction_vectors(dim):
+    """Return the (dim x bits) direction vectors of the Sobol sequence,
+    as integers scaled by 2**bits."""
+    if dim > len(_SOBOL_DIRECTIONS) + 1:
+        raise Exception('The Sobol sequence is available for up to %i dimensions' % (len(_SOBOL_DIRECTIONS) + 1))
+    
+    bits = _SOBOL_BITS
+    vectors = np.zeros((dim, bits), dtype=np.uint64)
+    # First dimension: van der Corput sequence
+    vectors[0] = [1 << (bits - 1 - k) for k in range(bits)]
+    for row, (s, a, m) in enumerate(_SOBOL_DIRECTIONS[:dim - 1]):
+        v = [m_k << (bits - 1 - k) for k, m_k in enumerate(m)]
+        for k in range(s, bits):
+            value = v[k - s] ^ (v[k - s] >> s)
+            for j in range(1, s):
+                value ^= ((a >> (s - 1 - j)) & 1) * v[k - j]
+            v.append(value)
+        vectors[row + 1] = v[:bits]
+    return vectors
+
+def sobol_sequence(num, dim, start=0):
+    """Return ``num`` points of the ``dim``-dimensional Sobol sequence
+    (in Gray code order), starting at index ``start``. The points lie in
+    the unit cube and are returned as (num x dim) matrix. The first
+    point (index 0) is the origin.
+    """
+    vectors = _sobol_direction_vectors(dim)
+    idx = np.arange(start, start + num, dtype=np.uint64)
+    gray = idx ^ (idx >> np.uint64(1))
+    points = np.zeros((num, dim), dtype=np.uint64)
+    for k in range(_SOBOL_BITS):
+        bit = ((gray >> np.uint64(k)) & np.uint64(1)).astype(bool)
+        points[bit] ^= vectors[:, k]
+    return points / float(1 << _SOBOL_BITS)
+
+class SobolSampler(_SequenceSampler):
+    """Cover the feasible part of the action box [``low``, ``high``]
+    with the Sobol sequence, see :py:func:`sobol_sequence`. The origin
+    is skipped by default (``start``).
+    """
+    def _points(self, num, dim, start):
+        return sobol_sequence(num, dim, start)
+
+class CoverageSampler(object):
+    """Random walk which prefers rarely visited actions.
+    
+    Of ``num_candidates`` feasible perturbations of the current action
+    (see :py:class:`TruncatedNormalSampler`), the one in the cell of
+    ``coverage`` (:py:class:`ActionCoverage`) with the fewest visits is
+    chosen (ties are broken randomly). The coverage is updated by the
+    :py:class:`OfflineCollector`, if it's passed there as well. If no
+    candidate is found, the current action is kept as in
+    :py:class:`TruncatedNormalSampler`.
+    
+    """
+    def __init__(self, coverage, sigma=0.15, num_candidates=16, feasible=puppy_feasible, rnd=None):
+        self.coverage = coverage
+        self.num_candidates = num_candidates
+        self.rnd = np.random if rnd is None else rnd
+        self.proposal = TruncatedNormalSampler(sigma, feasible, batch=2*num_candidates, rnd=self.rnd)
+    
+    def __call__(self, a_curr):
+        cand = self.proposal.candidates(a_curr, self.num_candidates)
+        if cand.shape[0] == 0:
+            return _keep_action(a_curr, self.proposal.feasible)
+        
+        visits = self.coverage.visits(cand)
+        best = np.flatnonzero(visits == visits.min())
+        return cand[best[self.rnd.randint(len(best))]][:, np.newaxis]
+
+class ActionCoverage(object):
+    """Track which regions of the action space were explored.
+    
+    The action box [``low``, ``high``] of dimension ``dim`` is divided
+    into ``bins`` cells per dimension. The cells whose center is
+    ``feasible`` make up the feasible region. Each sampled action is
+    counted in its cell, together with the simulated time.
+    
+    """
+    def __init__(self, dim, low=0.2, high=2.0, bins=5, feasible=puppy_feasible):
+        self.dim = dim
+        self.low = np.ones(dim) * low
+        self.high = np.ones(dim) * high
+        self.bins = bins
+        self.counts = np.zeros((bins, ) * dim, dtype=int)
+        centers = (np.indices(self.counts.shape).reshape(dim, -1).T + 0.5) / bins
+        self.feasible_cells = feasible(self.low + centers * (self.high - self.low)).reshape(self.counts.shape)
+        self.time_ms = 0
+        self._hours = []
+    
+    def cells(self, actions):
+        """Return the flat cell indices of the rows of ``actions``."""
+        pos = (actions - self.low) / (self.high - self.low) * self.bins
+        pos = np.clip(pos.astype(int), 0, self.bins - 1)
+        return np.ravel_multi_index(pos.T, self.counts.shape)
+    
+    def visits(self, actions):
+        """Return the visit counts of the cells of ``actions`` (rows)."""
+        return self.counts.flat[self.cells(actions)]
+    
+    def add(self, action, duration_ms):
+        """Count the ``action`` (Ax1), which is executed for
+        ``duration_ms`` of simulated time."""
+        hour = int(self.time_ms // 3600000)
+        while len(self._hours) <= hour:
+            self._hours.append([0, 0])
+        
+        cell = self.cells(np.atleast_2d(action.ravel()))[0]
+        if self.counts.flat[cell] == 0 and self.feasible_cells.flat[cell]:
+            self._hours[hour][1] += 1
+        self.counts.flat[cell] += 1
+        self._hours[hour][0] += 1
+        self.time_ms += duration_ms
+    
+    def coverage(self):
+        """Return the fraction of feasible cells visited so far."""
+        return float((self.counts[self.feasible_cells] > 0).sum()) / self.feasible_cells.sum()
+    
+    def report(self):
+        """Return the coverage per simulated hour, as list of
+        :py:keyword:`dict` with the hour, the number of actions, the
+        number of newly visited cells and the cumulative fraction of
+        visited feasible cells."""
+        num_feasible = float(self.feasible_cells.sum())
+        report, visited = [], 0
+        for hour, (num_actions, new_cells) in enumerate(self._hours):
+            visited += new_cells
+            report.append({
+                'hour'      : hour,
+                'actions'   : num_actions,
+                'new_cells' : new_cells,
+                'coverage'  : visited / num_feasible,
+                })
+        return report
@@ -0,0 +1,207 @@
+"""
+Offline data is commonly used to compare critic configurations, e.g.
+for different values of *gamma*, *alpha*, the reservoir size or the RLS
+forgetting factor. :py:class:`Sweep` runs
+:py:func:`offline_playback` for a list of configurations in a process
+pool. The configurations are either the full expansion of a parameter
+grid (:py:func:`expand_grid`) or a random sample of a parameter space
+(:py:func:`sample_configs`).
+
+The critic of a configuration is created by a user-defined function,
+which is passed the configuration as :py:keyword:`dict`. As the
+function is sent to the worker processes, it must be picklable (i.e.
+defined at module level). The workers open the data file read-only,
+hence its pages are shared through the operating system's cache.
+Instead of the data file, the directory of a stored
+:py:class:`ReplayCache` may be given. It's memory-mapped by the
+workers.
+
+Each finished configuration is stored as JSON record in the output
+directory. A sweep which was interrupted is resumed by running it
+again with the same output directory - configurations with a record
+are skipped. :py:meth:`Sweep.gather` collects all records into a table
+(also written as CSV).
+
+"""
+from puppy import offline_playback
+from cache import ReplayCache
+import numpy as np
+import itertools
+import multiprocessing
+import hashlib
+import json
+import time
+import csv
+import os
+
+def expand_grid(grid):
+    """Return a list of all configurations in the parameter ``grid``,
+    a :py:keyword:`dict` which maps the parameter names to lists of
+    values.
+    
+    >>> expand_grid({'gamma': [0.5, 0.9], 'alpha': [1.0]})
+    [{'alpha': 1.0, 'gamma': 0.5}, {'alpha': 1.0, 'gamma': 0.9}]
+    
+    """
+    keys = sorted(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+def sample_configs(space, num, rnd=None):
+    """Return ``num`` random configurations from the parameter
+    ``space``. The space maps parameter names to either a list of
+    values (from which one is chosen uniformly) or a tuple (*low*,
+    *high*), specifying a uniform distribution over the interval. If
+    both bounds are integers (e.g. for the reservoir size), an integer
+    is drawn from *low* to *high* (inclusive).
+    ``rnd`` is an optional :py:class:`numpy.random.RandomState`.
+    """
+    if rnd is None:
+        rnd = np.random
+    
+    configs = []
+    for _ in range(num):
+        config = {}
+        for key in sorted(space.keys()):
+            values = space[key]
+            if isinstance(values, tuple):
+                low, high = values
+                if isinstance(low, (int, long)) and isinstance(high, (int, long)):
+                    config[key] = int(rnd.randint(low, high + 1))
+                else:
+                    config[key] = float(rnd.uniform(low, high))
+            else:
+                config[key] = values[rnd.randint(len(values))]
+        configs.append(config)
+    return configs
+
+def config_key(config):
+    """Return an identifier of ``config``, which is used as name of its
+    record."""
+    return hashlib.md5(json.dumps(config, sort_keys=True)).hexdigest()[:16]
+
+def _run_config(args):
+    """Worker of :py:class:`Sweep`. Run the playback for a single
+    configuration and store its record."""
+    build_critic, config, pth_data, pth_out, playback_kwargs, store_critic = args
+    key = config_key(config)
+    time_start = time.time()
+    critic = build_critic(config)
+    if os.path.isdir(pth_data):
+        pth_data = ReplayCache.load(pth_data)
+    error = offline_playback(pth_data, critic, **playback_kwargs)
+    if store_critic:
+        critic.save_checkpoint(os.path.join(pth_out, key), background=False)
+    
+    record = {
+        'key'       : key,
+        'config'    : config,
+        'error'     : float(error),
+        'duration'  : time.time() - time_start,
+        }
+    
+    pth = os.path.join(pth_out, key + '.json')
+    f = open(pth + '.tmp', 'w')
+    json.dump(record, f, sort_keys=True)
+    f.close()
+    os.rename(pth + '.tmp', pth)
+    return record
+
+class Sweep(object):
+    """Run :py:func:`offline_playback` for a list of configurations.
+    
+    ``pth_data``
+        Path to the offline data (HDF5), see :py:func:`offline_playback`,
+        or to a stored :py:class:`ReplayCache`.
+    
+    ``build_critic``
+        Function which returns a new critic for a configuration. Must
+        be picklable.
+    
+    ``configs``
+        List of configurations (:py:keyword:`dict`). Their values must
+        be JSON serializable.
+    
+    ``pth_out``
+        Directory of the records. It's created if it doesn't exist.
+    
+    ``store_critic``
+        Store the trained critic of each configuration as checkpoint
+        (see :py:meth:`ActorCritic.save_checkpoint`) next to its record.
+    
+    Further keyword arguments are passed to :py:func:`offline_playback`
+    (e.g. ``samples_per_action`` and ``ms_per_step``).
+    
+    """
+    def __init__(self, pth_data, build_critic, configs, pth_out, store_critic=False, **playback_kwargs):
+        self.pth_data = pth_data
+        self.build_critic = build_critic
+        self.configs = list(configs)
+        self.pth_out = pth_out
+        self.store_critic = store_critic
+        self.playback_kwargs = playback_kwargs
+        if not os.path.exists(pth_out):
+            os.makedirs(pth_out)
+    
+    def pending(self):
+        """Return the configurations without a record."""
+        return [config for config in self.configs if not os.path.exists(os.path.join(self.pth_out, config_key(config) + '.json'))]
+    
+    def run(self, processes=None, callback=None):
+        """Run the playback for all pending configurations in a pool of
+        ``processes`` workers (default is the number of CPUs). Return
+        the table of all records, see :py:meth:`gather`. If given,
+        ``callback`` is called with the record of each finished
+        configuration, e.g. to report the progress."""
+        args = [(self.build_critic, config, self.pth_data, self.pth_out, self.playback_kwargs, self.store_critic) for config in self.pending()]
+        if len(args) > 0:
+            if processes == 1:
+                records = itertools.imap(_run_config, args)
+                pool = None
+            else:
+                pool = multiprocessing.Pool(processes)
+                records = pool.imap_unordered(_run_config, args)
+            
+            try:
+                for record in records:
+                    if callback is not None:
+                        callback(record)
+                if pool is not None:
+                    pool.close()
+            except:
+                if pool is not None:
+                    pool.terminate()
+                raise
+            finally:
+                if pool is not None:
+                    pool.join()
+        
+        return self.gather()
+    
+    def gather(self, pth_csv=None):
+        """Collect the records of all configurations of the sweep.
+        Return a list of rows (:py:keyword:`dict`), each with the
+        configuration's parameters, *error*, *duration* and *key*. The
+        table is also written as CSV to ``pth_csv`` (default:
+        *results.csv* in the output directory)."""
+        rows = []
+        for config in self.configs:
+            pth = os.path.join(self.pth_out, config_key(config) + '.json')
+            if not os.path.exists(pth):
+                continue
+            f = open(pth, 'r')
+            record = json.load(f)
+            f.close()
+            row = dict(record['config'])
+            row.update(key=record['key'], error=record['error'], duration=record['duration'])
+            rows.append(row)
+        
+        if pth_csv is None:
+            pth_csv = os.path.join(self.pth_out, 'results.csv')
+        
+        params = sorted(set(itertools.chain(*[config.keys() for config in self.configs])))
+        f = open(pth_csv, 'wb')
+        writer = csv.DictWriter(f, params + ['error', 'duration', 'key'])
+        writer.writeheader()
+        writer.writerows(rows)
+        f.close()
+        return rows
@@ -522,6 +522,88 @@ class ReservoirNode(object):
         # Return the updated reservoir state
         return states
     
+    def step(self, x, simulate=False, out=None):
+        """Execute a single time step with input ``x``.
+        
+        The result is identical to :py:meth:`execute` with a single
+        observation, but no intermediate state matrix is built. If
+        ``out`` is given (a 1xN array), the new state is written into it
+        and no array is allocated for the result.
+        
+        ``x``
+            Input sample. Array of shape (1, ``input_dim``).
+        
+        ``simulate``
+            If :py:const:`True`, the state won't be updated.
+        
+        ``out``
+            Optional output buffer of shape (1, ``output_dim``).
+        
+        """
+        if self.reset_states or type(self)._post_update_hook != ReservoirNode._post_update_hook:
+            # Fall back to the general implementation
+            states = self.execute(x, simulate=simulate)
+            if out is None:
+                return states
+            out[...] = states
+            return out
+        
+        if not self._is_initialized:
+            self.initialize()
+        
+        self._check_input(x)
+        
+        if out is None:
+            out = np.empty((1, self.output_dim))
+        
+        out[0] = self.w * self.states[-1, :]
+        out[0] += self.w_in * x[0]
+        out += self.w_bias
+        if isinstance(self.nonlin_func, np.ufunc):
+            self.nonlin_func(out, out=out)
+        else:
+            out[...] = self.nonlin_func(out)
+        
+        if not simulate:
+            # The state buffer is never handed out, thus can be reused
+            state_buf = getattr(self, '_state_buf', None)
+            if state_buf is None or state_buf.shape != out.shape:
+                state_buf = self._state_buf = np.empty(out.shape)
+            state_buf[...] = out
+            self.states = state_buf
+        
+        return out
+    
+    def execute_batch(self, x):
+        """Compute the next reservoir state for several alternative
+        inputs ``x`` at once.
+        
+        In contrast to :py:meth:`execute`, the rows of ``x`` are not
+        a time series but independent alternatives, each of which is
+        applied to the current reservoir state. All of them are
+        processed in a single pass. The reservoir state is never
+        updated (as with *simulate* in :py:meth:`execute`) and
+        :py:meth:`_post_update_hook` is not invoked.
+        
+        ``x``
+            Input alternatives. Variables in columns, alternatives in
+            rows, i.e. if C,M = x.shape then M == ``input_dim``.
+        
+        Returns a CxN matrix with the resulting state of each
+        alternative in its rows.
+        
+        """
+        if not self._is_initialized:
+            self.initialize()
+        
+        self._check_input(x)
+        
+        # Contribution of the current state is shared by all alternatives
+        r_base = self.w * self.states[-1, :] + self.w_bias # 1xN
+        r_pre = (self.w_in * x.T).T # CxN
+        r_pre += r_base
+        return self.nonlin_func(r_pre)
+    
     def reset(self):
         """Reset the reservoir states to the initial value."""
         self.states = np.zeros((1, self.output_dim))
@@ -734,12 +816,19 @@ class PlainRLS(object):
             self._psi_inv -= gain.dot(sample_i.T.dot(self._psi_inv))
             self._psi_inv /= self.lambda_
     
-    def __call__(self, x):
+    def __call__(self, x, out=None):
         """Evaluate the linear approximation on some point ``x``.
+        
+        The bias is added separately, hence ``x`` is not copied. If
+        ``out`` is given (a Kxoutput_dim array), the result is written
+        into it.
         """
-        if self.with_bias:
-            x = self._add_constant(x)
-        return self.beta.T.dot(x.T).T
+        if not self.with_bias:
+            return np.dot(x, self.beta, out=out)
+        
+        pred = np.dot(x, self.beta[1:], out=out)
+        pred += self.beta[0]
+        return pred
     
     def _add_constant(self, x):
         """Add a constant term to the vector 'x'.
@@ -27,6 +27,11 @@ has to be generated to actually steer the robot.
 import PuPy
 import numpy as np
 import cPickle as pickle
+import bisect
+import collections
+import time
+from features import FeatureExtractor
+from checkpoint import save_checkpoint, load_checkpoint
 
 class Plant(object):
     """A template for Actor-Critic *plants*. The *Plant* describes the
@@ -36,7 +41,16 @@ class Plant(object):
     
     An additional instance to :py:class:`PuPy.Normalization` may be 
     supplied in ``norm`` for normalizing sensor values.
+    
+    Instead of implementing :py:meth:`state_input`, a plant may
+    describe its state declaratively by setting :py:attr:`FEATURES` to
+    a list of :py:class:`FeatureSpec` instances. The specs are compiled
+    into a :py:class:`FeatureExtractor` whenever the normalization is
+    set.
     """
+    FEATURES = None
+    _features = None # Default for plants stored before features existed
+    
     def __init__(self, state_space_dim=None, norm=None):
         self._state_space_dim = state_space_dim
         self.normalization = None
@@ -55,8 +69,16 @@ class Plant(object):
         and *action*, this method must only return the *state* part of
         it.
         
+        If :py:attr:`FEATURES` is set, the state is extracted according
+        to the feature specs. Otherwise, the method must be implemented
+        by the plant.
+        
         """
-        raise NotImplementedError()
+        if self.FEATURES is None:
+            raise NotImplementedError()
+        if self._features is None:
+            self._features = FeatureExtractor(self.FEATURES, self.normalization)
+        return self._features(state)
     
     def reward(self, epoch):
         """A reward generated by the *Plant* based on the current
@@ -73,7 +95,9 @@ class Plant(object):
         :py:meth:`state_input`.
         """
         if self._state_space_dim is None:
-            raise NotImplementedError()
+            if self.FEATURES is None:
+                raise NotImplementedError()
+            return sum([len(spec) for spec in self.FEATURES])
         return self._state_space_dim
     
     def set_normalization(self, norm):
@@ -81,6 +105,8 @@ class Plant(object):
         if norm is None:
             norm = PuPy.Normalization()
         self.normalization = norm
+        if self.FEATURES is not None:
+            self._features = FeatureExtractor(self.FEATURES, norm)
     
     def reset(self):
         """Reset plant to initial state."""
@@ -234,6 +260,188 @@ class RadialMomentum(Momentum):
         imag_r = self._value * imag_0 + (1.0 - self._value) * imag_1
         return np.angle(imag_r) % (2*np.pi)
 
+class PhaseTimer(object):
+    """Accumulate the wall-clock time spent in named phases of the
+    control loop.
+    
+    A phase is measured by taking a mark with :py:meth:`tic` and
+    passing it to :py:meth:`toc` at its end. As :py:meth:`toc` returns
+    a new mark, consecutive phases can be chained:
+    
+    >>> t = timer.tic()
+    >>> reward = plant.reward(epoch)
+    >>> t = timer.toc('reward', t)
+    
+    Phases may be nested. The durations are exclusive, i.e. the time
+    of a phase which is measured within another one is only accounted
+    to the inner phase. Hence, the durations of all phases add up to
+    the measured total.
+    
+    For each phase, the number of calls, the total and maximum duration
+    and a histogram of the durations are kept. Further, the durations
+    are summed per episode (see :py:meth:`new_episode`).
+    
+    ``bins``
+        Upper bin edges of the histograms, in seconds. The last bin
+        counts durations beyond the last edge. Default are logarithmic
+        bins from 1 microsecond to 10 seconds.
+    
+    """
+    def __init__(self, bins=None):
+        if bins is None:
+            bins = np.logspace(-6, 1, 29)
+        self.bins = [float(edge) for edge in bins]
+        self.reset()
+    
+    def reset(self):
+        """Clear all measurements."""
+        self.phases = []
+        self.counts = {}
+        self.totals = {}
+        self.maxima = {}
+        self.histograms = {}
+        self.episode = {}
+        self.episodes = []
+        self._accounted = 0.0
+    
+    def tic(self):
+        """Return a mark of the current time, to be passed to
+        :py:meth:`toc`."""
+        return (time.time(), self._accounted)
+    
+    def toc(self, phase, start):
+        """Account the time since the mark ``start`` to ``phase``,
+        without the time of phases which were measured meanwhile.
+        Returns a new mark."""
+        now = time.time()
+        time_start, accounted = start
+        duration = (now - time_start) - (self._accounted - accounted)
+        self._accounted += duration
+        if phase not in self.counts:
+            self.phases.append(phase)
+            self.counts[phase] = 0
+            self.totals[phase] = 0.0
+            self.maxima[phase] = 0.0
+            self.histograms[phase] = np.zeros(len(self.bins) + 1, dtype=int)
+        
+        self.counts[phase] += 1
+        self.totals[phase] += duration
+        self.maxima[phase] = max(self.maxima[phase], duration)
+        self.histograms[phase][bisect.bisect_left(self.bins, duration)] += 1
+        self.episode[phase] = self.episode.get(phase, 0.0) + duration
+        return (now, self._accounted)
+    
+    def new_episode(self):
+        """Close the durations of the current episode. They're appended
+        to *episodes* (a :py:keyword:`dict` of the total duration per
+        phase) and returned. If nothing was measured, :py:const:`None`
+        is returned instead."""
+        episode, self.episode = self.episode, {}
+        if len(episode) == 0:
+            return None
+        self.episodes.append(episode)
+        return episode
+    
+    def histogram(self, phase):
+        """Return the histogram of ``phase`` as tuple (counts, edges).
+        The last count is for durations beyond the last edge."""
+        return self.histograms[phase].copy(), np.array(self.bins)
+    
+    def summary(self):
+        """Return a :py:keyword:`dict` with a tuple (calls, total,
+        mean, maximum) for each phase. Durations are in seconds."""
+        return dict((phase, (self.counts[phase], self.totals[phase], self.totals[phase] / self.counts[phase], self.maxima[phase])) for phase in self.phases)
+    
+    def __str__(self):
+        lines = ['%-12s %8s %12s %12s %12s' % ('phase', 'calls', 'total [s]', 'mean [ms]', 'max [ms]')]
+        for phase in self.phases:
+            calls, total, mean, maximum = self.summary()[phase]
+            lines.append('%-12s %8i %12.4f %12.4f %12.4f' % (phase, calls, total, mean * 1e3, maximum * 1e3))
+        return '\n'.join(lines)
+
+class _NullTimer(object):
+    """Stub for :py:class:`PhaseTimer`, if timing is disabled."""
+    def tic(self):
+        """Return zero."""
+        return 0.0
+    def toc(self, phase, start):
+        """Do nothing."""
+        return 0.0
+    def new_episode(self):
+        """Do nothing."""
+        return None
+
+_NULL_TIMER = _NullTimer()
+
+class _StepMemo(object):
+    """Memoization of the critic inputs within a control cycle.
+    
+    The state-part of the critic input is stored for the last two
+    epochs (by identity), which covers the current and next state of a
+    step. Normalized actions are stored by value and normalization
+    parameters, such that actions with the same parameters under
+    different names (e.g. *a_curr* and *a_next*) are shared. The
+    parameters are looked up on every call, hence changes of the
+    normalization take effect immediately. The memo is bound to the
+    plant and normalization instances it was created with.
+    """
+    def __init__(self, normalizer, plant, size=2, max_actions=8):
+        self.normalizer = normalizer
+        self.plant = plant
+        self.plant_normalizer = plant.normalization
+        self.states = collections.deque(maxlen=size)
+        self.actions = {}
+        self.max_actions = max_actions
+        self._params = []
+        self._names = {}
+    
+    def state_input(self, state):
+        """Return the state-part of the critic input of ``state``."""
+        for epoch, in_state in self.states:
+            if epoch is state:
+                return in_state
+        
+        in_state = self.plant.state_input(state)
+        self.states.append((state, in_state))
+        return in_state
+    
+    def normalize_action(self, name, action):
+        """Return ``action``, normalized with the parameters of
+        ``name``."""
+        group = self._group(name, self.normalizer.get(name))
+        key = (group, action.shape, action.tostring())
+        action_nrm = self.actions.get(key)
+        if action_nrm is None:
+            if len(self.actions) >= self.max_actions:
+                self.actions.clear()
+            action_nrm = self.normalizer.normalize_value(name, action)
+            self.actions[key] = action_nrm
+        return action_nrm
+    
+    def _group(self, name, params):
+        """Return the index of the normalization parameters ``params``
+        of ``name``. Names with identical parameters share the index.
+        If the parameters of ``name`` changed, the index is derived
+        anew."""
+        known = self._names.get(name)
+        if known is not None and _same_params(known[0], params):
+            return known[1]
+        
+        for group, other in enumerate(self._params):
+            if _same_params(params, other):
+                break
+        else:
+            group = len(self._params)
+            self._params.append(params)
+        
+        self._names[name] = (params, group)
+        return group
+
+def _same_params(params, other):
+    """Return True if the normalization parameters ``params`` and
+    ``other`` are equal."""
+    return params is other or all([np.array_equal(a, b) for a, b in zip(params, other)])
+
 class ActorCritic(PuPy.RobotActor):
     """Actor-critic design.
     
@@ -276,8 +484,51 @@ class ActorCritic(PuPy.RobotActor):
         Note that the parameters for *a_curr* and *a_next* should be
         exchangable, since it's really the same kind of 'sensor'.
     
+    ``record``
+        Recording policy, i.e. which intermediate results are written
+        into the epoch (and thus stored by a
+        :py:class:`PuPy.RobotCollector`). Either a level of
+        :py:attr:`RECORDING_LEVELS` ('minimal', 'standard', 'full') or
+        a custom collection of keys. Default is 'full'. See
+        :py:meth:`set_recording`.
+    
+    ``record_every``
+        :py:keyword:`dict`, mapping keys to a decimation factor *K*.
+        The respective value is only recorded every *K* steps.
+    
+    ``timing``
+        Measure the time spent in the phases of the control loop. See
+        :py:meth:`set_timing`. Default is :py:const:`False`.
+    
+    ``time_budget``
+        Time budget per step in milliseconds. If exceeded, the step is
+        degraded. See :py:meth:`set_time_budget`. Default is
+        :py:const:`None` (no budget).
+    
     """
-    def __init__(self, plant, policy, gamma=1.0, alpha=1.0, init_steps=1, norm=None, momentum=0.0):
+    RECORDING_LEVELS = {
+        'minimal'   : ('a_curr', 'a_next', 'reward', 'err'),
+        'standard'  : ('a_curr', 'a_next', 'reward', 'err', 'gamma', 'deriv', 'deriv2', 'i_curr', 'i_next', 'j_curr', 'j_next'),
+        'full'      : None,
+        }
+    
+    TIMING_PHASES = ('reward', 'state_input', 'critic', 'deriv', 'action', 'train', 'step', 'policy')
+    
+    # Defaults, such that instances stored by earlier versions load
+    _record_keys = None
+    _record_every = {}
+    timer = _NULL_TIMER
+    time_budget = None
+    deadline_misses = 0
+    _deadline = float('inf')
+    _backlog = None
+    
+    _memo = None
+    
+    # Attributes which are not stored (see __getstate__)
+    _transient = ('_memo', )
+    
+    def __init__(self, plant, policy, gamma=1.0, alpha=1.0, init_steps=1, norm=None, momentum=0.0, record='full', record_every=None, timing=False, time_budget=None):
         super(ActorCritic, self).__init__(child=policy)
         
         # Initial members
@@ -298,6 +549,9 @@ class ActorCritic(PuPy.RobotActor):
         self.set_alpha(alpha)
         self.set_gamma(gamma)
         self.set_momentum(momentum)
+        self.set_recording(record, record_every)
+        self.set_timing(timing)
+        self.set_time_budget(time_budget)
         
         # Check assumptions
         assert self.child.initial_action().shape[0] >= 1
@@ -310,12 +564,21 @@ class ActorCritic(PuPy.RobotActor):
         """Start a new episode of the same experiment. This method can
         also be used to initialize the *ActorCritic*, for example when
         it is loaded from a file.
+        
+        If timing is enabled, the durations of the finished episode
+        are passed to :py:meth:`_pre_increment_hook` as *timing* (see
+        :py:meth:`set_timing`).
         """
+        timing = self.timer.new_episode()
+        if timing is not None:
+            self._pre_increment_hook(dict(), timing=np.atleast_2d([timing.get(phase, 0.0) for phase in self.TIMING_PHASES]))
+        
         self.num_episode += 1
         self.a_curr = self.child.initial_action()
         self._motor_action_dim = self.child.action_space_dim()
         self.s_curr = dict()
         self.num_step = 0
+        self._memo = None
     
     def init_episode(self, epoch, time_start_ms, time_end_ms, step_size_ms):
         """Define the behaviour during the initial phase, i.e. as long
@@ -356,7 +619,13 @@ class ActorCritic(PuPy.RobotActor):
         # observe sensors values produced by the action (a_curr = previous a_next)
         
         # Generate reinforcement signal U(k), given in(k)
+        if self.time_budget is not None:
+            self._deadline = time.time() + 1e-3 * self.time_budget
+        
+        timer = self.timer
+        time_start = timer.tic()
         reward = self.plant.reward(epoch)
+        time_start = timer.toc('reward', time_start)
         #reward = self.plant.reward(self.s_curr)
         # It's not clear, which reward should be the input to the critic:
         # While the ACD papers imply the reward of time step n, the book
@@ -368,6 +637,7 @@ class ActorCritic(PuPy.RobotActor):
         
         # do the actual work
         epoch = self._step(self.s_curr, epoch, self.a_curr, reward)
+        time_start = timer.toc('step', time_start)
         
         # increment
         self.a_curr = np.atleast_2d(epoch['a_next']).T
@@ -375,7 +645,12 @@ class ActorCritic(PuPy.RobotActor):
         self.num_step += 1
         
         # return next action
-        return self.child(epoch, time_start_ms, time_end_ms, step_size_ms)
+        targets = self.child(epoch, time_start_ms, time_end_ms, step_size_ms)
+        timer.toc('policy', time_start)
+        if self._time_left() < 0.0:
+            self.deadline_misses += 1
+        
+        return targets
     
     def _step(self, s_curr, s_next, a_curr, reward):
         """Execute one step of the actor and return the next action.
@@ -410,16 +685,86 @@ class ActorCritic(PuPy.RobotActor):
         
         Before the actor-critic cycle increments, this method is invoked
         with all relevant locals of the :py:meth:`ADHDP.__call__`
-        method.
+        method. Arrays which live in reused buffers (e.g. the critic
+        inputs *x_curr* and *x_next*) are passed as they are and
+        overwritten in the next step, hence a hook must copy the arrays
+        it keeps.
         """
         pass
     
+    def _record(self, epoch, **values):
+        """Write ``values`` into the ``epoch``, according to the
+        recording policy (see :py:meth:`set_recording`). Recorded values
+        are copied, values which are not recorded are neither copied nor
+        stored. The next action *a_next* is always written, as it's
+        required by the :py:class:`Policy`.
+        """
+        keys, every = self._record_keys, self._record_every
+        for key, value in values.iteritems():
+            if key != 'a_next':
+                if keys is not None and key not in keys:
+                    continue
+                if key in every and self.num_step % every[key] != 0:
+                    continue
+            
+            epoch[key] = np.array(value)
+        
+        return epoch
+    
+    def _step_memo(self):
+        """Return the memo of the critic inputs. A new one is set up if
+        the plant or normalization was changed."""
+        memo = self._memo
+        plant = self.plant
+        if memo is None or memo.plant is not plant or memo.normalizer is not self.normalizer or memo.plant_normalizer is not plant.normalization:
+            memo = self._memo = _StepMemo(self.normalizer, plant)
+        return memo
+    
+    def _state_input(self, state):
+        """Return the state-part of the critic input of the epoch
+        ``state``, as computed by :py:meth:`Plant.state_input`.
+        
+        The result is memoized for the last two epochs, since each
+        epoch is evaluated as next state in one step and as current
+        state in the next one. The memo is keyed on the identity of
+        ``state``, hence the sensor values of an epoch must not be
+        altered in-place. The returned vector must not be altered
+        either.
+        
+        """
+        return self._step_memo().state_input(state)
+    
+    def _normalize_action(self, name, action):
+        """Return the ``action`` normalized w.r.t. ``name``.
+        
+        The result is memoized, such that the next action of a step is
+        not normalized again as current action of the following step.
+        The returned vector must not be altered.
+        
+        """
+        return self._step_memo().normalize_action(name, action)
+    
+    def _time_left(self):
+        """Return the remaining time (in seconds) of the current step's
+        budget. Without a budget, infinity is returned."""
+        if self.time_budget is None:
+            return float('inf')
+        return self._deadline - time.time()
+    
     def _next_action_hook(self, a_next):
         """Postprocessing hook, after the next action ``a_next`` was
         proposed by the algorithm. Must return the possibly altered
         next action in the same format."""
         return a_next
     
+    def __getstate__(self):
+        """Return the state for pickling. Transient attributes (e.g.
+        threads) are not included, they're set up again on demand."""
+        state = self.__dict__.copy()
+        for key in self._transient:
+            state.pop(key, None)
+        return state
+    
     def save(self, pth):
         """Store the current instance in a file at ``pth``.
         
@@ -432,8 +777,8 @@ class ActorCritic(PuPy.RobotActor):
         child = self.child
         self.child = None
         
-        f = open(pth, 'w')
-        pickle.dump(self, f)
+        f = open(pth, 'wb')
+        pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
         f.close()
         
         self.child = child
@@ -442,11 +787,54 @@ class ActorCritic(PuPy.RobotActor):
     def load(pth):
         """Load an instance from a file ``pth``.
         """
-        f = open(pth, 'r')
+        f = open(pth, 'rb')
         cls = pickle.load(f)
         cls.new_episode()
         return cls
     
+    def save_checkpoint(self, pth, background=True):
+        """Store the current instance as checkpoint in the directory
+        ``pth`` (see :py:mod:`HDPy.checkpoint`). The numeric state is
+        written as raw arrays. If ``background`` is set, the instance is
+        only snapshot in memory and written by a background thread; use
+        :py:func:`wait_checkpoints` before relying on the files.
+        
+        As with :py:meth:`save`, the policy is not stored.
+        
+        """
+        child = self.child
+        self.child = None
+        try:
+            save_checkpoint(self, pth, background)
+        finally:
+            self.child = child
+    
+    def restore_checkpoint(self, pth):
+        """Replace the state of the instance by the checkpoint in the
+        directory ``pth`` (see :py:meth:`save_checkpoint`). The policy
+        of the instance is kept. In contrast to
+        :py:meth:`load_checkpoint`, this allows to reset an instance to
+        an earlier state while references to it remain valid.
+        """
+        state = load_checkpoint(pth, mmap=False).__dict__
+        state.pop('child', None)
+        for key in self._transient:
+            self.__dict__.pop(key, None)
+        self.__dict__.update(state)
+    
+    @staticmethod
+    def load_checkpoint(pth, policy=None, mmap=True):
+        """Load an instance from the checkpoint directory ``pth``. The
+        arrays are memory-mapped (copy-on-write) if ``mmap`` is set.
+        If a ``policy`` is given, it's attached to the instance and a new
+        episode is started. Otherwise, this is up to the caller.
+        """
+        cls = load_checkpoint(pth, mmap)
+        if policy is not None:
+            cls.child = policy
+            cls.new_episode()
+        return cls
+    
     def set_alpha(self, alpha):
         """Define a value for ``alpha``. May be either a constant or
         a function of the time.
@@ -474,6 +862,98 @@ class ActorCritic(PuPy.RobotActor):
         else:
             self.momentum = ConstMomentum(momentum)
     
+    def set_recording(self, record='full', record_every=None):
+        """Define which intermediate results are written into the epoch.
+        
+        ``record``
+            Either the name of a level in :py:attr:`RECORDING_LEVELS`
+            or a collection of keys. The level 'full' records all
+            values.
+        
+        ``record_every``
+            :py:keyword:`dict`, mapping a key to a decimation factor
+            *K*. Then, the value is only recorded every *K* steps (e.g.
+            {'readout': 100}). Keys not listed are recorded in every
+            step.
+        
+        """
+        if isinstance(record, basestring):
+            if record not in self.RECORDING_LEVELS:
+                raise Exception('Unknown recording level: %s' % record)
+            keys = self.RECORDING_LEVELS[record]
+        else:
+            keys = record
+        
+        if keys is not None:
+            keys = frozenset(keys)
+        
+        if record_every is None:
+            record_every = {}
+        
+        for key, every in record_every.iteritems():
+            if int(every) < 1:
+                raise Exception('Decimation of %s must be positive' % key)
+        
+        self._record_keys = keys
+        self._record_every = dict((key, int(every)) for key, every in record_every.iteritems())
+    
+    def set_timing(self, timing=True):
+        """Enable or disable the timing instrumentation.
+        
+        If enabled, the time spent in the phases of the control loop is
+        accumulated in ``timer``, a :py:class:`PhaseTimer`. Which
+        phases are measured depends on the algorithm, typically these
+        are listed in :py:attr:`TIMING_PHASES`. The durations are
+        exclusive, e.g. *step* only covers the part of :py:meth:`_step`
+        which is not attributed to another phase (see
+        :py:class:`PhaseTimer`). At the end of each episode (in
+        :py:meth:`new_episode`), the total durations of the episode are
+        passed to :py:meth:`_pre_increment_hook` as *timing*, a 1xF
+        array in the order of :py:attr:`TIMING_PHASES`. A hook may
+        store them alongside the collected data.
+        
+        If disabled, the measurement is replaced by a stub.
+        
+        ``timing``
+            :py:const:`True`, :py:const:`False` or a
+            :py:class:`PhaseTimer` instance to be used.
+        
+        """
+        if isinstance(timing, PhaseTimer):
+            self.timer = timing
+        elif timing:
+            self.timer = PhaseTimer()
+        else:
+            self.timer = _NULL_TIMER
+    
+    def set_time_budget(self, time_budget, backlog=1000):
+        """Set a time budget per step, for real-time operation.
+        
+        The time is measured from the start of :py:meth:`__call__`
+        (after the initial phase) to the return of the child. If the
+        budget is exceeded, the step counts as deadline miss (see
+        ``deadline_misses``). Before, the algorithm degrades
+        gracefully as far as possible; it may cap the action search
+        (see :py:meth:`_time_left`), which retains the previous action
+        if there's no time left at all, or defer the critic training
+        to a backlog of at most ``backlog`` samples. The backlog is
+        processed in later steps, if time remains, and at the latest
+        when a new episode starts. If the backlog is full, the oldest
+        samples are dropped.
+        
+        ``time_budget``
+            Time budget in milliseconds or :py:const:`None` to disable
+            the budget.
+        
+        """
+        self.time_budget = time_budget
+        self.deadline_misses = 0
+        self._deadline = float('inf')
+        if time_budget is None:
+            self._backlog = None
+        else:
+            self._backlog = collections.deque(maxlen=backlog)
+    
     def set_normalization(self, norm):
         """Set the normalization instance to ``norm``. The normalization
         is propagated to the plant and policy."""
@@ -482,4 +962,5 @@ class ActorCritic(PuPy.RobotActor):
         self.normalizer = norm
         self.plant.set_normalization(norm)
         self.child.set_normalization(norm) # for the policy.
+        self._memo = None
 
@@ -0,0 +1,101 @@
+"""
+Run a population of ADHDP agents in lockstep and, side by side, the
+same agents individually. The actions and trained readouts of both must
+agree up to numerical precision.
+"""
+import HDPy
+import PuPy
+import numpy as np
+import copy
+
+# setup:
+num_agents = 8
+num_steps = 100
+samples_per_step = 150
+
+# Policy setup
+bound_gait = {
+    'amplitude' : ( 0.8, 1.0, 0.8, 1.0),
+    'frequency' : (1.0, 1.0, 1.0, 1.0),
+    'offset'    : ( -0.23, -0.23, -0.37, -0.37),
+    'phase'     : (0.0, 0.0, 0.5, 0.5)
+}
+
+# Normalization of the GPS and actions
+nrm = PuPy.Normalization()
+nrm.set('puppyGPS_x', 0.0, 2.0)
+nrm.set('puppyGPS_y', 0.0, 2.0)
+nrm.set('a_curr', 0.9, 0.5)
+nrm.set('a_next', 0.9, 0.5)
+
+def create_agent(idx):
+    """Create an agent, with its own reservoir and parameters."""
+    policy = HDPy.puppy.policy.LRA(PuPy.Gait(bound_gait))
+    plant = HDPy.puppy.plant.SpeedReward()
+    np.random.seed(idx)
+    reservoir = HDPy.ReservoirNode(
+        output_dim      = 20,
+        input_dim       = policy.action_space_dim() + plant.state_space_dim(),
+        spectral_radius = 0.9,
+        w               = HDPy.sparse_reservoir(10),
+    )
+    reservoir.initialize()
+    readout = HDPy.StabilizedRLS(
+        with_bias       = True,
+        input_dim       = reservoir.get_output_dim() + reservoir.get_input_dim(),
+        output_dim      = 1,
+        lambda_         = 1.0
+    )
+    return HDPy.ADHDP(
+        reservoir       = reservoir,
+        readout         = readout,
+        plant           = plant,
+        policy          = policy,
+        gamma           = 0.3 + 0.05 * idx,
+        alpha           = 0.002 * (idx + 1),
+        init_steps      = 5,
+        norm            = nrm
+    )
+
+def create_epoch(rnd, position):
+    """Return an epoch of a robot walking randomly from ``position``."""
+    gps = position + np.cumsum(rnd.normal(0.0, 0.002, size=(samples_per_step, 2)), axis=0)
+    return {
+        'puppyGPS_x'        : gps[:, 0],
+        'puppyGPS_y'        : gps[:, 1],
+        'accelerometer_z'   : 9.81 + rnd.normal(size=samples_per_step),
+        }
+
+agents = [create_agent(idx) for idx in range(num_agents)]
+reference = copy.deepcopy(agents)
+population = HDPy.ADHDPPopulation(agents)
+
+rnd = np.random.RandomState(0)
+positions = np.zeros((num_agents, 2))
+max_diff = 0.0
+for step in range(num_steps):
+    epochs = [create_epoch(rnd, positions[idx]) for idx in range(num_agents)]
+    positions = np.array([[epoch['puppyGPS_x'][-1], epoch['puppyGPS_y'][-1]] for epoch in epochs])
+    
+    # Population: one call for all agents
+    actions = population([dict(epoch) for epoch in epochs])
+    
+    # Reference: each agent on its own
+    for idx, agent in enumerate(reference):
+        agent(dict(epochs[idx]), step * 3000, (step + 1) * 3000, 20)
+    
+    actions_ref = np.array([agent.a_curr[:, 0] for agent in reference])
+    max_diff = max(max_diff, np.abs(actions - actions_ref).max())
+    
+    # Restart some of the agents
+    if step == num_steps / 2:
+        population.new_episode([1, 4])
+        for idx in (1, 4):
+            reference[idx].new_episode()
+            positions[idx] = 0.0
+
+population.sync()
+beta_diff = max([np.abs(agent.readout.beta - ref.readout.beta).max() for agent, ref in zip(agents, reference)])
+print "Max. action difference:", max_diff
+print "Max. readout difference:", beta_diff
+assert max_diff < 1e-6 and beta_diff < 1e-6
@@ -0,0 +1,130 @@
+"""
+Run the offline pipeline without webots: Collect data with the
+:py:class:`HDPy.puppy.HeadlessPuppy` stand-in, replay it into a critic
+and train a critic online. The critics must stay finite and a run must
+be reproducible from its seed.
+"""
+import HDPy
+import PuPy
+import numpy as np
+import h5py
+import os
+
+# setup:
+sampling_period_ms = 20
+ctrl_period_ms = 3000
+samples_per_action = ctrl_period_ms / sampling_period_ms
+pth_data = '/tmp/puppy_headless_data.hdf5'
+
+# Policy setup
+bound_gait = {
+    'amplitude' : ( 0.8, 1.0, 0.8, 1.0),
+    'frequency' : (1.0, 1.0, 1.0, 1.0),
+    'offset'    : ( -0.23, -0.23, -0.37, -0.37),
+    'phase'     : (0.0, 0.0, 0.5, 0.5)
+}
+
+# Normalization of the GPS and actions
+nrm = PuPy.Normalization()
+nrm.set('puppyGPS_x', 0.0, 10.0)
+nrm.set('puppyGPS_y', 0.0, 10.0)
+nrm.set('a_curr', 0.9, 0.5)
+nrm.set('a_next', 0.9, 0.5)
+
+def collect(seed, expfile=None):
+    """Run the offline collector on the headless robot for one hour of
+    simulated time. Return the robot."""
+    policy = HDPy.puppy.policy.LRA(PuPy.Gait(bound_gait))
+    if expfile is not None:
+        policy = PuPy.RobotCollector(
+            child   = policy,
+            expfile = expfile
+        )
+    
+    actor = HDPy.puppy.OfflineCollector(
+        policy      = policy,
+        init_steps  = 10,
+        sampler     = HDPy.puppy.TruncatedNormalSampler(rnd=np.random.RandomState(seed))
+    )
+    robot = HDPy.puppy.HeadlessPuppy(
+        actor,
+        sampling_period_ms  = sampling_period_ms,
+        ctrl_period_ms      = ctrl_period_ms,
+        seed                = seed,
+        max_episode_ms      = 120000,
+        tumble_rate         = 0.5
+    )
+    robot.run(3600 * 1000)
+    # store the last episode
+    actor.signal('new_episode')
+    return robot
+
+def create_critic(seed):
+    """Create a critic with the speed reward."""
+    policy = HDPy.puppy.policy.LRA(PuPy.Gait(bound_gait))
+    plant = HDPy.puppy.plant.SpeedReward()
+    np.random.seed(seed)
+    reservoir = HDPy.ReservoirNode(
+        output_dim      = 50,
+        input_dim       = policy.action_space_dim() + plant.state_space_dim(),
+        spectral_radius = 0.9,
+        w               = HDPy.sparse_reservoir(20),
+    )
+    reservoir.initialize()
+    readout = HDPy.StabilizedRLS(
+        with_bias       = True,
+        input_dim       = reservoir.get_output_dim() + reservoir.get_input_dim(),
+        output_dim      = 1,
+        lambda_         = 1.0
+    )
+    return HDPy.PuppyHDP(
+        tumbled_reward  = 0.0,
+        reservoir       = reservoir,
+        readout         = readout,
+        plant           = plant,
+        policy          = policy,
+        gamma           = 0.5,
+        alpha           = 0.05,
+        init_steps      = 10,
+        norm            = nrm
+    )
+
+# Collect offline data
+if os.path.exists(pth_data):
+    os.unlink(pth_data)
+
+robot = collect(0, pth_data)
+f = h5py.File(pth_data, 'r')
+num_episodes = len(f.keys())
+f.close()
+print "Collected", robot.num_steps, "steps,", num_episodes, "episodes,", robot.num_tumbles, "tumbles"
+assert num_episodes == robot.num_episodes
+
+# Replay the data into a critic
+critic = create_critic(0)
+errors = HDPy.puppy.offline_playback(
+    pth_data,
+    critic,
+    samples_per_action  = samples_per_action,
+    ms_per_step         = sampling_period_ms
+)
+print "Replay error:", errors
+assert np.isfinite(errors).all() and np.isfinite(critic.readout.beta).all()
+
+# Train a critic online
+critic = create_critic(0)
+robot = HDPy.puppy.HeadlessPuppy(
+    critic,
+    sampling_period_ms  = sampling_period_ms,
+    ctrl_period_ms      = ctrl_period_ms,
+    seed                = 1,
+    max_episode_ms      = 60000
+)
+robot.run(600 * 1000)
+print "Online:", robot.num_steps, "steps,", critic.num_episode, "episodes"
+assert np.isfinite(critic.readout.beta).all()
+
+# Runs are reproducible
+runs = [collect(5) for _ in range(2)]
+assert (runs[0].position == runs[1].position).all()
+assert runs[0].num_tumbles == runs[1].num_tumbles